@@ -1,7 +1,213 @@
-from django.contrib import admin
-from .models import Emails, Subscriber, BroadcastLog
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+from .analytics import record_subscribers
+from .models import DeliveryEvent, Emails, Subscriber, Suppression, BroadcastLog, BroadcastTiming, normalize_email
+from .search import SearchUnavailable, search
 
-# Register your models here.
-admin.site.register(Emails)
-admin.site.register(Subscriber)
-admin.site.register(BroadcastLog)
\ No newline at end of file
+# Lists longer than this are never counted exactly
+EXACT_COUNT_LIMIT = 10000
+# Ids taken from the full-text index for one admin search
+SEARCH_LIMIT = 1000
+
+
+def estimated_row_count(model):
+    """Cheap estimate of the number of rows in `model`'s table."""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        else:
+            # Ids only grow, so the highest one is an upper bound read from the index
+            cursor.execute(f'SELECT MAX({model._meta.pk.column}) FROM {connection.ops.quote_name(table)}')
+        row = cursor.fetchone()
+    return max(int(row[0] or 0), 0) if row else 0
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that never runs COUNT(*) over a whole large table.
+
+    Unfiltered lists use a table estimate; filtered lists are counted up to
+    EXACT_COUNT_LIMIT rows. Either way the number of pages is bounded, so
+    deep OFFSETs are out of reach: narrow the list with filters or search.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate > EXACT_COUNT_LIMIT:
+                return EXACT_COUNT_LIMIT
+        return queryset.order_by().values('pk')[:EXACT_COUNT_LIMIT].count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Skip the second, unfiltered COUNT(*) behind "N total"
+    show_full_result_count = False
+    list_per_page = 50
+    # Large text columns are not loaded on the changelist
+    changelist_defer = ()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        match = request.resolver_match
+        if self.changelist_defer and match and match.url_name.endswith('_changelist'):
+            queryset = queryset.defer(*self.changelist_defer)
+        return queryset
+
+
+def _full_text_ids(term, kind):
+    results, _ = search(term, kind=kind, limit=SEARCH_LIMIT)
+    return [result['id'] for result in results]
+
+
+@admin.register(Subscriber)
+class SubscriberAdmin(LargeTableAdmin):
+    list_display = ('email', 'device', 'is_active', 'created_at', 'updated_at')
+    list_select_related = ('device',)
+    # Served by core_sub_active_created
+    list_filter = ('is_active',)
+    search_help_text = 'Email prefix (ann, ann@ex) or domain (@example.com, includes subdomains)'
+    readonly_fields = ('email_normalized', 'domain_reversed', 'created_at', 'updated_at')
+    raw_id_fields = ('device',)
+    actions = ['activate', 'deactivate']
+
+    # Any non-empty value enables the search box; the lookup itself is get_search_results
+    search_fields = ('email_normalized',)
+
+    def get_search_results(self, request, queryset, search_term):
+        from .utils import _subscriber_search
+
+        search_term = search_term.strip()
+        if not search_term or search_term == '@':
+            return queryset, False
+        # Index range on email_normalized / domain_reversed instead of LIKE '%term%'
+        return queryset & _subscriber_search(search_term), False
+
+    def get_actions(self, request):
+        # Deleting loads every selected row; subscribers are deactivated instead
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def _set_active(self, request, queryset, active):
+        changing = queryset.filter(is_active=not active)
+        per_device = list(changing.order_by().values('device_id').annotate(total=Count('pk')))
+        updated = changing.update(is_active=active, updated_at=timezone.now())
+        for row in per_device:
+            if active:
+                record_subscribers(row['device_id'], reactivated=row['total'])
+            else:
+                record_subscribers(row['device_id'], deactivated=row['total'])
+        self.message_user(request, f"{'Activated' if active else 'Deactivated'} {updated} subscribers", messages.SUCCESS)
+
+    @admin.action(description='Activate selected subscribers')
+    def activate(self, request, queryset):
+        self._set_active(request, queryset, True)
+
+    @admin.action(description='Deactivate selected subscribers')
+    def deactivate(self, request, queryset):
+        self._set_active(request, queryset, False)
+
+
+@admin.register(BroadcastLog)
+class BroadcastLogAdmin(LargeTableAdmin):
+    list_display = ('broadcast_id', 'subject', 'device', 'status', 'recipients_count', 'sent_count',
+                    'failed_count', 'delivered_count', 'bounced_count', 'created_at', 'send_at')
+    list_select_related = ('device',)
+    # Served by core_bcast_status_history
+    list_filter = ('status',)
+    search_fields = ('broadcast_id',)
+    search_help_text = 'Exact broadcast id, or words from the subject and content'
+    raw_id_fields = ('device',)
+    changelist_defer = ('message', 'payload')
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q(broadcast_id=search_term)
+        try:
+            condition |= Q(id__in=_full_text_ids(search_term, 'broadcast'))
+        except SearchUnavailable:
+            pass
+        return queryset.filter(condition), False
+
+
+@admin.register(BroadcastTiming)
+class BroadcastTimingAdmin(LargeTableAdmin):
+    # Sort by a phase to find the broadcasts that were slow in it
+    list_display = ('broadcast', 'total_ms', 'validation_ms', 'upsert_ms', 'render_ms', 'queue_ms', 'provider_ms',
+                    'provider_calls', 'provider_p50_ms', 'provider_p99_ms', 'delivery_ms', 'bookkeeping_ms')
+    list_select_related = ('broadcast',)
+    search_fields = ('broadcast__broadcast_id',)
+    search_help_text = 'Exact broadcast id'
+    raw_id_fields = ('broadcast',)
+    changelist_defer = ('request_state', 'broadcast__message', 'broadcast__payload')
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(broadcast__broadcast_id=search_term), False
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(Emails)
+class EmailsAdmin(LargeTableAdmin):
+    list_display = ('subject', 'email', 'device', 'created_at', 'edited_at')
+    list_select_related = ('device',)
+    search_fields = ('subject',)
+    search_help_text = 'Words from the subject and content'
+    raw_id_fields = ('device',)
+    changelist_defer = ('message',)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        try:
+            return queryset.filter(id__in=_full_text_ids(search_term, 'email')), False
+        except SearchUnavailable:
+            messages.warning(request, 'Full-text search is not available on this database')
+            return queryset.none(), False
+
+
+@admin.register(DeliveryEvent)
+class DeliveryEventAdmin(LargeTableAdmin):
+    list_display = ('event', 'email', 'broadcast_id', 'reason', 'occurred_at')
+    search_fields = ('email',)
+    search_help_text = 'Exact email address or broadcast id'
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        # Served by core_event_email and core_event_broadcast
+        return queryset.filter(Q(email=normalize_email(search_term)) | Q(broadcast_id=search_term)), False
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(Suppression)
+class SuppressionAdmin(LargeTableAdmin):
+    list_display = ('email', 'reason', 'event_at', 'updated_at')
+    list_filter = ('reason',)
+    search_fields = ('email',)
+    search_help_text = 'Email prefix'
+    readonly_fields = ('created_at', 'updated_at')
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = normalize_email(search_term)
+        if not search_term:
+            return queryset, False
+        # Range instead of LIKE so the unique index on email is used
+        return queryset.filter(email__gte=search_term, email__lt=search_term + '\U0010ffff'), False
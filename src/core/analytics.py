@@ -0,0 +1,193 @@
+"""
+Pre-aggregated broadcast and subscriber analytics.
+
+Counters live in small daily rollup tables (BroadcastDailyStat and
+SubscriberDailyStat) that are incremented with a single UPDATE when a
+broadcast finishes or subscribers change, so dashboards read a handful of
+rows per day instead of scanning BroadcastLog and Subscriber.
+`manage.py backfill_analytics` rebuilds them from the existing history.
+"""
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import BroadcastDailyStat, BroadcastLog, Subscriber, SubscriberDailyStat
+from .progress import FINAL_STATUSES
+from .devices import device_key
+import logging
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_COUNTERS = ('broadcasts', 'recipients', 'sent', 'failed')
+SUBSCRIBER_COUNTERS = ('added', 'reactivated', 'deactivated')
+
+
+def _increment(model, keys, counts):
+    """Add `counts` to the row identified by `keys`, creating it if needed."""
+    counts = {name: value for name, value in counts.items() if value}
+    if not counts:
+        return
+    updates = {name: F(name) + value for name, value in counts.items()}
+    if model.objects.filter(**keys).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **counts)
+    except IntegrityError:
+        # Created concurrently by another process
+        model.objects.filter(**keys).update(**updates)
+
+
+def broadcast_day(broadcast_log):
+    return timezone.localdate(broadcast_log.send_at or broadcast_log.created_at)
+
+
+def record_broadcast(broadcast_log):
+    """Count a finished broadcast. Call exactly once, when its final status is set."""
+    if broadcast_log.status not in FINAL_STATUSES:
+        return
+    try:
+        _increment(
+            BroadcastDailyStat,
+            {'day': broadcast_day(broadcast_log), 'device_id': broadcast_log.device_id, 'status': broadcast_log.status},
+            {
+                'broadcasts': 1,
+                'recipients': broadcast_log.recipients_count,
+                'sent': broadcast_log.sent_count,
+                'failed': broadcast_log.failed_count,
+            },
+        )
+    except Exception:
+        logger.exception(f"Failed to record analytics for broadcast {broadcast_log.broadcast_id}")
+
+
+def record_subscribers(device_id, added=0, reactivated=0, deactivated=0):
+    """Count subscriber changes made today."""
+    try:
+        _increment(
+            SubscriberDailyStat,
+            {'day': timezone.localdate(), 'device_id': device_id},
+            {'added': added, 'reactivated': reactivated, 'deactivated': deactivated},
+        )
+    except Exception:
+        logger.exception('Failed to record subscriber analytics')
+
+
+# Reading -----------------------------------------------------------------
+
+def _failure_rate(sent, failed):
+    total = sent + failed
+    return round(failed / total, 4) if total else 0.0
+
+
+def date_range(days, end=None):
+    end = end or timezone.localdate()
+    return end - timedelta(days=days - 1), end
+
+
+def broadcast_series(start, end, device_id=None):
+    """Per-day broadcast counters between `start` and `end` (inclusive)."""
+    rows = BroadcastDailyStat.objects.filter(day__range=(start, end))
+    if device_id is not None:
+        rows = rows.filter(device_id=device_id)
+    by_day = {}
+    for row in rows.values('day', 'status', *BROADCAST_COUNTERS):
+        day = by_day.setdefault(row['day'], {name: 0 for name in BROADCAST_COUNTERS} | {'by_status': {}})
+        for name in BROADCAST_COUNTERS:
+            day[name] += row[name]
+        day['by_status'][row['status']] = day['by_status'].get(row['status'], 0) + row['broadcasts']
+
+    series = []
+    day = start
+    while day <= end:
+        counters = by_day.get(day, {name: 0 for name in BROADCAST_COUNTERS} | {'by_status': {}})
+        series.append({'date': day.isoformat(), **counters, 'failure_rate': _failure_rate(counters['sent'], counters['failed'])})
+        day += timedelta(days=1)
+    return series
+
+
+def subscriber_series(start, end, device_id=None):
+    """Per-day subscriber changes with the running number of active subscribers."""
+    rows = SubscriberDailyStat.objects.all()
+    if device_id is not None:
+        rows = rows.filter(device_id=device_id)
+    before = rows.filter(day__lt=start).aggregate(**{name: Sum(name) for name in SUBSCRIBER_COUNTERS})
+    active = (before['added'] or 0) + (before['reactivated'] or 0) - (before['deactivated'] or 0)
+
+    # One row per day and device: add up the devices
+    totals = (rows.filter(day__range=(start, end)).values('day')
+              .annotate(**{name: Sum(name) for name in SUBSCRIBER_COUNTERS}).order_by('day'))
+    by_day = {row['day']: row for row in totals}
+    series = []
+    day = start
+    while day <= end:
+        row = by_day.get(day, {})
+        counters = {name: row.get(name, 0) for name in SUBSCRIBER_COUNTERS}
+        net = counters['added'] + counters['reactivated'] - counters['deactivated']
+        active += net
+        series.append({'date': day.isoformat(), **counters, 'net': net, 'active': active})
+        day += timedelta(days=1)
+    return series
+
+
+def device_failure_rates(start, end):
+    """Sent/failed totals and failure rate per device_id over the range."""
+    rows = (BroadcastDailyStat.objects.filter(day__range=(start, end))
+            .values('device_id')
+            .annotate(broadcasts=Sum('broadcasts'), sent=Sum('sent'), failed=Sum('failed'))
+            .order_by('device_id'))
+    return [
+        {
+            'device_id': device_key(row['device_id']),
+            'broadcasts': row['broadcasts'],
+            'sent': row['sent'],
+            'failed': row['failed'],
+            'failure_rate': _failure_rate(row['sent'], row['failed']),
+        }
+        for row in rows
+    ]
+
+
+# Backfill ----------------------------------------------------------------
+
+def backfill():
+    """Rebuild both rollup tables from BroadcastLog and Subscriber.
+
+    History only records when a subscriber was created and, for inactive
+    ones, when they were last updated, so reactivations before the rollups
+    existed cannot be recovered; they count as added on their creation day.
+    """
+    broadcast_rows = {}
+    logs = (BroadcastLog.objects.filter(status__in=FINAL_STATUSES)
+            .only('device_id', 'status', 'created_at', 'send_at', 'recipients_count', 'sent_count', 'failed_count'))
+    for broadcast_log in logs.iterator(chunk_size=2000):
+        key = (broadcast_day(broadcast_log), broadcast_log.device_id, broadcast_log.status)
+        row = broadcast_rows.setdefault(key, dict.fromkeys(BROADCAST_COUNTERS, 0))
+        row['broadcasts'] += 1
+        row['recipients'] += broadcast_log.recipients_count
+        row['sent'] += broadcast_log.sent_count
+        row['failed'] += broadcast_log.failed_count
+
+    subscriber_rows = {}
+    for subscriber in Subscriber.objects.only('device_id', 'is_active', 'created_at', 'updated_at').iterator(chunk_size=2000):
+        device_id = subscriber.device_id
+        key = (timezone.localdate(subscriber.created_at), device_id)
+        subscriber_rows.setdefault(key, dict.fromkeys(SUBSCRIBER_COUNTERS, 0))['added'] += 1
+        if not subscriber.is_active:
+            key = (timezone.localdate(subscriber.updated_at), device_id)
+            subscriber_rows.setdefault(key, dict.fromkeys(SUBSCRIBER_COUNTERS, 0))['deactivated'] += 1
+
+    with transaction.atomic():
+        BroadcastDailyStat.objects.all().delete()
+        SubscriberDailyStat.objects.all().delete()
+        BroadcastDailyStat.objects.bulk_create(
+            [BroadcastDailyStat(day=day, device_id=device_id, status=status, **counters)
+             for (day, device_id, status), counters in broadcast_rows.items()],
+            batch_size=500,
+        )
+        SubscriberDailyStat.objects.bulk_create(
+            [SubscriberDailyStat(day=day, device_id=device_id, **counters)
+             for (day, device_id), counters in subscriber_rows.items()],
+            batch_size=500,
+        )
+    return len(broadcast_rows), len(subscriber_rows)
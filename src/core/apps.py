@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Resolve the newsletter image map once per process
+        from .assets import image_urls
+        image_urls()
+
+        # Keep the full-text search index in sync with emails and broadcasts
+        from .search import connect_signals
+        connect_signals()
+
+        # Long-lived workers import the provider clients at boot rather than
+        # on their first send
+        if getattr(settings, 'PRELOAD_PROVIDER_CLIENTS', False):
+            from .providers import preload
+            preload()
@@ -0,0 +1,70 @@
+"""
+Newsletter image URLs.
+
+The full image map is resolved once per process (at app start-up) instead of
+on every send. When `NEWSLETTER_ASSET_BASE_URL` is configured, images that
+were optimised by `manage.py optimize_images` are served from their
+content-hashed static paths, which can be cached forever by clients.
+"""
+from django.conf import settings
+from functools import lru_cache
+from pathlib import Path
+import json
+
+IMAGES_DIR = Path(__file__).resolve().parent / 'static' / 'images'
+OPTIMIZED_DIR = IMAGES_DIR / 'dist'
+MANIFEST_PATH = OPTIMIZED_DIR / 'manifest.json'
+
+# Image key -> (source file in core/static/images, max width, max height).
+# Sizes are twice the size the templates display the image at.
+NEWSLETTER_IMAGE_SOURCES = {
+    'icon2': ('icon2.png', 220, 220),
+    'icon': ('icon.png', 120, 120),
+    'logo': ('logo.png', 180, 180),
+    'qr_code': ('QRcode.jpg', 300, 300),
+    'instagram': ('instagram.png', 80, 80),
+    'tiktok': ('tiktok.png', 80, 80),
+    'twitter': ('twitter.png', 80, 80),
+    'whatsapp': ('whatsapp.png', 80, 80),
+    'header_bg': ('bacgroundtop.png', 1280, 880),
+    'footer_bg': ('backgroundbottom.jpg', 1280, 880),
+}
+
+
+def load_manifest():
+    """Return {image key: static path} written by optimize_images, or {}."""
+    try:
+        with open(MANIFEST_PATH) as fh:
+            return json.load(fh).get('images', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _configured_url(key):
+    imgs = getattr(settings, 'NEWSLETTER_IMAGES', {}) or {}
+    if imgs.get(key):
+        return imgs[key]
+    # Try common fallback attribute names
+    for suffix in ('_ICON_URL', '_URL'):
+        val = getattr(settings, f"{key.upper()}{suffix}", '')
+        if val:
+            return val
+    return ''
+
+
+@lru_cache(maxsize=None)
+def image_urls():
+    """Resolve every newsletter image URL once.
+
+    Hashed optimised assets win when NEWSLETTER_ASSET_BASE_URL is set (emails
+    need absolute URLs); otherwise the URLs configured in settings are used.
+    """
+    keys = set(NEWSLETTER_IMAGE_SOURCES) | set(getattr(settings, 'NEWSLETTER_IMAGES', {}) or {})
+    urls = {key: _configured_url(key) for key in keys}
+
+    base_url = getattr(settings, 'NEWSLETTER_ASSET_BASE_URL', '')
+    if base_url:
+        static_prefix = base_url.rstrip('/') + '/' + settings.STATIC_URL.strip('/') + '/'
+        for key, path in load_manifest().items():
+            urls[key] = static_prefix + path
+    return urls
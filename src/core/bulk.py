@@ -0,0 +1,139 @@
+"""
+Set-based bulk operations on subscribers (POST /subscribers/bulk/).
+
+Targets are a list of ids, a list of emails, or a filter (device, domain,
+active flag, creation date). They are processed in chunks of
+SUBSCRIBER_BULK_CHUNK_SIZE: per chunk, one indexed SELECT of the current
+state (by the listed values, or the next ids of the filter in id order) and
+one UPDATE (or DELETE) of the rows that change, in a short transaction.
+A filter handles at most SUBSCRIBER_BULK_MAX_ITEMS subscribers per request;
+the result then has `has_more` and the `next_after` id to continue from.
+Analytics rollups are updated once per device.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .analytics import record_subscribers
+from .models import Subscriber, domain_q, normalize_email
+
+ACTIONS = ('activate', 'deactivate', 'delete')
+
+# Unmatched ids / emails echoed back in the response
+NOT_FOUND_SAMPLE = 20
+
+
+def chunk_size():
+    return getattr(settings, 'SUBSCRIBER_BULK_CHUNK_SIZE', 500)
+
+
+def max_items():
+    return getattr(settings, 'SUBSCRIBER_BULK_MAX_ITEMS', 100000)
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def filter_queryset(base, device_id=None, domain=None, is_active=None, created_before=None):
+    subscribers = base
+    if device_id is not None:
+        subscribers = subscribers.filter(device_id=device_id)
+    if domain:
+        subscribers = subscribers.filter(domain_q(domain))
+    if is_active is not None:
+        subscribers = subscribers.filter(is_active=is_active)
+    if created_before is not None:
+        subscribers = subscribers.filter(created_at__lt=created_before)
+    return subscribers
+
+
+def _changes(action, is_active):
+    if action == 'activate':
+        return not is_active
+    if action == 'deactivate':
+        return is_active
+    return True
+
+
+def _apply_chunk(action, rows, dry_run, by_device):
+    """Apply `action` to the (id, device_id, is_active) rows of one chunk.
+    Returns the number of rows changed."""
+    changing = [row for row in rows if _changes(action, row[2])]
+    if not changing:
+        return 0
+    if not dry_run:
+        with transaction.atomic():
+            if action == 'delete':
+                Subscriber.objects.filter(id__in=[row[0] for row in changing]).delete()
+            else:
+                # Rows whose state changed since the SELECT are left alone
+                active = action == 'activate'
+                changed = Subscriber.objects.filter(id__in=[row[0] for row in changing], is_active=not active).update(
+                    is_active=active, updated_at=timezone.now())
+                if changed != len(changing):
+                    current = set(Subscriber.objects.filter(id__in=[row[0] for row in changing], is_active=active)
+                                  .values_list('id', flat=True))
+                    changing = [row for row in changing if row[0] in current]
+    for _, device_id, is_active in changing:
+        counters = by_device.setdefault(device_id, {'reactivated': 0, 'deactivated': 0})
+        if action == 'activate':
+            counters['reactivated'] += 1
+        elif is_active:
+            # Deactivated, or deleted while active
+            counters['deactivated'] += 1
+    return len(changing)
+
+
+def apply(action, base, ids=None, emails=None, filters=None, after=None, dry_run=False, limit=None):
+    """Apply `action` to the subscribers of `base` selected by `ids`, `emails`
+    or `filters` (keyword arguments of filter_queryset; ids above `after`,
+    at most `limit`, default max_items()).
+
+    Returns per-outcome counts: matched, changed, unchanged and, for lists,
+    requested / not_found with a sample of the unmatched values; for a
+    filter, has_more and next_after.
+    """
+    size = chunk_size()
+    result = {'action': action, 'dry_run': dry_run, 'matched': 0, 'changed': 0, 'unchanged': 0}
+    by_device = {}
+
+    if ids is not None or emails is not None:
+        if ids is not None:
+            column, values = 'id', list(dict.fromkeys(ids))
+        else:
+            column, values = 'email_normalized', list(dict.fromkeys(normalize_email(email) for email in emails if email))
+        missing = []
+        for chunk in _chunks(values, size):
+            rows = list(base.filter(**{f'{column}__in': chunk}).values_list('id', 'device_id', 'is_active', column))
+            found = {row[3] for row in rows}
+            missing += [value for value in chunk if value not in found]
+            changed = _apply_chunk(action, [row[:3] for row in rows], dry_run, by_device)
+            result['matched'] += len(rows)
+            result['changed'] += changed
+        result['requested'] = len(values)
+        result['not_found'] = len(missing)
+        result['not_found_sample'] = missing[:NOT_FOUND_SAMPLE]
+    else:
+        limit = limit or max_items()
+        matching = filter_queryset(base, **filters).order_by('id').values_list('id', 'device_id', 'is_active')
+        last_id, has_more = after or 0, True
+        while has_more and result['matched'] < limit:
+            # Keyset chunks: only one chunk of ids is held at a time
+            take = min(size, limit - result['matched'])
+            rows = list(matching.filter(id__gt=last_id)[:take + 1])
+            has_more = len(rows) > take
+            rows = rows[:take]
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            result['matched'] += len(rows)
+            result['changed'] += _apply_chunk(action, rows, dry_run, by_device)
+        result['has_more'] = has_more
+        result['next_after'] = last_id if has_more else None
+
+    result['unchanged'] = result['matched'] - result['changed']
+    if not dry_run:
+        for device_id, counters in by_device.items():
+            record_subscribers(device_id, **counters)
+    return result
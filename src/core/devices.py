@@ -0,0 +1,104 @@
+"""
+X-Device-ID resolution.
+
+Devices are stored once in the Device table and referenced by integer
+foreign keys. The header value is resolved to its id through a small
+in-process LRU cache, so a request normally costs no query for it; the
+reverse mapping is used to show the device key in API responses.
+
+Only endpoints that store something for the device (sending, creating emails
+and subscribers) create it, through resolve_device(). Everything else uses
+scope_device(): a key never seen before owns nothing, so it resolves to
+UNKNOWN_DEVICE, an id no row refers to, and reads come back empty without a
+Device row being written for every made-up header.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from django.db import IntegrityError
+from .models import Device
+import threading
+
+# Matches no rows; truthy, so device-scoped queries still filter by it
+UNKNOWN_DEVICE = -1
+
+_lock = threading.Lock()
+_ids = OrderedDict()   # key -> id
+_keys = OrderedDict()  # id -> key
+
+
+def _max_size():
+    return getattr(settings, 'DEVICE_CACHE_SIZE', 10000)
+
+
+def _remember(key, pk):
+    with _lock:
+        for cache, cache_key, value in ((_ids, key, pk), (_keys, pk, key)):
+            cache[cache_key] = value
+            cache.move_to_end(cache_key)
+            while len(cache) > _max_size():
+                cache.popitem(last=False)
+
+
+def resolve_device(key):
+    """Return the Device id for a header value (creating the device on first
+    sight), or None when no device was given."""
+    key = (key or '').strip()
+    if not key:
+        return None
+    with _lock:
+        pk = _ids.get(key)
+        if pk is not None:
+            _ids.move_to_end(key)
+            return pk
+    try:
+        pk = Device.objects.get_or_create(key=key)[0].pk
+    except IntegrityError:
+        # Created concurrently by another request
+        pk = Device.objects.get(key=key).pk
+    _remember(key, pk)
+    return pk
+
+
+def lookup_device(key):
+    """Like resolve_device() but never creates the device: None if unknown."""
+    key = (key or '').strip()
+    if not key:
+        return None
+    with _lock:
+        pk = _ids.get(key)
+    if pk is not None:
+        return pk
+    pk = Device.objects.filter(key=key).values_list('pk', flat=True).first()
+    if pk is not None:
+        _remember(key, pk)
+    return pk
+
+
+def scope_device(key):
+    """The Device id to scope a read (or an update of existing rows) to:
+    None when no device was given, UNKNOWN_DEVICE when it does not exist."""
+    pk = lookup_device(key)
+    if pk is None and (key or '').strip():
+        return UNKNOWN_DEVICE
+    return pk
+
+
+def device_key(pk):
+    """The X-Device-ID value of a Device id (None for None)."""
+    if pk is None:
+        return None
+    with _lock:
+        key = _keys.get(pk)
+        if key is not None:
+            _keys.move_to_end(pk)
+            return key
+    key = Device.objects.filter(pk=pk).values_list('key', flat=True).first()
+    if key is not None:
+        _remember(key, pk)
+    return key
+
+
+def clear_cache():
+    with _lock:
+        _ids.clear()
+        _keys.clear()
@@ -0,0 +1,63 @@
+from django.db import models
+import base64
+import binascii
+import zlib
+
+# Stored values starting with MARKER are never plain user text: compressed
+# bodies carry COMPRESSED_PREFIX, and plain text that happens to start with
+# MARKER is written behind ESCAPED_PREFIX.
+MARKER = '\x01'
+COMPRESSED_PREFIX = MARKER + 'zlib:'
+ESCAPED_PREFIX = MARKER + 'raw:'
+# Written by earlier versions; only trusted when the rest decodes (migration 0017)
+LEGACY_PREFIX = 'zlib:'
+
+
+class CompressedText(str):
+    """A value produced by compress_text, stored as is."""
+
+
+def compress_text(value):
+    """Encode text as COMPRESSED_PREFIX + base64 deflate."""
+    return CompressedText(COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8'), 9)).decode('ascii'))
+
+
+def inflate(encoded):
+    """Text of a base64 deflate string; raises ValueError when it is not one."""
+    try:
+        return zlib.decompress(base64.b64decode(encoded, validate=True)).decode('utf-8')
+    except (binascii.Error, zlib.error, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+
+
+def decompress_text(value):
+    if not isinstance(value, str) or not value.startswith(MARKER):
+        return value
+    if value.startswith(COMPRESSED_PREFIX):
+        try:
+            return inflate(value[len(COMPRESSED_PREFIX):])
+        except ValueError:
+            return value
+    if value.startswith(ESCAPED_PREFIX):
+        return value[len(ESCAPED_PREFIX):]
+    return value
+
+
+def escape_text(value):
+    """The stored form of plain text: escaped when it could pass for an encoded value."""
+    if isinstance(value, str) and not isinstance(value, CompressedText) and value.startswith(MARKER):
+        return ESCAPED_PREFIX + value
+    return value
+
+
+class CompressedTextField(models.TextField):
+    """A TextField whose stored value may be compressed by the retention job
+    (core.retention). Compressed values are inflated transparently when read,
+    and left as stored when they do not decode; values are always written as
+    plain text (escaped when they start with MARKER)."""
+
+    def from_db_value(self, value, expression, connection):
+        return decompress_text(value)
+
+    def get_db_prep_save(self, value, connection):
+        return super().get_db_prep_save(escape_text(value), connection)
@@ -0,0 +1,171 @@
+"""
+Priority lanes for outbound provider calls.
+
+Single sends (createEmail) go through the 'transactional' lane, broadcast
+sends through the 'bulk' lane. Every provider call of a process takes a slot
+first: at most `capacity` calls are in flight (by default the size of the
+provider connection pool), and `reserved` slots are held back for the
+transactional lane, so bulk sends can never occupy every connection. A freed
+slot goes to a waiting transactional send before any bulk send. Each lane
+has its own queue of waiting sends, whose depth and wait times are exposed
+by lane_stats() (GET /api/lanes/).
+
+Across processes (web workers, dispatcher, shard workers) the shared token
+bucket of core.ratelimit keeps its own reserve for transactional sends; the
+time spent waiting for a token is part of a lane's wait time.
+"""
+from contextlib import contextmanager
+from collections import deque
+from django.conf import settings
+from .ratelimit import acquire_provider_token
+import os
+import threading
+import time
+
+# Highest priority first
+LANES = ('transactional', 'bulk')
+
+DEFAULT_LANES = {
+    'capacity': None,  # defaults to PROVIDER_HTTP_POOL size
+    'reserved': {'transactional': 2},
+    'window': 500,  # recent waits kept per lane for the percentiles
+}
+
+
+def lane_settings():
+    options = dict(DEFAULT_LANES)
+    options.update(getattr(settings, 'SEND_LANES', {}) or {})
+    if not options['capacity']:
+        options['capacity'] = (getattr(settings, 'PROVIDER_HTTP_POOL', {}) or {}).get('size', 10)
+    return options
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class LaneScheduler:
+    """Slots for provider calls, shared by priority lanes."""
+
+    def __init__(self, capacity, reserved=None, window=500, clock=time.monotonic):
+        self.capacity = max(int(capacity), 1)
+        self.reserved = {lane: int((reserved or {}).get(lane, 0)) for lane in LANES}
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._in_flight = {lane: 0 for lane in LANES}
+        self._waiting = {lane: deque() for lane in LANES}
+        self._waits = {lane: deque(maxlen=window) for lane in LANES}
+        self._totals = {lane: {'calls': 0, 'wait_seconds': 0.0, 'max_wait': 0.0} for lane in LANES}
+
+    def limit(self, lane):
+        """Slots `lane` may use: the capacity less what other lanes reserve."""
+        others = sum(count for name, count in self.reserved.items() if name != lane)
+        return max(self.capacity - others, 1)
+
+    def _can_start(self, lane, ticket):
+        if sum(self._in_flight.values()) >= self.capacity or self._in_flight[lane] >= self.limit(lane):
+            return False
+        # First in its own queue, and no higher-priority lane waiting
+        if self._waiting[lane][0] is not ticket:
+            return False
+        return not any(self._waiting[name] for name in LANES[:LANES.index(lane)])
+
+    def acquire(self, lane):
+        ticket = object()
+        with self._cond:
+            waiting = self._waiting[lane]
+            waiting.append(ticket)
+            try:
+                while not self._can_start(lane, ticket):
+                    self._cond.wait()
+            finally:
+                waiting.remove(ticket)
+                # The next one in line may be able to start too
+                self._cond.notify_all()
+            self._in_flight[lane] += 1
+
+    def release(self, lane):
+        with self._cond:
+            self._in_flight[lane] -= 1
+            self._cond.notify_all()
+
+    def record(self, lane, waited):
+        with self._cond:
+            self._waits[lane].append(waited)
+            totals = self._totals[lane]
+            totals['calls'] += 1
+            totals['wait_seconds'] += waited
+            totals['max_wait'] = max(totals['max_wait'], waited)
+
+    @contextmanager
+    def slot(self, lane):
+        """Wait for a slot and a provider token in `lane`, then run the call."""
+        started = self.clock()
+        self.acquire(lane)
+        try:
+            acquire_provider_token(lane)
+            self.record(lane, self.clock() - started)
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        with self._cond:
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self._waits[lane])
+                totals = self._totals[lane]
+                lanes[lane] = {
+                    'depth': len(self._waiting[lane]),
+                    'in_flight': self._in_flight[lane],
+                    'limit': self.limit(lane),
+                    'reserved': self.reserved[lane],
+                    'calls': totals['calls'],
+                    'wait_ms': {
+                        'avg': round(totals['wait_seconds'] * 1000 / totals['calls'], 2) if totals['calls'] else 0,
+                        'p50': round(_percentile(waits, 0.5) * 1000, 2),
+                        'p95': round(_percentile(waits, 0.95) * 1000, 2),
+                        'max': round(totals['max_wait'] * 1000, 2),
+                    },
+                }
+        return {'capacity': self.capacity, 'lanes': lanes}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_scheduler_pid = os.getpid()
+
+
+def _reset_after_fork():
+    # Waiters of the parent do not exist in the child
+    global _scheduler, _scheduler_lock, _scheduler_pid
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+    _scheduler_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_scheduler():
+    """The process-wide lane scheduler."""
+    global _scheduler
+    if _scheduler_pid != os.getpid():
+        _reset_after_fork()
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                options = lane_settings()
+                _scheduler = LaneScheduler(options['capacity'], options['reserved'], options['window'])
+    return _scheduler
+
+
+def slot(lane):
+    return get_scheduler().slot(lane)
+
+
+def lane_stats():
+    return dict(get_scheduler().stats(), pid=os.getpid())
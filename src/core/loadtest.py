@@ -0,0 +1,373 @@
+"""
+Load-test harness for the API (`manage.py loadtest`).
+
+Everything runs in one process against a throwaway SQLite database:
+
+- a stand-in for the SendGrid API (FakeProvider) that accepts
+  /v3/mail/send with a configurable latency and error rate, wired in through
+  SENDGRID_API_HOST;
+- the WSGI app served by Django's threaded development server;
+- `concurrency` client threads replaying a weighted mix of scenarios, each
+  request carrying an X-Device-ID drawn from a skewed (Zipf-like) spread so
+  a few devices are much busier than the rest.
+
+Results are per scenario: throughput, latency percentiles and error rate.
+The JSON report also records the commit and the options, so runs can be
+compared across commits (see --compare).
+"""
+from django.conf import settings
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http.client
+import json
+import platform
+import random
+import subprocess
+import threading
+import time
+import uuid
+
+# Relative weights of the scenarios in Scenario.request
+DEFAULT_MIX = {
+    'routes': 2,
+    'subscribers.create': 25,
+    'subscribers.list': 5,
+    'subscribers.search': 10,
+    'emails.list': 5,
+    'search': 10,
+    'broadcasts.history': 15,
+    'broadcast.progress': 10,
+    'analytics': 10,
+    'broadcast.send': 3,
+}
+
+SEARCH_WORDS = ['launch', 'event', 'tickets', 'weekly', 'lagos', 'party', 'update']
+DOMAINS = ['example.com', 'mail.example.com', 'example.org', 'restless.test', 'inbox.test']
+
+
+def parse_mix(value):
+    """'name=weight,name=weight' -> dict (unknown names raise ValueError)."""
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f'Unknown scenario {name!r}; choose from {", ".join(DEFAULT_MIX)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+# Fake provider ---------------------------------------------------------------
+
+class FakeProvider:
+    """Accepts SendGrid mail sends on a local port."""
+
+    def __init__(self, latency=0.02, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.received = 0
+        self.rejected = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if provider.latency:
+                    time.sleep(provider.latency)
+                with provider._lock:
+                    failed = provider._random.random() < provider.error_rate
+                    if failed:
+                        provider.rejected += 1
+                    else:
+                        provider.received += 1
+                body = b'{"errors":[{"message":"simulated failure"}]}' if failed else b''
+                self.send_response(500 if failed else 202)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# App server ------------------------------------------------------------------
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class AppServer:
+    def __init__(self):
+        self.server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler, allow_reuse_address=True)
+        self.server.set_app(get_wsgi_application())
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Database --------------------------------------------------------------------
+
+def create_database(path):
+    """Create and migrate a throwaway database at `path`; returns the name to restore."""
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = str(path)
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    return old_name
+
+
+def destroy_database(old_name):
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def device_keys(count):
+    return [f'loadtest-device-{index:03d}' for index in range(count)]
+
+
+def seed(devices, subscribers_per_device=200, emails_per_device=20, broadcasts_per_device=10, rng=None):
+    """Give every device some subscribers, sent emails and finished broadcasts.
+    Returns the seeded broadcast ids."""
+    from .analytics import backfill
+    from .devices import resolve_device
+    from .models import BroadcastLog, Emails, Subscriber
+    from . import search
+
+    rng = rng or random.Random(0)
+    broadcast_ids = []
+    for key in devices:
+        device_id = resolve_device(key)
+        Subscriber.objects.bulk_create([
+            Subscriber(device_id=device_id, email=f'{key}-{index}@{rng.choice(DOMAINS)}')
+            for index in range(subscribers_per_device)
+        ], batch_size=500)
+
+        Emails.objects.bulk_create([
+            Emails(device_id=device_id, subject=f'{rng.choice(SEARCH_WORDS).title()} news #{index}',
+                   message=json.dumps({'title': f'{rng.choice(SEARCH_WORDS)} update',
+                                       'content': ' '.join(rng.choices(SEARCH_WORDS, k=40))}),
+                   email=f'{key}-{index}@example.com')
+            for index in range(emails_per_device)
+        ], batch_size=500)
+
+        logs = []
+        for index in range(broadcasts_per_device):
+            broadcast_id = f'{key}-seed-{index}'
+            broadcast_ids.append(broadcast_id)
+            logs.append(BroadcastLog(
+                device_id=device_id, broadcast_id=broadcast_id, subject=f'{rng.choice(SEARCH_WORDS).title()} broadcast',
+                message=json.dumps({'title': 'Seeded', 'content': ' '.join(rng.choices(SEARCH_WORDS, k=40))}),
+                recipients_count=100, sent_count=97, failed_count=3, status='partial',
+            ))
+        BroadcastLog.objects.bulk_create(logs, batch_size=500)
+
+    if search.fts_available():
+        search.rebuild()
+    backfill()
+    return broadcast_ids
+
+
+# Clients ---------------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            key = f'{name}:{status}'
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        scenarios = {}
+        everything = []
+        for name in sorted(self.latencies):
+            latencies = self.latencies[name]
+            everything += latencies
+            scenarios[name] = self._summary(latencies, self.errors.get(name, 0), elapsed)
+            scenarios[name]['statuses'] = {key.split(':', 1)[1]: count for key, count in self.statuses.items()
+                                           if key.split(':', 1)[0] == name}
+        total = self._summary(everything, sum(self.errors.values()), elapsed)
+        return scenarios, total
+
+    @staticmethod
+    def _summary(latencies, errors, elapsed):
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'error_rate': round(errors / len(latencies), 4) if latencies else 0.0,
+            'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': ms(percentile(latencies, 0.50)),
+            'p90_ms': ms(percentile(latencies, 0.90)),
+            'p99_ms': ms(percentile(latencies, 0.99)),
+            'max_ms': ms(max(latencies) if latencies else None),
+        }
+
+
+class Scenario:
+    """Builds the request for one scenario from the shared run state."""
+
+    def __init__(self, devices, broadcast_ids, recipients_per_broadcast, rng):
+        self.devices = devices
+        self.broadcast_ids = broadcast_ids
+        self.recipients_per_broadcast = recipients_per_broadcast
+        self.rng = rng
+        # Zipf-like: device n is picked with weight 1/(n+1)
+        self.device_weights = [1 / (index + 1) for index in range(len(devices))]
+        self._lock = threading.Lock()
+
+    def device(self):
+        return self.rng.choices(self.devices, weights=self.device_weights)[0]
+
+    def request(self, name):
+        """(method, path, JSON body or None) for scenario `name`."""
+        rng = self.rng
+        if name == 'routes':
+            return 'GET', '/api/', None
+        if name == 'subscribers.create':
+            return 'POST', '/api/subscribers/', {'email': f'signup-{uuid.uuid4().hex[:12]}@{rng.choice(DOMAINS)}'}
+        if name == 'subscribers.list':
+            return 'GET', '/api/subscribers/', None
+        if name == 'subscribers.search':
+            query = f'@{rng.choice(DOMAINS)}' if rng.random() < 0.5 else 'loadtest-device-0'
+            return 'GET', f'/api/subscribers/search/?q={query}&limit=50', None
+        if name == 'emails.list':
+            return 'GET', '/api/emails/', None
+        if name == 'search':
+            return 'GET', f'/api/search/?q={rng.choice(SEARCH_WORDS)}', None
+        if name == 'broadcasts.history':
+            return 'GET', '/api/broadcasts/?limit=20', None
+        if name == 'broadcast.progress':
+            with self._lock:
+                broadcast_id = rng.choice(self.broadcast_ids[-50:])
+            return 'GET', f'/api/broadcast/{broadcast_id}/progress/', None
+        if name == 'analytics':
+            return 'GET', '/api/analytics/?days=30', None
+        if name == 'broadcast.send':
+            broadcast_id = f'loadtest-{uuid.uuid4().hex}'
+            recipients = [f'reader-{index}@{rng.choice(DOMAINS)}' for index in range(self.recipients_per_broadcast)]
+            return 'POST', '/api/broadcast/send/', {
+                'subject': 'Load test broadcast', 'broadcastId': broadcast_id, 'recipients': recipients,
+                'message': json.dumps({'title': 'Load test', 'content': 'Hello from the load test'}),
+            }
+        raise ValueError(name)
+
+    def completed(self, name, body, status):
+        # Only poll the progress of broadcasts that exist
+        if name == 'broadcast.send' and isinstance(status, int) and 200 <= status < 300:
+            with self._lock:
+                self.broadcast_ids.append(body['broadcastId'])
+
+
+def run_clients(address, mix, scenario, concurrency, duration, warmup=0.0, timeout=60):
+    """Replay the mix from `concurrency` threads; returns (Stats, measured seconds)."""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    stats = Stats()
+    started = time.monotonic()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+
+    def worker():
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            name = scenario.rng.choices(names, weights=weights)[0]
+            method, path, body = scenario.request(name)
+            headers = {'X-Device-ID': scenario.device(), 'Accept': 'application/json'}
+            payload = None
+            if body is not None:
+                payload = json.dumps(body).encode('utf-8')
+                headers['Content-Type'] = 'application/json'
+            began = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection(*address, timeout=timeout)
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    response = conn.getresponse()
+                    response.read()
+                    status = response.status
+                finally:
+                    conn.close()
+            except Exception as e:
+                status = type(e).__name__
+            scenario.completed(name, body, status)
+            if now >= measure_from:
+                stats.record(name, time.perf_counter() - began, status)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, max(time.monotonic() - measure_from, 1e-9)
+
+
+def current_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                capture_output=True, text=True, timeout=5)
+        commit = result.stdout.strip() or None
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR,
+                               capture_output=True, text=True, timeout=5).stdout.strip()
+        return f'{commit}-dirty' if commit and dirty else commit
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment():
+    import django
+    return {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'started_at': timezone.now().isoformat(),
+    }
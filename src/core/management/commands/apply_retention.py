@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+from core.retention import (MODELS, compress_bodies, cutoff, database_stats, drop_finished_partitions,
+                            enable_incremental_vacuum, incremental_vacuum, prune, retention_settings)
+
+
+def _size(size):
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f'{size:,.0f} {unit}' if unit == 'bytes' else f'{size:,.1f} {unit}'
+        size /= 1024
+    return f'{size:,.1f} GiB'
+
+
+class Command(BaseCommand):
+    help = ('Compress old message bodies, drop the recipient partitions of finished broadcasts, '
+            'optionally archive and prune old rows, then return free space to the filesystem. '
+            'Defaults come from settings.RETENTION')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compress-after-days', type=int, help='Compress bodies older than this')
+        parser.add_argument('--prune-after-days', type=int, help='Archive and delete rows older than this')
+        parser.add_argument('--archive-dir', help='Directory for the gzipped JSON lines archives of pruned rows')
+        parser.add_argument('--no-archive', action='store_true', help='Delete pruned rows without archiving them')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--vacuum-pages', type=int, default=0,
+                            help='Free pages to release per run (0 releases all of them)')
+        parser.add_argument('--full-vacuum', action='store_true',
+                            help='Switch the database to incremental auto-vacuum first if needed (one full VACUUM)')
+
+    def handle(self, *args, **options):
+        config = retention_settings(
+            compress_after_days=options['compress_after_days'],
+            prune_after_days=options['prune_after_days'],
+            archive_dir=options['archive_dir'],
+            batch_size=options['batch_size'],
+        )
+        batch_size = config['batch_size']
+        before = database_stats()
+
+        if config['compress_after_days'] is not None:
+            older_than = cutoff(config['compress_after_days'])
+            for model in MODELS:
+                rows, raw, compressed = compress_bodies(model, older_than, batch_size, config['min_compress_bytes'])
+                self.stdout.write(f'{model._meta.db_table}: compressed {rows} bodies, {_size(raw)} -> {_size(compressed)}')
+            partitions = drop_finished_partitions(older_than, batch_size)
+            self.stdout.write(f'Dropped {partitions} partitions of finished broadcasts')
+
+        if config['prune_after_days']:
+            older_than = cutoff(config['prune_after_days'])
+            archive_dir = None if options['no_archive'] else config['archive_dir']
+            for model in MODELS:
+                rows, archive_path = prune(model, older_than, archive_dir, batch_size)
+                where = f' (archived to {archive_path})' if rows and archive_path else ''
+                self.stdout.write(f'{model._meta.db_table}: pruned {rows} rows{where}')
+
+        if before is None:
+            self.stdout.write(self.style.SUCCESS('Done (space is only reclaimed on SQLite)'))
+            return
+
+        if before['auto_vacuum'] != 2:
+            if not options['full_vacuum']:
+                self.stdout.write(self.style.WARNING(
+                    'auto_vacuum is not INCREMENTAL, so freed pages stay in the file. '
+                    'Run once with --full-vacuum (rewrites the database) to enable it'
+                ))
+            else:
+                self.stdout.write('Enabling incremental auto-vacuum (full VACUUM)...')
+                enable_incremental_vacuum()
+        else:
+            incremental_vacuum(options['vacuum_pages'] or None)
+
+        after = database_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Database {_size(before['size'])} -> {_size(after['size'])} "
+            f"({_size(before['size'] - after['size'])} reclaimed, "
+            f"{_size(after['freelist_count'] * after['page_size'])} still free inside the file)"
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core.analytics import backfill
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the daily analytics rollups from BroadcastLog and Subscriber history. '
+            'Run it while no broadcasts are finishing; increments made during the rebuild are lost')
+
+    def handle(self, *args, **options):
+        broadcast_rows, subscriber_rows = backfill()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {broadcast_rows} broadcast and {subscriber_rows} subscriber daily rollup rows'
+        ))
@@ -0,0 +1,121 @@
+from django.core.management.base import BaseCommand
+from io import BytesIO
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from core import fastjson, middleware
+import json
+import random
+import statistics
+import time
+import uuid
+
+MB = 1024 * 1024
+
+
+def broadcast_request(recipients, rng):
+    """A POST /broadcast/send/ body."""
+    return {
+        'subject': 'Spring line-up announced',
+        'message': json.dumps({'title': 'Spring line-up', 'content': 'Lorem ipsum dolor sit amet. ' * 40}),
+        'recipients': [f'{uuid.UUID(int=rng.getrandbits(128)).hex[:12]}@example{i % 97}.com' for i in range(recipients)],
+        'senderName': 'Restless Society',
+        'templateType': 'announcement',
+    }
+
+
+def history_response(rows, rng):
+    """A GET /broadcasts/ page, as returned by BroadcastLogListSerializer."""
+    return {
+        'results': [{
+            'id': i,
+            'device_id': f'device-{rng.randrange(50)}',
+            'broadcast_id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'subject': f'Newsletter #{i}: what is on this weekend',
+            'sender_email': 'hello@example.com',
+            'sender_name': 'Restless Society',
+            'recipients_count': rng.randrange(10000),
+            'sent_count': rng.randrange(10000),
+            'failed_count': rng.randrange(50),
+            'delivered_count': rng.randrange(10000),
+            'bounced_count': rng.randrange(50),
+            'complaint_count': rng.randrange(5),
+            'status': rng.choice(['sent', 'partial', 'failed']),
+            'created_at': '2026-10-19T18:16:00.123Z',
+            'send_at': None,
+        } for i in range(rows)],
+        'next_cursor': 'MjAyNi0xMC0xOVQxODoxNjowMC4xMjNafDEyMzQ1',
+    }
+
+
+class Command(BaseCommand):
+    help = ('Benchmark API JSON parsing / rendering (DRF stdlib vs core.fastjson) and response '
+            'compression, in milliseconds per megabyte of JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[1000, 10000, 50000],
+                            help='Broadcast request sizes (recipients)')
+        parser.add_argument('--rows', type=int, nargs='+', default=[500, 5000],
+                            help='Broadcast history response sizes (rows)')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (median is reported)')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def _time(self, function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
+
+    def handle(self, *args, **options):
+        rng = random.Random(1)
+        repeat = options['repeat']
+        cases = [(f'broadcast request, {n} recipients', broadcast_request(n, rng)) for n in options['recipients']]
+        cases += [(f'history response, {n} rows', history_response(n, rng)) for n in options['rows']]
+
+        parsers = {'drf': JSONParser(), 'fast': fastjson.FastJSONParser()}
+        renderers = {'drf': JSONRenderer(), 'fast': fastjson.FastJSONRenderer()}
+        results = []
+        for name, data in cases:
+            body = JSONRenderer().render(data)
+            megabytes = len(body) / MB
+            row = {'case': name, 'bytes': len(body)}
+            for label, parser in parsers.items():
+                seconds = self._time(lambda: parser.parse(BytesIO(body), parser_context={}), repeat)
+                row[f'parse_{label}_ms_per_mb'] = round(seconds * 1000 / megabytes, 2)
+            for label, renderer in renderers.items():
+                seconds = self._time(lambda: renderer.render(data), repeat)
+                row[f'render_{label}_ms_per_mb'] = round(seconds * 1000 / megabytes, 2)
+
+            compressed = middleware.gzip_compress(body)
+            row['gzip_ratio'] = round(len(body) / len(compressed), 1)
+            row['gzip_ms_per_mb'] = round(self._time(lambda: middleware.gzip_compress(body), repeat) * 1000 / megabytes, 2)
+            row['gunzip_ms_per_mb'] = round(self._time(
+                lambda: middleware.inflate(compressed, 'gzip', len(body)), repeat) * 1000 / megabytes, 2)
+            if middleware.brotli is not None:
+                compressed = middleware.brotli_compress(body)
+                row['brotli_ratio'] = round(len(body) / len(compressed), 1)
+                row['brotli_ms_per_mb'] = round(
+                    self._time(lambda: middleware.brotli_compress(body), repeat) * 1000 / megabytes, 2)
+            results.append(row)
+
+        report = {'orjson': fastjson.available(), 'brotli': middleware.brotli is not None, 'results': results}
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"orjson {'installed' if report['orjson'] else 'not installed (fast = stdlib)'}, "
+                          f"brotli {'installed' if report['brotli'] else 'not installed'}; ms per MB of JSON")
+        header = (f'{"case":<38}{"size":>9}{"parse drf":>11}{"fast":>8}{"render drf":>12}{"fast":>8}'
+                  f'{"gzip":>8}{"ratio":>7}{"gunzip":>8}')
+        if report['brotli']:
+            header += f'{"brotli":>8}{"ratio":>7}'
+        self.stdout.write(header)
+        for row in results:
+            line = (f'{row["case"]:<38}{row["bytes"] / MB:>7.2f}MB{row["parse_drf_ms_per_mb"]:>11.1f}'
+                    f'{row["parse_fast_ms_per_mb"]:>8.1f}{row["render_drf_ms_per_mb"]:>12.1f}'
+                    f'{row["render_fast_ms_per_mb"]:>8.1f}{row["gzip_ms_per_mb"]:>8.1f}'
+                    f'{row["gzip_ratio"]:>6.1f}x{row["gunzip_ms_per_mb"]:>8.1f}')
+            if report['brotli']:
+                line += f'{row["brotli_ms_per_mb"]:>8.1f}{row["brotli_ratio"]:>6.1f}x'
+            self.stdout.write(line)
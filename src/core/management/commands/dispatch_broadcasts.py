@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from core.scheduler import BroadcastDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Run the scheduled broadcast dispatcher (sleeps until the next broadcast is due)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of broadcasts that may send concurrently')
+        parser.add_argument('--resync-seconds', type=int, default=None,
+                            help='Safety interval for a full reload of scheduled broadcasts')
+
+    def handle(self, *args, **options):
+        dispatcher = BroadcastDispatcher(
+            workers=options['workers'],
+            resync_seconds=options['resync_seconds'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Broadcast dispatcher started ({dispatcher.workers} workers, resync every {dispatcher.resync_seconds}s)'
+        ))
+        try:
+            dispatcher.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Broadcast dispatcher stopped')
@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from core import loadtest
+from core.providers import close_clients
+from pathlib import Path
+import json
+import logging
+import random
+import shutil
+import tempfile
+
+
+class Command(BaseCommand):
+    help = ('Load-test the API: start the app and a fake email provider locally on a throwaway database, '
+            'replay a weighted mix of requests from concurrent clients and report throughput, latency '
+            'percentiles and error rates per scenario. Your database is not touched')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=20, help='Measured seconds')
+        parser.add_argument('--warmup', type=float, default=2, help='Seconds of unmeasured traffic first')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--mix', help=('Scenario weights, e.g. "subscribers.create=5,analytics=2" '
+                                           f'(default {",".join(f"{k}={v}" for k, v in loadtest.DEFAULT_MIX.items())})'))
+        parser.add_argument('--devices', type=int, default=20, help='Distinct X-Device-ID values')
+        parser.add_argument('--subscribers', type=int, default=200, help='Subscribers seeded per device')
+        parser.add_argument('--recipients', type=int, default=25, help='Recipients per broadcast.send request')
+        parser.add_argument('--provider-latency-ms', type=float, default=20)
+        parser.add_argument('--provider-error-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=1, help='Random seed, for repeatable runs')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--compare', help='A previous JSON report to compare against')
+        parser.add_argument('--json', action='store_true', help='Print the JSON report instead of a table')
+
+    def handle(self, *args, **options):
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = json.loads(Path(options['compare']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot read {options["compare"]}: {e}')
+
+        if options['verbosity'] < 2:
+            # Per-message INFO logging would dominate the output (and the timings)
+            logging.getLogger('core').setLevel(logging.WARNING)
+
+        rng = random.Random(options['seed'])
+        workdir = Path(tempfile.mkdtemp(prefix='newsletter-loadtest-'))
+        provider = loadtest.FakeProvider(options['provider_latency_ms'] / 1000, options['provider_error_rate'],
+                                         seed=options['seed'])
+        provider.start()
+        old_name = loadtest.create_database(workdir / 'loadtest.sqlite3')
+        try:
+            with override_settings(SENDGRID_API_HOST=provider.url, SENDGRID_API_KEY='loadtest',
+                                   BROADCAST_TRANSPORT='sendgrid'):
+                close_clients()
+                devices = loadtest.device_keys(options['devices'])
+                self.stderr.write(f'Seeding {len(devices)} devices...')
+                broadcast_ids = loadtest.seed(devices, options['subscribers'], rng=rng)
+
+                app = loadtest.AppServer()
+                app.start()
+                self.stderr.write(f'Running {options["concurrency"]} clients for {options["duration"]:g}s '
+                                  f'(+{options["warmup"]:g}s warm-up)...')
+                try:
+                    scenario = loadtest.Scenario(devices, broadcast_ids, options['recipients'], rng)
+                    stats, elapsed = loadtest.run_clients(app.address, mix, scenario, options['concurrency'],
+                                                          options['duration'], options['warmup'])
+                finally:
+                    app.stop()
+                    close_clients()
+        finally:
+            provider.stop()
+            loadtest.destroy_database(old_name)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        scenarios, total = stats.report(elapsed)
+        report = {
+            'environment': loadtest.environment(),
+            'options': {name: options[name] for name in (
+                'duration', 'warmup', 'concurrency', 'devices', 'subscribers', 'recipients',
+                'provider_latency_ms', 'provider_error_rate', 'seed')} | {'mix': mix},
+            'elapsed': round(elapsed, 2),
+            'provider': {'received': provider.received, 'rejected': provider.rejected},
+            'total': total,
+            'scenarios': scenarios,
+        }
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2))
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self._print_table(report, baseline)
+
+    def _print_table(self, report, baseline):
+        header = f'{"scenario":<22}{"requests":>9}{"rps":>8}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"max ms":>9}{"errors":>8}'
+        if baseline:
+            header += f'{"Δp50":>9}{"Δp99":>9}{"Δrps":>8}'
+        self.stdout.write(f"commit {report['environment']['commit'] or 'unknown'}, "
+                          f"{report['options']['concurrency']} clients, {report['elapsed']}s measured, "
+                          f"provider accepted {report['provider']['received']} messages")
+        self.stdout.write(header)
+        rows = list(report['scenarios'].items()) + [('TOTAL', report['total'])]
+        for name, row in rows:
+            line = (f'{name:<22}{row["requests"]:>9}{row["rps"]:>8.1f}{row["p50_ms"] or 0:>9.1f}'
+                    f'{row["p90_ms"] or 0:>9.1f}{row["p99_ms"] or 0:>9.1f}{row["max_ms"] or 0:>9.1f}'
+                    f'{row["error_rate"] * 100:>7.1f}%')
+            if baseline:
+                before = baseline['total'] if name == 'TOTAL' else baseline.get('scenarios', {}).get(name)
+                if before and before.get('p50_ms') and row['p50_ms']:
+                    line += (f'{(row["p50_ms"] / before["p50_ms"] - 1) * 100:>+8.0f}%'
+                             f'{(row["p99_ms"] / before["p99_ms"] - 1) * 100:>+8.0f}%'
+                             f'{(row["rps"] / before["rps"] - 1) * 100 if before["rps"] else 0:>+7.0f}%')
+            self.stdout.write(line)
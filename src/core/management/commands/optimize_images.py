@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.assets import IMAGES_DIR, MANIFEST_PATH, NEWSLETTER_IMAGE_SOURCES, OPTIMIZED_DIR, image_urls
+import hashlib
+import io
+import json
+
+
+class Command(BaseCommand):
+    help = ('Recompress and resize the newsletter images into content-hashed files under '
+            'core/static/images/dist and write the manifest used for image URLs (requires Pillow)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jpeg-quality', type=int, default=82)
+        parser.add_argument('--hash-length', type=int, default=12)
+
+    def _encode(self, image, fmt, jpeg_quality):
+        out = io.BytesIO()
+        if fmt == 'JPEG':
+            image.convert('RGB').save(out, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+        else:
+            image.save(out, 'PNG', optimize=True)
+        return out.getvalue()
+
+    def handle(self, *args, **options):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise CommandError('Pillow is required: pip install Pillow')
+
+        OPTIMIZED_DIR.mkdir(parents=True, exist_ok=True)
+        manifest = {}
+        total_before = total_after = 0
+
+        for key, (filename, max_width, max_height) in NEWSLETTER_IMAGE_SOURCES.items():
+            source = IMAGES_DIR / filename
+            if not source.exists():
+                self.stderr.write(self.style.WARNING(f'{key}: {filename} not found, skipped'))
+                continue
+
+            original = source.read_bytes()
+            stem, ext = filename.rsplit('.', 1)
+            with Image.open(source) as image:
+                image.thumbnail((max_width, max_height), Image.LANCZOS)
+                native = 'JPEG' if image.format == 'JPEG' or ext.lower() in ('jpg', 'jpeg') else 'PNG'
+                candidates = {native: self._encode(image, native, options['jpeg_quality'])}
+                # Opaque PNGs (photos, backgrounds) are usually far smaller as JPEG
+                if native == 'PNG' and 'A' not in image.getbands() and image.mode != 'P':
+                    candidates['JPEG'] = self._encode(image, 'JPEG', options['jpeg_quality'])
+            fmt, data = min(candidates.items(), key=lambda item: len(item[1]))
+            out_ext = 'jpg' if fmt == 'JPEG' else 'png'
+            # Never ship something bigger than the original
+            if len(data) >= len(original):
+                data, out_ext = original, ext.lower()
+
+            digest = hashlib.sha256(data).hexdigest()[:options['hash_length']]
+            hashed_name = f'{stem}.{digest}.{out_ext}'
+            target = OPTIMIZED_DIR / hashed_name
+            if not target.exists():
+                target.write_bytes(data)
+            # Drop older hashed versions of the same image
+            for stale in OPTIMIZED_DIR.glob(f'{stem}.*'):
+                if stale.name != hashed_name:
+                    stale.unlink()
+
+            manifest[key] = f'images/dist/{hashed_name}'
+            total_before += len(original)
+            total_after += len(data)
+            self.stdout.write(f'{key:10} {filename:22} {len(original):>10,} -> {len(data):>9,} bytes  {hashed_name}')
+
+        MANIFEST_PATH.write_text(json.dumps({'images': manifest}, indent=2, sort_keys=True) + '\n')
+        image_urls.cache_clear()
+
+        saved = total_before - total_after
+        percent = (saved / total_before * 100) if total_before else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Optimized {len(manifest)} images: {total_before:,} -> {total_after:,} bytes ({percent:.1f}% smaller). '
+            f'Manifest: {MANIFEST_PATH}'
+        ))
+        self.stdout.write('Set NEWSLETTER_ASSET_BASE_URL to the public origin serving STATIC_URL to use the hashed files '
+                          'in emails; serve them with a long-lived immutable Cache-Control header.')
@@ -0,0 +1,121 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Runs in a fresh interpreter: loads the WSGI app exactly as the server does,
+# then times the first and second request through it.
+PROBE = r'''
+import json, sys, time
+start = time.perf_counter()
+from newsletterservice.wsgi import application
+loaded = time.perf_counter()
+from django.conf import settings
+from wsgiref.util import setup_testing_defaults
+
+def request(path):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'HTTP_HOST': next((h for h in settings.ALLOWED_HOSTS if '*' not in h), 'localhost')}
+    setup_testing_defaults(environ)
+    status = []
+    began = time.perf_counter()
+    body = application(environ, lambda s, headers, exc_info=None: status.append(s))
+    for _ in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+    return (time.perf_counter() - began) * 1000, status[0]
+
+first, status = request(sys.argv[1])
+second, _ = request(sys.argv[1])
+print(json.dumps({'app_ms': (loaded - start) * 1000, 'first_request_ms': first,
+                  'second_request_ms': second, 'status': status,
+                  'sendgrid_loaded': 'sendgrid' in sys.modules}))
+'''
+
+
+def parse_importtime(output):
+    """Parse `python -X importtime` output into (module, self_us, cumulative_us, depth) tuples."""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+            rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+        except ValueError:
+            continue
+    return rows
+
+
+class Command(BaseCommand):
+    help = ('Report the cold-start cost of the WSGI app (newsletterservice/wsgi.py): import time per module '
+            '(from python -X importtime) and the latency of the first request, measured in fresh interpreters')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/', help='Path requested after the app is loaded')
+        parser.add_argument('--runs', type=int, default=3, help='Fresh processes to measure; medians are reported')
+        parser.add_argument('--top', type=int, default=15, help='Slowest modules to list')
+        parser.add_argument('--budget-ms', type=float,
+                            help='Fail when import + first request takes longer than this (for CI)')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def _run_once(self, path):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'newsletterservice.settings'))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE, path],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        lines = result.stdout.strip().splitlines()
+        if result.returncode or not lines:
+            raise CommandError(f'Startup probe failed:\n{result.stderr[-2000:]}')
+        return json.loads(lines[-1]), parse_importtime(result.stderr)
+
+    def handle(self, *args, **options):
+        runs = [self._run_once(options['path']) for _ in range(max(options['runs'], 1))]
+
+        def median(values):
+            return round(statistics.median(values), 1)
+
+        # Module timings from the median run by total import time
+        imports_ms = [sum(row[2] for row in rows if row[3] == 0) / 1000 for _, rows in runs]
+        probe, rows = sorted(zip(imports_ms, runs), key=lambda item: item[0])[len(runs) // 2][1]
+        report = {
+            'runs': len(runs),
+            'import_ms': median(imports_ms),
+            'app_ms': median([probe['app_ms'] for probe, _ in runs]),
+            'first_request_ms': median([probe['first_request_ms'] for probe, _ in runs]),
+            'second_request_ms': median([probe['second_request_ms'] for probe, _ in runs]),
+            'status': probe['status'],
+            'sendgrid_loaded': probe['sendgrid_loaded'],
+            'modules': len(rows),
+            'slowest': [
+                {'module': name, 'self_ms': round(self_us / 1000, 1), 'cumulative_ms': round(cumulative_us / 1000, 1)}
+                for name, self_us, cumulative_us, depth in sorted(rows, key=lambda row: -row[2])[:options['top']]
+            ],
+        }
+        cold_start_ms = round(report['app_ms'] + report['first_request_ms'], 1)
+        report['cold_start_ms'] = cold_start_ms
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(
+                f"{report['modules']} modules imported; median of {report['runs']} runs:\n"
+                f"  imports (interpreter + app)  {report['import_ms']:8.1f} ms\n"
+                f"  load WSGI app                {report['app_ms']:8.1f} ms\n"
+                f"  first request {options['path']:<14} {report['first_request_ms']:8.1f} ms ({report['status']})\n"
+                f"  second request               {report['second_request_ms']:8.1f} ms\n"
+                f"  cold start (load + first)    {cold_start_ms:8.1f} ms\n"
+                f"  sendgrid imported: {'yes' if report['sendgrid_loaded'] else 'no'}"
+            )
+            self.stdout.write('Slowest imports (cumulative):')
+            for row in report['slowest']:
+                self.stdout.write(f"  {row['cumulative_ms']:8.1f} ms  {row['self_ms']:7.1f} ms self  {row['module']}")
+
+        if options['budget_ms'] is not None and cold_start_ms > options['budget_ms']:
+            raise CommandError(f"Cold start took {cold_start_ms} ms, over the {options['budget_ms']} ms budget")
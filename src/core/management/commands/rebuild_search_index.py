@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.search import SearchUnavailable, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of sent emails and broadcasts'
+
+    def handle(self, *args, **options):
+        try:
+            count = rebuild()
+        except SearchUnavailable as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} documents'))
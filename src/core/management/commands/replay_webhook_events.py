@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from core import webhooks
+from core.providers import HTTPConnectionPool
+from urllib.parse import urlsplit
+import base64
+import json
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = ('Replay recorded provider event webhook payloads (WEBHOOK_EVENTS record_dir files, or JSON '
+            'arrays as posted by SendGrid): write them directly in bulk, or post them to a running '
+            'server with --url. Events already stored are skipped unless --fresh-ids is given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='.json / .jsonl files, optionally gzipped')
+        parser.add_argument('--url', help='POST the payloads here (e.g. http://127.0.0.1:8000/api/webhooks/sendgrid/)')
+        parser.add_argument('--signing-key',
+                            help='PEM EC private key whose public key is the server\'s WEBHOOK_EVENTS public_key; '
+                                 'signs the posted payloads the way SendGrid does')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent requests with --url')
+        parser.add_argument('--batch-size', type=int, help='Events per bulk write (default WEBHOOK_EVENTS flush_size)')
+        parser.add_argument('--repeat', type=int, default=1, help='Replay the payloads this many times')
+        parser.add_argument('--fresh-ids', action='store_true',
+                            help='Give every event a new sg_event_id, so repeated replays are stored (load testing)')
+
+    def _payloads(self, paths, repeat, fresh_ids):
+        for _ in range(repeat):
+            for path in paths:
+                for payload in webhooks.read_payloads(path):
+                    if fresh_ids and isinstance(payload, list):
+                        payload = [dict(item, sg_event_id=uuid.uuid4().hex) if isinstance(item, dict) else item
+                                   for item in payload]
+                    yield payload
+
+    def handle(self, *args, **options):
+        payloads = self._payloads(options['paths'], options['repeat'], options['fresh_ids'])
+        started = time.perf_counter()
+        try:
+            if options['url']:
+                totals = self._post(payloads, options['url'], options['concurrency'],
+                                    self._signer(options['signing_key']))
+            else:
+                totals = self._write(payloads, options['batch_size'] or webhooks.webhook_settings()['flush_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - started
+
+        rate = totals['events'] / elapsed if elapsed else 0
+        self.stdout.write(', '.join(f'{name} {value}' for name, value in totals.items()))
+        self.stdout.write(f'{elapsed:.2f}s, {rate:.0f} events/s')
+
+    def _write(self, payloads, batch_size):
+        totals = {'payloads': 0, 'events': 0, 'rejected': 0, 'stored': 0, 'duplicates': 0,
+                  'suppressed': 0, 'deactivated': 0}
+        pending = []
+
+        def flush():
+            result = webhooks.write_events(pending)
+            for name in ('stored', 'duplicates', 'suppressed', 'deactivated'):
+                totals[name] += result[name]
+            pending.clear()
+
+        for payload in payloads:
+            events, rejected = webhooks.parse_events(payload)
+            totals['payloads'] += 1
+            totals['events'] += len(events)
+            totals['rejected'] += rejected
+            pending.extend(events)
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+        return totals
+
+    def _signer(self, path):
+        if not path:
+            return None
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        with open(path, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+
+        def sign(body):
+            timestamp = str(int(time.time()))
+            signature = key.sign(timestamp.encode('ascii') + body, ec.ECDSA(hashes.SHA256()))
+            return {'X-Twilio-Email-Event-Webhook-Signature': base64.b64encode(signature).decode('ascii'),
+                    'X-Twilio-Email-Event-Webhook-Timestamp': timestamp}
+        return sign
+
+    def _post(self, payloads, url, concurrency, sign=None):
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        pool = HTTPConnectionPool(f'{parts.scheme}://{parts.netloc}', size=concurrency)
+        totals = {'payloads': 0, 'events': 0, 'rejected': 0, 'errors': 0}
+
+        def post(payload):
+            data = json.dumps(payload).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+            if sign is not None:
+                headers.update(sign(data))
+            status, body, _ = pool.request('POST', path, body=data, headers=headers)
+            return status, body
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for status, body in executor.map(post, payloads):
+                    totals['payloads'] += 1
+                    if status != 200:
+                        totals['errors'] += 1
+                        self.stderr.write(f'HTTP {status}: {body[:200].decode("utf-8", "replace")}')
+                        continue
+                    result = json.loads(body)
+                    totals['events'] += result['accepted']
+                    totals['rejected'] += result['rejected']
+        finally:
+            pool.close()
+        return totals
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from core.sharding import ShardWorker
+
+
+class Command(BaseCommand):
+    help = 'Claim and send partitions of sharded broadcasts (run as many as needed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', default=None, help='Lease owner name (defaults to host:pid:random)')
+        parser.add_argument('--lease-seconds', type=int, default=None, help='Lease duration before a partition can be reclaimed')
+        parser.add_argument('--batch-size', type=int, default=None, help='Recipients reserved per cursor advance')
+        parser.add_argument('--once', action='store_true', help='Exit when there is nothing left to claim')
+
+    def handle(self, *args, **options):
+        worker = ShardWorker(
+            owner=options['owner'],
+            lease_seconds=options['lease_seconds'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Broadcast worker {worker.owner} started (lease {worker.lease_seconds}s)'))
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write(f'Broadcast worker {worker.owner} stopped')
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.template import engines
+from django.template.loader import get_template
+from core.assets import image_urls
+from core.template_compiler import compiled_template_names, source_version
+from datetime import datetime
+
+
+SAMPLE_CONTEXT = {
+    'newsletter_title': 'Restless Society Weekly',
+    'newsletter_content': 'Tickets for the next gathering are live. ' * 8,
+    'highlight_text': 'Early bird pricing ends Friday.',
+    'cta_text': 'Get tickets',
+    'cta_url': 'https://restless-society.web.app/events',
+    'event_title': 'Warehouse Night',
+    'event_date': 'Saturday 14 November',
+    'event_time': '22:00',
+    'event_location': 'Lagos',
+    'flyer_images': [],
+    'unsubscribe_url': 'https://restless-society.web.app/unsubscribe?email=someone@example.com',
+}
+
+
+class Command(BaseCommand):
+    help = 'Report the per-message byte savings of the compiled (CSS-inlined, minified) newsletter templates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=10000,
+                            help='Recipient count used to project the savings for one broadcast')
+
+    def handle(self, *args, **options):
+        engine = engines['django']
+        images = image_urls()
+        context = dict(
+            SAMPLE_CONTEXT,
+            year=datetime.now().year,
+            icon2_image=images.get('icon2', ''),
+            qr_code_image=images.get('qr_code', ''),
+            icon_image=images.get('icon', ''),
+            logo_image=images.get('logo', ''),
+            background_image=images.get('header_bg', ''),
+            instagram_icon=images.get('instagram', ''),
+            tiktok_icon=images.get('tiktok', ''),
+            x_icon=images.get('twitter', ''),
+            whatsapp_icon=images.get('whatsapp', ''),
+        )
+
+        recipients = options['recipients']
+        for name in compiled_template_names():
+            compiled = get_template(name)
+            with open(compiled.origin.name, encoding='utf-8') as fh:
+                original = engine.from_string(fh.read())
+            before = len(original.render(context).encode('utf-8'))
+            after = len(compiled.render(context).encode('utf-8'))
+            saved = before - after
+            percent = (saved / before * 100) if before else 0
+            self.stdout.write(
+                f'{name}: {before:,} -> {after:,} bytes per message ({percent:.1f}% smaller, '
+                f'version {source_version(compiled.template.source)}); '
+                f'{saved * recipients / 1024 / 1024:,.1f} MiB saved per {recipients:,} recipients'
+            )
@@ -0,0 +1,177 @@
+"""
+Compression of API traffic.
+
+RequestDecompressionMiddleware inflates gzip / deflate request bodies
+(Content-Encoding) on the endpoints that take large uploads, such as
+broadcasts with tens of thousands of recipients. The inflated size is
+capped, so a small compressed body cannot expand without limit.
+
+ResponseCompressionMiddleware compresses large API responses with brotli
+(when the brotli package is installed and the client accepts it) or gzip.
+Only API paths are compressed, and not the browsable API: those pages carry
+CSRF tokens, and compressing them would expose the tokens to BREACH-style
+attacks. Streaming
+responses (the progress event stream) are passed through untouched.
+"""
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+from io import BytesIO
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_REQUEST_DECOMPRESSION = {
+    'paths': ['/api/broadcast/send/', '/api/subscribers/bulk/', '/api/webhooks/sendgrid/'],
+    'max_bytes': 64 * 1024 * 1024,
+}
+
+DEFAULT_RESPONSE_COMPRESSION = {
+    'path_prefixes': ['/api/'],
+    'min_bytes': 1024,
+    'gzip_level': 6,
+    'brotli_quality': 4,
+    'content_types': ['application/json', 'text/html', 'text/plain'],
+}
+
+
+def _options(name, defaults):
+    options = dict(defaults)
+    options.update(getattr(settings, name, {}) or {})
+    return options
+
+
+class InflateError(ValueError):
+    pass
+
+
+def inflate(data, encoding, max_bytes):
+    """Decompress a gzip or deflate body of at most `max_bytes` inflated.
+    Raises InflateError when it is corrupt or larger."""
+    wbits = 16 + zlib.MAX_WBITS if encoding in ('gzip', 'x-gzip') else zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        inflated = decompressor.decompress(data, max_bytes + 1)
+    except zlib.error as e:
+        raise InflateError(f'Invalid {encoding} body: {e}')
+    if len(inflated) > max_bytes:
+        raise InflateError(f'Request body inflates to more than {max_bytes} bytes')
+    if not decompressor.eof:
+        raise InflateError(f'Truncated {encoding} body')
+    return inflated
+
+
+def gzip_compress(data, level=6):
+    # mtime=0: identical bodies compress to identical bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def brotli_compress(data, quality=4):
+    return brotli.compress(data, quality=quality)
+
+
+def accepted_encodings(header):
+    """Encodings a client accepts ('Accept-Encoding'), q=0 excluded."""
+    accepted = set()
+    for item in header.lower().split(','):
+        name, _, params = item.partition(';')
+        name, params = name.strip(), params.replace(' ', '')
+        quality = 1.0
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if name and quality > 0:
+            accepted.add(name)
+    if '*' in accepted:
+        accepted |= {'br', 'gzip'}
+    return accepted
+
+
+class RequestDecompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = _options('REQUEST_DECOMPRESSION', DEFAULT_REQUEST_DECOMPRESSION)
+        self.paths = set(options['paths'])
+        self.max_bytes = options['max_bytes']
+
+    def __call__(self, request):
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            error = self._inflate(request, encoding)
+            if error is not None:
+                return error
+        return self.get_response(request)
+
+    def _inflate(self, request, encoding):
+        if request.path not in self.paths or encoding not in ('gzip', 'x-gzip', 'deflate'):
+            return JsonResponse({'error': f'Content-Encoding {encoding} is not accepted here'}, status=415)
+        try:
+            body = inflate(request.body, encoding, self.max_bytes)
+        except RequestDataTooBig:
+            return JsonResponse({'error': 'Request body too large'}, status=413)
+        except InflateError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        # The rest of the stack sees a plain body
+        request._body = body
+        request._stream = BytesIO(body)
+        request.META['CONTENT_LENGTH'] = str(len(body))
+        del request.META['HTTP_CONTENT_ENCODING']
+        return None
+
+
+class ResponseCompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = _options('RESPONSE_COMPRESSION', DEFAULT_RESPONSE_COMPRESSION)
+        self.path_prefixes = tuple(options['path_prefixes'])
+        self.min_bytes = options['min_bytes']
+        self.gzip_level = options['gzip_level']
+        self.brotli_quality = options['brotli_quality']
+        self.content_types = set(options['content_types'])
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not request.path.startswith(self.path_prefixes):
+            return response
+        return self.compress(request, response)
+
+    def compress(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        # Varies on Accept-Encoding whether or not this one is compressed
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < self.min_bytes:
+            return response
+        if response.get('Content-Type', '').split(';')[0].strip() not in self.content_types:
+            return response
+        # The browsable API pages carry a CSRF token too
+        if getattr(getattr(response, 'accepted_renderer', None), 'format', None) == 'api':
+            return response
+
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in accepted:
+            encoding, content = 'br', brotli_compress(response.content, self.brotli_quality)
+        elif 'gzip' in accepted:
+            encoding, content = 'gzip', gzip_compress(response.content, self.gzip_level)
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        # The entity changed; a strong ETag would now be wrong
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
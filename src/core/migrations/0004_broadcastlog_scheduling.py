@@ -0,0 +1,37 @@
+# Generated by Django 5.2.11 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_merge_20260204_2051'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='payload',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='send_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='send_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='spread_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='broadcastlog',
+            index=models.Index(fields=['status', 'send_at'], name='core_bcast_status_send_at'),
+        ),
+    ]
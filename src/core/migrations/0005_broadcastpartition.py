@@ -0,0 +1,37 @@
+# Generated by Django 5.2.11 on 2026-10-19 10:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_broadcastlog_scheduling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('recipients', models.TextField()),
+                ('recipients_count', models.IntegerField(default=0)),
+                ('status', models.CharField(default='pending', max_length=20)),
+                ('lease_owner', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('cursor', models.IntegerField(default=0)),
+                ('sent_count', models.IntegerField(default=0)),
+                ('failed_count', models.IntegerField(default=0)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partitions', to='core.broadcastlog')),
+            ],
+            options={
+                'ordering': ['broadcast', 'index'],
+                'indexes': [models.Index(fields=['status', 'lease_expires_at'], name='core_partition_lease')],
+                'constraints': [models.UniqueConstraint(fields=('broadcast', 'index'), name='core_partition_unique_index')],
+            },
+        ),
+    ]
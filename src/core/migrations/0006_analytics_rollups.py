@@ -0,0 +1,47 @@
+# Generated by Django 5.2.11 on 2026-10-19 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_broadcastpartition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('device_id', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(max_length=50)),
+                ('broadcasts', models.IntegerField(default=0)),
+                ('recipients', models.IntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day'],
+                'indexes': [models.Index(fields=['device_id', 'day'], name='core_bcast_stat_device_day')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'device_id', 'status'), name='core_bcast_stat_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubscriberDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('device_id', models.CharField(blank=True, default='', max_length=255)),
+                ('added', models.IntegerField(default=0)),
+                ('reactivated', models.IntegerField(default=0)),
+                ('deactivated', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day'],
+                'indexes': [models.Index(fields=['device_id', 'day'], name='core_sub_stat_device_day')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'device_id'), name='core_sub_stat_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.11 on 2026-10-19 17:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_analytics_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='broadcastlog',
+            index=models.Index(fields=['-created_at', '-id'], name='core_bcast_history'),
+        ),
+        migrations.AddIndex(
+            model_name='broadcastlog',
+            index=models.Index(fields=['device_id', '-created_at', '-id'], name='core_bcast_device_history'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+FTS_TABLE = 'core_search_index'
+
+# Newsletter messages are JSON with "title" and "content"; anything else is plain content
+DOCUMENT_SELECT = """
+    SELECT id * 2 + {offset}, '{kind}', id, COALESCE(device_id, ''), subject,
+        CASE WHEN json_valid(message) AND json_type(message) = 'object'
+            THEN COALESCE(json_extract(message, '$.title'), subject) ELSE subject END,
+        CASE WHEN json_valid(message) AND json_type(message) = 'object'
+            THEN COALESCE(json_extract(message, '$.content'), '') ELSE message END
+    FROM {table}
+"""
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "kind UNINDEXED, object_id UNINDEXED, device_id UNINDEXED, subject, title, content, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        )
+        for offset, kind, table in ((0, 'email', 'core_emails'), (1, 'broadcast', 'core_broadcastlog')):
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, kind, object_id, device_id, subject, title, content) '
+                + DOCUMENT_SELECT.format(offset=offset, kind=kind, table=table)
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_broadcastlog_history_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
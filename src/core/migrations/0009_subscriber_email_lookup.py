@@ -0,0 +1,49 @@
+# Generated by Django 5.2.11 on 2026-10-19 17:27
+
+from django.db import migrations, models
+
+
+def populate_lookup_columns(apps, schema_editor):
+    Subscriber = apps.get_model('core', 'Subscriber')
+    batch = []
+    for subscriber in Subscriber.objects.only('id', 'email').iterator(chunk_size=2000):
+        email = (subscriber.email or '').strip().lower()
+        domain = email.rpartition('@')[2]
+        subscriber.email_normalized = email
+        subscriber.domain_reversed = '.'.join(reversed(domain.split('.'))) if domain else ''
+        batch.append(subscriber)
+        if len(batch) >= 2000:
+            Subscriber.objects.bulk_update(batch, ['email_normalized', 'domain_reversed'])
+            batch = []
+    if batch:
+        Subscriber.objects.bulk_update(batch, ['email_normalized', 'domain_reversed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriber',
+            name='domain_reversed',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='email_normalized',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        # Fill the columns before indexing them
+        migrations.RunPython(populate_lookup_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='subscriber',
+            index=models.Index(fields=['email_normalized'], name='core_sub_email_norm'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriber',
+            index=models.Index(fields=['domain_reversed', 'email_normalized'], name='core_sub_domain'),
+        ),
+    ]
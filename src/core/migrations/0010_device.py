@@ -0,0 +1,139 @@
+"""
+Move device_id strings into a Device table referenced by integer foreign keys.
+
+The string columns are copied into temporary `device_ref` foreign keys, then
+dropped, and the new columns take their place (keeping the `device_id`
+column name). Empty strings become NULL. The full-text index's device column
+is rewritten to the new ids.
+"""
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+DEVICE_MODELS = ('emails', 'subscriber', 'broadcastlog', 'broadcastdailystat', 'subscriberdailystat')
+
+
+def populate_devices(apps, schema_editor):
+    Device = apps.get_model('core', 'Device')
+    keys = set()
+    for model_name in DEVICE_MODELS:
+        model = apps.get_model('core', model_name)
+        keys.update(model.objects.exclude(device_id__isnull=True).exclude(device_id='')
+                    .values_list('device_id', flat=True).distinct())
+    Device.objects.bulk_create([Device(key=key) for key in sorted(keys)], batch_size=500)
+
+    device_ids = Device.objects.filter(key=OuterRef('device_id')).values('pk')[:1]
+    for model_name in DEVICE_MODELS:
+        apps.get_model('core', model_name).objects.exclude(device_id__isnull=True).exclude(device_id='') \
+            .update(device_ref=Subquery(device_ids))
+
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'core_search_index'")
+            if cursor.fetchone():
+                cursor.execute(
+                    "UPDATE core_search_index SET device_id = "
+                    "(SELECT id FROM core_device WHERE core_device.key = core_search_index.device_id) "
+                    "WHERE device_id != ''"
+                )
+
+
+def depopulate_devices(apps, schema_editor):
+    Device = apps.get_model('core', 'Device')
+    device_keys = Device.objects.filter(pk=OuterRef('device_ref')).values('key')[:1]
+    for model_name in DEVICE_MODELS:
+        apps.get_model('core', model_name).objects.exclude(device_ref__isnull=True) \
+            .update(device_id=Subquery(device_keys))
+
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'core_search_index'")
+            if cursor.fetchone():
+                cursor.execute(
+                    "UPDATE core_search_index SET device_id = "
+                    "(SELECT key FROM core_device WHERE core_device.id = core_search_index.device_id) "
+                    "WHERE device_id != ''"
+                )
+
+
+def temporary_fk():
+    return models.ForeignKey(null=True, blank=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+',
+                             to='core.device', db_index=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_subscriber_email_lookup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Device',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        *[migrations.AddField(model_name=model_name, name='device_ref', field=temporary_fk()) for model_name in DEVICE_MODELS],
+        migrations.RunPython(populate_devices, depopulate_devices),
+
+        # Drop everything built on the string columns, then the columns themselves
+        migrations.RemoveIndex(model_name='broadcastlog', name='core_bcast_device_history'),
+        migrations.RemoveConstraint(model_name='broadcastdailystat', name='core_bcast_stat_unique'),
+        migrations.RemoveIndex(model_name='broadcastdailystat', name='core_bcast_stat_device_day'),
+        migrations.RemoveConstraint(model_name='subscriberdailystat', name='core_sub_stat_unique'),
+        migrations.RemoveIndex(model_name='subscriberdailystat', name='core_sub_stat_device_day'),
+        *[migrations.RemoveField(model_name=model_name, name='device_id') for model_name in DEVICE_MODELS],
+        *[migrations.RenameField(model_name=model_name, old_name='device_ref', new_name='device') for model_name in DEVICE_MODELS],
+
+        migrations.AlterField(
+            model_name='emails',
+            name='device',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='emails', to='core.device'),
+        ),
+        migrations.AlterField(
+            model_name='subscriber',
+            name='device',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='subscribers', to='core.device'),
+        ),
+        migrations.AlterField(
+            model_name='broadcastlog',
+            name='device',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='broadcasts', to='core.device'),
+        ),
+        migrations.AlterField(
+            model_name='broadcastdailystat',
+            name='device',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.device'),
+        ),
+        migrations.AlterField(
+            model_name='subscriberdailystat',
+            name='device',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.device'),
+        ),
+
+        migrations.AddIndex(
+            model_name='broadcastlog',
+            index=models.Index(fields=['device', '-created_at', '-id'], name='core_bcast_device_history'),
+        ),
+        migrations.AddConstraint(
+            model_name='broadcastdailystat',
+            constraint=models.UniqueConstraint(fields=('day', 'device', 'status'), name='core_bcast_stat_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='broadcastdailystat',
+            index=models.Index(fields=['device', 'day'], name='core_bcast_stat_device_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscriberdailystat',
+            constraint=models.UniqueConstraint(fields=('day', 'device'), name='core_sub_stat_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriberdailystat',
+            index=models.Index(fields=['device', 'day'], name='core_sub_stat_device_day'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.11 on 2026-10-19 17:41
+
+import core.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_device'),
+    ]
+
+    # The column type does not change; only the Python-side field does, so
+    # skip the table rebuild SQLite would otherwise do.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='broadcastlog',
+                    name='message',
+                    field=core.fields.CompressedTextField(),
+                ),
+                migrations.AlterField(
+                    model_name='emails',
+                    name='message',
+                    field=core.fields.CompressedTextField(max_length=500),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.11 on 2026-10-19 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_compressed_messages'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='broadcastlog',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='core_bcast_status_history'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriber',
+            index=models.Index(fields=['-created_at', '-id'], name='core_sub_created'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriber',
+            index=models.Index(fields=['is_active', '-created_at', '-id'], name='core_sub_active_created'),
+        ),
+    ]
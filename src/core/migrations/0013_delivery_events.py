@@ -0,0 +1,60 @@
+# Generated by Django 5.2.11 on 2026-10-19 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(max_length=254, unique=True)),
+                ('reason', models.CharField(max_length=32)),
+                ('event_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-updated_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='bounced_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='complaint_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='delivered_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='DeliveryEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=100, unique=True)),
+                ('event', models.CharField(max_length=32)),
+                ('email', models.CharField(max_length=254)),
+                ('broadcast_id', models.CharField(blank=True, default='', max_length=255)),
+                ('message_id', models.CharField(blank=True, default='', max_length=255)),
+                ('reason', models.CharField(blank=True, default='', max_length=500)),
+                ('occurred_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-occurred_at'],
+                'indexes': [models.Index(fields=['email', '-occurred_at'], name='core_event_email'), models.Index(fields=['broadcast_id', 'event'], name='core_event_broadcast')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.11 on 2026-10-19 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_delivery_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriber',
+            name='fields',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-19 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_subscriber_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcastlog',
+            name='transport_stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='broadcastpartition',
+            name='transport_stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.11 on 2026-10-19 18:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_broadcast_transport_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastTiming',
+            fields=[
+                ('broadcast', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='timing', serialize=False, to='core.broadcastlog')),
+                ('total_ms', models.FloatField(default=0)),
+                ('validation_ms', models.FloatField(default=0)),
+                ('upsert_ms', models.FloatField(default=0)),
+                ('render_ms', models.FloatField(default=0)),
+                ('queue_ms', models.FloatField(default=0)),
+                ('provider_ms', models.FloatField(default=0)),
+                ('provider_calls', models.IntegerField(default=0)),
+                ('provider_p50_ms', models.FloatField(default=0)),
+                ('provider_p99_ms', models.FloatField(default=0)),
+                ('delivery_ms', models.FloatField(default=0)),
+                ('bookkeeping_ms', models.FloatField(default=0)),
+                ('request_state', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='broadcastpartition',
+            name='timing',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
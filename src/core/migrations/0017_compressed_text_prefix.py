@@ -0,0 +1,29 @@
+from django.db import migrations
+
+import core.fields
+
+
+def move_to_marked_prefix(apps, schema_editor):
+    # Rows compressed under the old 'zlib:' prefix, told apart from plain text
+    # that merely starts with it by decoding them
+    for name in ('Emails', 'BroadcastLog'):
+        model = apps.get_model('core', name)
+        rows = model.objects.filter(message__startswith=core.fields.LEGACY_PREFIX).values_list('id', 'message')
+        for pk, message in rows.iterator(chunk_size=500):
+            try:
+                core.fields.inflate(message[len(core.fields.LEGACY_PREFIX):])
+            except ValueError:
+                continue
+            model.objects.filter(id=pk).update(message=core.fields.CompressedText(
+                core.fields.MARKER + message))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_broadcast_timing'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_to_marked_prefix, migrations.RunPython.noop),
+    ]
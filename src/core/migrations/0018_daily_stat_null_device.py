@@ -0,0 +1,43 @@
+# Generated by Django 5.2.11 on 2026-10-19 18:41
+
+from django.db import migrations, models
+
+
+def merge_null_device_rows(apps, schema_editor):
+    # Rows without a device were duplicated by concurrent increments; fold
+    # each group into its first row before it becomes unique
+    for name, keys, counters in (
+        ('BroadcastDailyStat', ('day', 'status'), ('broadcasts', 'recipients', 'sent', 'failed')),
+        ('SubscriberDailyStat', ('day',), ('added', 'reactivated', 'deactivated')),
+    ):
+        model = apps.get_model('core', name)
+        kept = {}
+        for row in model.objects.filter(device__isnull=True).order_by('id'):
+            key = tuple(getattr(row, field) for field in keys)
+            if key not in kept:
+                kept[key] = row
+                continue
+            first = kept[key]
+            for counter in counters:
+                setattr(first, counter, getattr(first, counter) + getattr(row, counter))
+            first.save(update_fields=counters)
+            row.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_compressed_text_prefix'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_null_device_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='broadcastdailystat',
+            constraint=models.UniqueConstraint(condition=models.Q(('device__isnull', True)), fields=('day', 'status'), name='core_bcast_stat_unique_nodev'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscriberdailystat',
+            constraint=models.UniqueConstraint(condition=models.Q(('device__isnull', True)), fields=('day',), name='core_sub_stat_unique_nodev'),
+        ),
+    ]
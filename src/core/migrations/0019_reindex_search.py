@@ -0,0 +1,23 @@
+from django.db import migrations
+
+import core.search
+
+
+def reindex(apps, schema_editor):
+    # 0008 filled the index in SQL with the raw message HTML; re-index every
+    # row the way the signals do (tags stripped)
+    if not core.search.fts_available(schema_editor.connection):
+        return
+    kinds = {'email': apps.get_model('core', 'Emails'), 'broadcast': apps.get_model('core', 'BroadcastLog')}
+    core.search.rebuild(kinds, using=schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_daily_stat_null_device'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def clear_payloads(apps, schema_editor):
+    # Finished broadcasts kept their payload, recipient list included
+    BroadcastLog = apps.get_model('core', 'BroadcastLog')
+    BroadcastLog.objects.exclude(status__in=('scheduled', 'pending')).exclude(payload='').update(payload='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_reindex_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_payloads, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,21 @@
 from django.db import models  
+from django.db.models import Q
+from .fields import CompressedTextField
+
+
+class Device(models.Model):
+    """A client identified by its X-Device-ID header (see core.devices)."""
+    key = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
 
 class Emails(models.Model):
-    device_id = models.CharField(max_length=255,null=True, blank=True) 
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.SET_NULL, related_name='emails')
     subject = models.CharField(max_length=500)
-    message = models.TextField(max_length=500)
+    message = CompressedTextField(max_length=500)
     email = models.EmailField()
     created_at = models.DateTimeField(auto_now_add=True,blank=True, null=True)
     edited_at = models.DateTimeField(auto_now=True)
@@ -12,37 +24,278 @@ class Emails(models.Model):
         return self.subject[:50]
 
 
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def reversed_domain(email):
+    """'Ann@Mail.Example.com' -> 'com.example.mail', so a domain and all of its
+    subdomains form one contiguous index range."""
+    domain = normalize_email(email).rpartition('@')[2]
+    return '.'.join(reversed(domain.split('.'))) if domain else ''
+
+
+def domain_q(domain):
+    """Subscribers at `domain` or one of its subdomains, as a single range of
+    core_sub_domain ('/' sorts right after '.'; 'com.example-x' falls in the
+    range too and is filtered out row by row)."""
+    reversed_name = '.'.join(reversed(normalize_email(domain).lstrip('@').strip('.').split('.')))
+    return (Q(domain_reversed__gte=reversed_name, domain_reversed__lt=reversed_name + '/')
+            & (Q(domain_reversed=reversed_name) | Q(domain_reversed__startswith=reversed_name + '.')))
+
+
+class SubscriberQuerySet(models.QuerySet):
+    """Keeps the lookup columns derived from `email` in step on the writes
+    that bypass Subscriber.save()."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for subscriber in objs:
+            subscriber.normalize()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        fields = list(fields)
+        if 'email' in fields:
+            objs = list(objs)
+            for subscriber in objs:
+                subscriber.normalize()
+            fields += [name for name in ('email_normalized', 'domain_reversed') if name not in fields]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def update(self, **kwargs):
+        # bulk_update() passes all three, as expressions
+        if 'email' in kwargs and not {'email_normalized', 'domain_reversed'} <= kwargs.keys():
+            if not isinstance(kwargs['email'], str):
+                raise TypeError('Subscriber emails can only be updated to a plain value')
+            kwargs.setdefault('email_normalized', normalize_email(kwargs['email']))
+            kwargs.setdefault('domain_reversed', reversed_domain(kwargs['email']))
+        return super().update(**kwargs)
+
+
 class Subscriber(models.Model):
-    device_id = models.CharField(max_length=255, null=True, blank=True)
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.SET_NULL, related_name='subscribers')
     email = models.EmailField(unique=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Lookup columns derived from `email` on save and on bulk writes (SubscriberQuerySet)
+    email_normalized = models.CharField(max_length=254, blank=True, default='')
+    domain_reversed = models.CharField(max_length=254, blank=True, default='')
+    # Merge fields for personalised broadcasts, e.g. {"first_name": "Ann"} (core.personalize)
+    fields = models.JSONField(default=dict, blank=True)
+
+    objects = SubscriberQuerySet.as_manager()
 
     def __str__(self):
         return self.email
 
+    def normalize(self):
+        self.email_normalized = normalize_email(self.email)
+        self.domain_reversed = reversed_domain(self.email)
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'email_normalized', 'domain_reversed'}
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['email_normalized'], name='core_sub_email_norm'),
+            models.Index(fields=['domain_reversed', 'email_normalized'], name='core_sub_domain'),
+            # Admin changelist: newest first, optionally filtered by is_active
+            models.Index(fields=['-created_at', '-id'], name='core_sub_created'),
+            models.Index(fields=['is_active', '-created_at', '-id'], name='core_sub_active_created'),
+        ]
 
 
 class BroadcastLog(models.Model):
-    device_id = models.CharField(max_length=255, null=True, blank=True)
+    # Indexed by core_bcast_device_history
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.SET_NULL, related_name='broadcasts',
+                               db_index=False)
     broadcast_id = models.CharField(max_length=255, unique=True)
     subject = models.CharField(max_length=500)
-    message = models.TextField()
+    message = CompressedTextField()
     sender_email = models.EmailField(blank=True, null=True)
     sender_name = models.CharField(max_length=255, blank=True, null=True)
     recipients_count = models.IntegerField(default=0)
     sent_count = models.IntegerField(default=0)
     failed_count = models.IntegerField(default=0)
-    status = models.CharField(max_length=50, default='pending')  # pending, sent, failed, partial
+    status = models.CharField(max_length=50, default='pending')  # scheduled, pending, sent, failed, partial
     created_at = models.DateTimeField(auto_now_add=True)
+    # Scheduling: when to start sending and how to pace the sends
+    send_at = models.DateTimeField(null=True, blank=True)
+    spread_seconds = models.IntegerField(default=0)
+    send_rate = models.FloatField(null=True, blank=True)  # messages per second
+    payload = models.TextField(blank=True, default='')  # request data replayed by the dispatcher; cleared when done
+    # Provider events received for this broadcast (core.webhooks)
+    delivered_count = models.IntegerField(default=0)
+    bounced_count = models.IntegerField(default=0)
+    complaint_count = models.IntegerField(default=0)
+    # Per-transport sent / failed / throttled / errors / failovers and rate (core.transports)
+    transport_stats = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.subject[:50]} - {self.broadcast_id}"
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'send_at'], name='core_bcast_status_send_at'),
+            # Keyset pagination of the history, newest first
+            models.Index(fields=['-created_at', '-id'], name='core_bcast_history'),
+            models.Index(fields=['device', '-created_at', '-id'], name='core_bcast_device_history'),
+            # Admin changelist filtered by status
+            models.Index(fields=['status', '-created_at', '-id'], name='core_bcast_status_history'),
+        ]
     
 
+
+
+class BroadcastPartition(models.Model):
+    """A slice of a broadcast's recipients, claimed by one worker at a time
+    through a lease that must be renewed (heartbeat) before it expires."""
+    broadcast = models.ForeignKey(BroadcastLog, on_delete=models.CASCADE, related_name='partitions')
+    index = models.IntegerField()
+    recipients = models.TextField()  # JSON list of emails
+    recipients_count = models.IntegerField(default=0)
+    status = models.CharField(max_length=20, default='pending')  # pending, claimed, done, failed
+    lease_owner = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    # Recipients before `cursor` have been handed to a worker; never resent
+    cursor = models.IntegerField(default=0)
+    sent_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    transport_stats = models.JSONField(default=dict, blank=True)
+    # Phase timer state of the attempts at this partition (core.timing)
+    timing = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.broadcast_id} #{self.index} ({self.status})"
+
+    class Meta:
+        ordering = ['broadcast', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'index'], name='core_partition_unique_index'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at'], name='core_partition_lease'),
+        ]
+
+
+class BroadcastTiming(models.Model):
+    """Time a broadcast spent in each phase of the send pipeline, in
+    milliseconds (core.timing)."""
+    broadcast = models.OneToOneField(BroadcastLog, on_delete=models.CASCADE, primary_key=True, related_name='timing')
+    total_ms = models.FloatField(default=0)
+    validation_ms = models.FloatField(default=0)
+    upsert_ms = models.FloatField(default=0)
+    render_ms = models.FloatField(default=0)
+    queue_ms = models.FloatField(default=0)
+    provider_ms = models.FloatField(default=0)
+    provider_calls = models.IntegerField(default=0)
+    provider_p50_ms = models.FloatField(default=0)
+    provider_p99_ms = models.FloatField(default=0)
+    delivery_ms = models.FloatField(default=0)
+    bookkeeping_ms = models.FloatField(default=0)
+    # Timer state of the send request of a sharded broadcast, merged with its partitions'
+    request_state = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.broadcast_id} ({self.total_ms:.0f} ms)"
+
+
+class BroadcastDailyStat(models.Model):
+    """Finished broadcasts per day, device and final status, maintained
+    incrementally (see core.analytics)."""
+    day = models.DateField()
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    status = models.CharField(max_length=50)
+    broadcasts = models.IntegerField(default=0)
+    recipients = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day} {self.device_id or '-'} {self.status}: {self.broadcasts}"
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'device', 'status'], name='core_bcast_stat_unique'),
+            # NULLs are distinct in the constraint above: one row per day and status without a device
+            models.UniqueConstraint(fields=['day', 'status'], condition=Q(device__isnull=True),
+                                    name='core_bcast_stat_unique_nodev'),
+        ]
+        indexes = [
+            models.Index(fields=['device', 'day'], name='core_bcast_stat_device_day'),
+        ]
+
+
+class SubscriberDailyStat(models.Model):
+    """Subscriber changes per day and device, maintained incrementally."""
+    day = models.DateField()
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    added = models.IntegerField(default=0)
+    reactivated = models.IntegerField(default=0)
+    deactivated = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day} {self.device_id or '-'}: +{self.added} ~{self.reactivated} -{self.deactivated}"
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'device'], name='core_sub_stat_unique'),
+            models.UniqueConstraint(fields=['day'], condition=Q(device__isnull=True), name='core_sub_stat_unique_nodev'),
+        ]
+        indexes = [
+            models.Index(fields=['device', 'day'], name='core_sub_stat_device_day'),
+        ]
+
+
+class DeliveryEvent(models.Model):
+    """One provider event (delivered, bounce, open, ...) from the event
+    webhook, written in bulk by core.webhooks."""
+    # sg_event_id, or a hash of the event when the provider sends none
+    event_id = models.CharField(max_length=100, unique=True)
+    event = models.CharField(max_length=32)
+    email = models.CharField(max_length=254)  # normalised
+    broadcast_id = models.CharField(max_length=255, blank=True, default='')
+    message_id = models.CharField(max_length=255, blank=True, default='')
+    reason = models.CharField(max_length=500, blank=True, default='')
+    occurred_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.event} {self.email}"
+
+    class Meta:
+        ordering = ['-occurred_at']
+        indexes = [
+            models.Index(fields=['email', '-occurred_at'], name='core_event_email'),
+            models.Index(fields=['broadcast_id', 'event'], name='core_event_broadcast'),
+        ]
+
+
+class Suppression(models.Model):
+    """An address that must not be sent to any more: it hard-bounced, reported
+    spam or unsubscribed at the provider. Broadcasts skip these recipients;
+    delete the row to lift the suppression."""
+    email = models.CharField(max_length=254, unique=True)  # normalised
+    reason = models.CharField(max_length=32)  # bounce, spamreport, unsubscribe
+    event_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.reason})"
+
+    class Meta:
+        ordering = ['-updated_at']
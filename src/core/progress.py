@@ -0,0 +1,194 @@
+"""
+Live broadcast progress.
+
+Senders keep their counters in memory and publish a small snapshot to the
+cache every `BROADCAST_PROGRESS_EVERY` recipients (and when they finish), so
+progress costs no database writes per message. Watchers, both the polling
+endpoint and the Server-Sent Events stream, only ever read that snapshot;
+the database is consulted once, on a cache miss, and the answer is cached.
+
+Sharded broadcasts publish from `sharding.rollup`, which already aggregates
+every partition after each batch.
+
+An SSE stream occupies the thread (or sync worker) that serves it for as
+long as it is open. Serve it from threaded or async workers (e.g. gunicorn
+--threads / gevent, or ASGI); even so, each process holds at most
+`BROADCAST_PROGRESS_STREAM_MAX` streams open (further watchers get a 503 and
+poll instead), and a stream ends after `BROADCAST_PROGRESS_STREAM_TIMEOUT`
+seconds. EventSource clients then reconnect by themselves, and their
+Last-Event-ID keeps the snapshot they already have from being sent again.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+import os
+import threading
+import time
+
+FINAL_STATUSES = ('sent', 'failed', 'partial')
+
+# How long a miss-filled snapshot of a broadcast that is not finished is trusted
+_FALLBACK_TTL = 5
+
+
+def _key(broadcast_id):
+    return f'broadcast-progress:{broadcast_id}'
+
+
+def _ttl():
+    return getattr(settings, 'BROADCAST_PROGRESS_TTL', 3600)
+
+
+def get_progress(broadcast_id):
+    return cache.get(_key(broadcast_id))
+
+
+def publish(broadcast_id, total, sent, failed, status='pending', previous=None):
+    """Store a progress snapshot and return it.
+
+    The rate is smoothed over the previous snapshot, read from the cache
+    unless the caller passes the one it published last (or {} to start over).
+    """
+    now = time.time()
+    if previous is None:
+        previous = get_progress(broadcast_id)
+    done = sent + failed
+    remaining = max(total - done, 0)
+
+    started = (previous.get('started') if previous else None) or now
+    rate = None
+    if previous and previous['timestamp'] and now > previous['timestamp']:
+        instant = max(done - previous['done'], 0) / (now - previous['timestamp'])
+        rate = instant if previous['rate'] is None else 0.5 * instant + 0.5 * previous['rate']
+    elif done and now > started:
+        rate = done / (now - started)
+
+    snapshot = {
+        'broadcast_id': broadcast_id,
+        'status': status,
+        'total': total,
+        'sent': sent,
+        'failed': failed,
+        'done': done,
+        'remaining': remaining,
+        'rate': round(rate, 2) if rate is not None else None,
+        'eta_seconds': round(remaining / rate, 1) if rate else (0 if not remaining else None),
+        'started': started,
+        'timestamp': now,
+        'updated_at': timezone.now().isoformat(),
+        'version': previous['version'] + 1 if previous else 1,
+    }
+    cache.set(_key(broadcast_id), snapshot, _ttl())
+    return snapshot
+
+
+def snapshot_from_log(broadcast_log):
+    """Progress as recorded in the database, cached briefly (or for the full
+    TTL once the broadcast is finished)."""
+    done = broadcast_log.sent_count + broadcast_log.failed_count
+    remaining = max(broadcast_log.recipients_count - done, 0)
+    snapshot = {
+        'broadcast_id': broadcast_log.broadcast_id,
+        'status': broadcast_log.status,
+        'total': broadcast_log.recipients_count,
+        'sent': broadcast_log.sent_count,
+        'failed': broadcast_log.failed_count,
+        'done': done,
+        'remaining': remaining,
+        'rate': None,
+        'eta_seconds': 0 if not remaining else None,
+        'started': None,
+        'timestamp': 0,
+        'updated_at': broadcast_log.created_at.isoformat(),
+        'version': 0,
+    }
+    ttl = _ttl() if broadcast_log.status in FINAL_STATUSES else _FALLBACK_TTL
+    # add() so a sender that is already publishing is never overwritten
+    cache.add(_key(broadcast_log.broadcast_id), snapshot, ttl)
+    return snapshot
+
+
+class ProgressTracker:
+    """Counts the outcome of every send and publishes every `every` recipients.
+
+    Thread-safe, so it can be shared by the workers of a transport pool.
+    """
+
+    def __init__(self, broadcast_id, total, every=None):
+        self.broadcast_id = broadcast_id
+        self.total = total
+        self.every = every or getattr(settings, 'BROADCAST_PROGRESS_EVERY', 25)
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._last = publish(broadcast_id, total, 0, 0, status='pending', previous={})
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+            if (self.sent + self.failed) % self.every == 0:
+                self._publish('pending')
+
+    def finish(self, status):
+        with self._lock:
+            self._publish(status)
+
+    def _publish(self, status):
+        self._last = publish(self.broadcast_id, self.total, self.sent, self.failed, status, previous=self._last)
+
+
+# Streams -------------------------------------------------------------------
+
+_streams = 0
+_streams_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Streams of the parent are not served by the child
+    global _streams, _streams_lock
+    _streams = 0
+    _streams_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def open_stream():
+    """Take one of the process's stream slots; False when all are in use."""
+    global _streams
+    with _streams_lock:
+        if _streams >= getattr(settings, 'BROADCAST_PROGRESS_STREAM_MAX', 4):
+            return False
+        _streams += 1
+        return True
+
+
+def close_stream():
+    global _streams
+    with _streams_lock:
+        _streams = max(_streams - 1, 0)
+
+
+class StreamSlot:
+    """Iterates `events` and frees the stream slot when the response is
+    closed, whether or not the stream was ever started."""
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.events)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.events.close()
+            close_stream()
@@ -0,0 +1,314 @@
+"""
+Email provider clients.
+
+Importing the `sendgrid` package (and the python_http_client / helpers stack
+behind it) is a noticeable part of a worker's cold start, and most requests
+never send mail. Callers ask for the client classes here when they actually
+need them; the import happens once per process. Long-lived workers can set
+PRELOAD_PROVIDER_CLIENTS to pay the cost at boot instead of on the first send
+(see CoreConfig.ready).
+
+SendGridAPIClient opens a new connection (and TLS handshake) for every
+request. `provider_client('sendgrid')` instead returns one client per process
+that sends through a pool of keep-alive connections to the API host
+(settings.SENDGRID_API_HOST). The pool is dropped in forked children so that
+pre-fork servers never share sockets between processes.
+"""
+from django.conf import settings
+from importlib.util import find_spec
+from urllib.parse import urlsplit
+import http.client
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_sendgrid = None
+_clients = {}
+_clients_pid = os.getpid()
+
+
+def sendgrid_installed():
+    """Whether the sendgrid package can be imported, without importing it."""
+    return _sendgrid is not None or find_spec('sendgrid') is not None
+
+
+def load_sendgrid():
+    """Return (SendGridAPIClient, Mail, CustomArg), importing them on first use.
+    Raises ImportError when the package is not installed."""
+    global _sendgrid
+    if _sendgrid is None:
+        with _lock:
+            if _sendgrid is None:
+                from sendgrid import SendGridAPIClient
+                from sendgrid.helpers.mail import CustomArg, Mail
+                _sendgrid = (SendGridAPIClient, Mail, CustomArg)
+    return _sendgrid
+
+
+def preload():
+    """Import every installed provider client now."""
+    if sendgrid_installed():
+        load_sendgrid()
+
+
+# Keep-alive connection pool ------------------------------------------------
+
+class ProviderError(Exception):
+    """The provider answered with an error status."""
+
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class RequestNotSent(ConnectionError):
+    """A request failed before any byte of it was written: the provider
+    never saw it, so it may safely be sent again, elsewhere or later."""
+
+
+class ProviderResponse:
+    """Same attributes as python_http_client's Response."""
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+
+# Errors that mean a reused keep-alive connection was closed by the server
+_STALE_ERRORS = (http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+
+class _TrackedSend:
+    """Notes whether any part of the current request went out."""
+
+    sent = False
+
+    def send(self, data):
+        if self.sock is None and self.auto_open:
+            self.connect()
+        # Set before writing: a write that fails halfway may still have
+        # delivered part of the request
+        self.sent = True
+        super().send(data)
+
+
+class _HTTPConnection(_TrackedSend, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TrackedSend, http.client.HTTPSConnection):
+    pass
+
+
+def _dropped(conn):
+    """Whether an idle connection's socket was closed by the server: it is
+    readable (EOF, or bytes nobody asked for) while no request is out."""
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class HTTPConnectionPool:
+    """Up to `size` persistent connections to one origin, shared by threads.
+
+    Idle connections are reused most-recently-used first, so a quiet process
+    lets surplus connections age out (`idle_timeout`) instead of keeping
+    every one of them half alive. Idle connections the server has closed are
+    discarded before use, and a request is retried on a fresh connection only
+    when its reused one failed before any byte of it was written: past that
+    point the provider may have acted on it (a POST would send twice), so the
+    error is raised. Any other failure before that point (e.g. a refused
+    connect) is raised as RequestNotSent.
+    """
+
+    def __init__(self, base_url, size=10, timeout=30, idle_timeout=60):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'connects': 0, 'reused': 0, 'reconnects': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({'origin': f'{self.scheme}://{self.host}' + (f':{self.port}' if self.port else ''),
+                      'size': self.size, 'idle': self._idle.qsize()})
+        return stats
+
+    def _connect(self):
+        self._count('connects')
+        cls = _HTTPSConnection if self.scheme == 'https' else _HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _checkout(self):
+        """An idle connection that is still fresh, or None."""
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            if time.monotonic() - last_used < self.idle_timeout and not _dropped(conn):
+                return conn
+            conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.sent = False
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read(), dict(response.getheaders()), response.will_close
+
+    def request(self, method, path, body=None, headers=None):
+        """Send one request; returns (status, body bytes, headers)."""
+        headers = dict(headers or {}, Connection='keep-alive')
+        self._slots.acquire()
+        try:
+            self._count('requests')
+            conn = self._checkout()
+            if conn is not None:
+                self._count('reused')
+                try:
+                    status, data, response_headers, will_close = self._send(conn, method, path, body, headers)
+                except _STALE_ERRORS as e:
+                    conn.close()
+                    if conn.sent:
+                        self._count('errors')
+                        raise
+                    logger.debug(f'Keep-alive connection to {self.host} was closed ({e!r}), reconnecting')
+                    self._count('reconnects')
+                    conn = None
+                except Exception as e:
+                    conn.close()
+                    self._count('errors')
+                    if not conn.sent:
+                        raise RequestNotSent(f'Request to {self.host} not sent: {e!r}') from e
+                    raise
+            if conn is None:
+                conn = self._connect()
+                try:
+                    status, data, response_headers, will_close = self._send(conn, method, path, body, headers)
+                except Exception as e:
+                    conn.close()
+                    self._count('errors')
+                    if not conn.sent:
+                        raise RequestNotSent(f'Request to {self.host} not sent: {e!r}') from e
+                    raise
+            if will_close:
+                conn.close()
+            else:
+                self._idle.put((conn, time.monotonic()))
+            return status, data, response_headers
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+class SendGridClient:
+    """Drop-in for SendGridAPIClient.send() over a shared connection pool."""
+
+    name = 'sendgrid'
+
+    def __init__(self, api_key, host, **pool_options):
+        self.api_key = api_key
+        self.pool = HTTPConnectionPool(host, **pool_options)
+        self._path_prefix = urlsplit(host).path.rstrip('/')
+
+    def send(self, message):
+        body = message if isinstance(message, dict) else message.get()
+        status, data, headers = self.pool.request(
+            'POST', f'{self._path_prefix}/v3/mail/send',
+            body=json.dumps(body).encode('utf-8'),
+            headers={'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json',
+                     'Accept': 'application/json', 'User-Agent': 'newsletterservice'},
+        )
+        if status >= 400:
+            raise ProviderError(f'SendGrid returned HTTP {status}', status, data)
+        return ProviderResponse(status, data, headers)
+
+    @property
+    def stats(self):
+        return self.pool.stats
+
+    def close(self):
+        self.pool.close()
+
+
+def _create_client(name, api_key=None, host=None):
+    options = getattr(settings, 'PROVIDER_HTTP_POOL', {})
+    if name == 'sendgrid' or api_key is not None:
+        return SendGridClient(
+            api_key if api_key is not None else getattr(settings, 'SENDGRID_API_KEY', ''),
+            host or getattr(settings, 'SENDGRID_API_HOST', 'https://api.sendgrid.com'),
+            size=options.get('size', 10),
+            timeout=options.get('timeout', 30),
+            idle_timeout=options.get('idle_timeout', 60),
+        )
+    raise ValueError(f'Unknown provider: {name}')
+
+
+def _reset_after_fork():
+    # The child must not use (or close) connections it shares with its parent
+    global _lock, _clients, _clients_pid
+    _lock = threading.Lock()
+    _clients = {}
+    _clients_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def provider_client(name='sendgrid', api_key=None, host=None):
+    """The process-wide client for provider `name`. Further SendGrid
+    accounts (settings.BROADCAST_TRANSPORTS) are named clients created with
+    their own `api_key` and optional `host`."""
+    if _clients_pid != os.getpid():
+        _reset_after_fork()
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = _create_client(name, api_key, host)
+    return client
+
+
+def pool_stats():
+    """Connection pool statistics of the clients created in this process."""
+    return {'pid': os.getpid(), 'providers': {name: client.stats for name, client in list(_clients.items())}}
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
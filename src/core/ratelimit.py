@@ -0,0 +1,147 @@
+"""
+Token-bucket rate limiting for outbound provider calls.
+
+The bucket state lives in a tiny SQLite file so that every gunicorn worker,
+dispatcher and shard worker on the host draws from the same budget. Each
+acquire is a single `BEGIN IMMEDIATE` transaction that refills the bucket from
+the elapsed time and takes tokens, so concurrent processes never overspend.
+
+Priorities get allowances through a reserve: a priority with reserve 0.2 may
+only take tokens while more than 20% of the burst is left, which keeps that
+share available for transactional sends during a bulk broadcast. The reserve
+never holds back so much that a full bucket could not serve the call, so a
+small burst (e.g. rate 1, burst 1) slows bulk sends down but never stops them.
+"""
+from django.conf import settings
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT = {
+    'rate': 0,  # tokens per second; 0 disables limiting
+    'burst': None,  # defaults to one second worth of tokens
+    'reserve': {'transactional': 0.0, 'bulk': 0.2},
+    'timeout': {'transactional': 10, 'bulk': 300},
+    'path': os.path.join(tempfile.gettempdir(), 'newsletterservice-ratelimit.sqlite3'),
+}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no token became available within the allowed wait."""
+
+
+class TokenBucket:
+    """A named token bucket backed by a shared SQLite file."""
+
+    def __init__(self, name, rate, burst=None, reserve=None, path=None, clock=time.time):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst or max(self.rate, 1.0))
+        self.reserve = reserve or {}
+        self.path = str(path or DEFAULT_RATE_LIMIT['path'])
+        self._clock = clock
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections are per thread and must not survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def floor(self, priority, tokens=1):
+        """Tokens that must stay in the bucket for `priority` to draw `tokens`
+        from it; at most what a full bucket leaves after them."""
+        return max(min(self.burst * float(self.reserve.get(priority, 0.0)), self.burst - tokens), 0.0)
+
+    def try_acquire(self, tokens=1, priority='bulk'):
+        """Take `tokens` if available. Returns 0 on success, otherwise the
+        number of seconds after which a retry can succeed.
+        """
+        conn = self._connection()
+        now = self._clock()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            if row is None:
+                available = self.burst
+            else:
+                available = min(self.burst, row[0] + max(now - row[1], 0) * self.rate)
+
+            needed = self.floor(priority, tokens) + tokens
+            if available >= needed:
+                available -= tokens
+                wait = 0.0
+            else:
+                wait = (needed - available) / self.rate
+            conn.execute(
+                'INSERT INTO buckets (name, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (self.name, available, now),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def acquire(self, tokens=1, priority='bulk', timeout=None):
+        """Block until `tokens` are taken; raise RateLimitTimeout after `timeout` seconds."""
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            wait = self.try_acquire(tokens, priority)
+            if wait <= 0:
+                return
+            if deadline is not None and self._clock() + wait > deadline:
+                raise RateLimitTimeout(f'Rate limit "{self.name}" exhausted for {priority} sends')
+            time.sleep(wait)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def _rate_limit_settings():
+    config = dict(DEFAULT_RATE_LIMIT)
+    config.update(getattr(settings, 'PROVIDER_RATE_LIMIT', {}) or {})
+    return config
+
+
+def provider_limiter():
+    """Return the process-wide limiter for provider calls (None if disabled)."""
+    global _limiter
+    config = _rate_limit_settings()
+    if not config['rate']:
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = TokenBucket(
+                    'provider',
+                    rate=config['rate'],
+                    burst=config['burst'],
+                    reserve=config['reserve'],
+                    path=config['path'],
+                )
+    return _limiter
+
+
+def acquire_provider_token(priority='bulk'):
+    """Wait for permission to make one outbound provider call."""
+    limiter = provider_limiter()
+    if limiter is None:
+        return
+    timeout = _rate_limit_settings()['timeout'].get(priority)
+    limiter.acquire(1, priority=priority, timeout=timeout)
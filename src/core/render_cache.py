@@ -0,0 +1,152 @@
+"""
+Content-addressed cache of rendered newsletters.
+
+The same newsletter is typically rendered several times: preview, a test
+send, the broadcast itself (once per partition batch when sharded) and a
+re-send to late signups. Renders are keyed by a hash of the template name,
+the template version (hash of its compiled source, so editing a template
+never serves stale HTML) and the normalised context, and kept in a
+per-process LRU bounded both by entry count and by total size.
+
+Preview renders are reachable by their key for as long as they stay cached
+(GET /broadcast/preview/<key>/).
+"""
+from collections import OrderedDict
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.html import strip_tags
+from .template_compiler import source_version
+import hashlib
+import json
+import threading
+import unicodedata
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+def _normalise(value):
+    """Strip and NFC-normalise strings (recursively) so equivalent content
+    hashes the same."""
+    if isinstance(value, str):
+        return unicodedata.normalize('NFC', value.replace('\r\n', '\n')).strip()
+    if isinstance(value, dict):
+        return {str(key): _normalise(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalise(item) for item in value]
+    return value
+
+
+def template_version(template):
+    return source_version(template.template.source)
+
+
+def render_key(template_name, version, context):
+    payload = json.dumps(
+        {'template': template_name, 'version': version, 'context': _normalise(context)},
+        sort_keys=True, default=str, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Thread-safe LRU of rendered (html, text) pairs."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> render dict
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, key):
+        """Like get() without touching the LRU order or the statistics."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, entry):
+        size = entry['size']
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)['size']
+            # An entry larger than the whole budget is never cached
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted['size']
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                options = getattr(settings, 'NEWSLETTER_RENDER_CACHE', {})
+                _cache = RenderCache(options.get('max_entries', DEFAULT_MAX_ENTRIES),
+                                     options.get('max_bytes', DEFAULT_MAX_BYTES))
+    return _cache
+
+
+def render_newsletter(template_name, context):
+    """Render `template_name` with `context`, or return the cached render.
+
+    Returns a dict with 'key', 'template', 'version', 'html', 'text' (the
+    html with tags stripped), 'size' and 'cached' (whether it was a hit).
+    """
+    template = get_template(template_name)
+    version = template_version(template)
+    key = render_key(template_name, version, context)
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        return dict(entry, cached=True)
+
+    html = template.render(context)
+    text = strip_tags(html)
+    entry = {
+        'key': key,
+        'template': template_name,
+        'version': version,
+        'html': html,
+        'text': text,
+        'size': len(html.encode('utf-8')) + len(text.encode('utf-8')),
+    }
+    cache.put(key, entry)
+    return dict(entry, cached=False)
+
+
+def cached_render(key):
+    """A previously rendered newsletter by key, or None if it was evicted."""
+    entry = get_cache().peek(key)
+    return dict(entry, cached=True) if entry is not None else None
@@ -0,0 +1,193 @@
+"""
+Retention and compaction of old broadcast data.
+
+`manage.py apply_retention` runs, in order:
+
+1. compress: message bodies of Emails / BroadcastLog rows older than
+   `compress_after_days` are stored zlib-compressed (see core.fields; reads
+   stay transparent);
+2. partitions: BroadcastPartition rows (recipient lists) of finished
+   broadcasts of that age are deleted, their counts live on the BroadcastLog;
+3. prune: rows older than `prune_after_days` are written to a gzipped JSON
+   lines archive (unless disabled) and deleted;
+4. vacuum: free pages are returned to the filesystem with
+   `PRAGMA incremental_vacuum`.
+
+Everything runs in small batches, each in its own transaction, so the web
+process is never locked out for long. Daily analytics rollups are kept, so
+dashboards are unaffected by pruning.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models.functions import Cast
+from django.utils import timezone
+from .fields import COMPRESSED_PREFIX, compress_text, decompress_text
+from .models import BroadcastLog, BroadcastPartition, Emails
+from .progress import FINAL_STATUSES
+from pathlib import Path
+import gzip
+import json
+
+# Tables whose old rows are compressed and pruned
+MODELS = (Emails, BroadcastLog)
+
+DEFAULT_RETENTION = {
+    'compress_after_days': 30,
+    'prune_after_days': None,  # keep rows forever
+    'archive_dir': None,       # no archive: pruned rows are only deleted
+    'batch_size': 500,
+    'min_compress_bytes': 256,
+}
+
+
+def retention_settings(**overrides):
+    options = dict(DEFAULT_RETENTION)
+    options.update(getattr(settings, 'RETENTION', {}) or {})
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    return options
+
+
+def cutoff(days):
+    return timezone.now() - timedelta(days=days)
+
+
+# Compression ---------------------------------------------------------------
+
+def compress_bodies(model, older_than, batch_size=500, min_bytes=256):
+    """Compress the message of rows created before `older_than`.
+
+    Returns (rows compressed, bytes before, bytes after). Bodies that would
+    not shrink are left alone. Rows are written with .update(), which sends
+    no post_save: the search index (core.search) is not refreshed, and need
+    not be, as the text it holds is unchanged.
+    """
+    rows = bytes_before = bytes_after = 0
+    last_id = 0
+    candidates = (model.objects.filter(created_at__lt=older_than)
+                  .exclude(message__startswith=COMPRESSED_PREFIX)
+                  .order_by('id'))
+    # The value as stored (e.g. escaped), not as the field reads it
+    stored = Cast('message', output_field=models.TextField())
+    while True:
+        batch = list(candidates.filter(id__gt=last_id).values_list('id', stored)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        with transaction.atomic():
+            for pk, raw in batch:
+                if not raw or len(raw.encode('utf-8')) < min_bytes:
+                    continue
+                compressed = compress_text(decompress_text(raw))
+                if len(compressed) >= len(raw.encode('utf-8')):
+                    continue
+                # Only if the row was not edited in the meantime
+                if model.objects.filter(id=pk, message=raw).update(message=compressed):
+                    rows += 1
+                    bytes_before += len(raw.encode('utf-8'))
+                    bytes_after += len(compressed)
+    return rows, bytes_before, bytes_after
+
+
+# Partitions ----------------------------------------------------------------
+
+def drop_finished_partitions(older_than, batch_size=500):
+    """Delete the recipient partitions of finished broadcasts created before `older_than`."""
+    deleted = 0
+    partitions = BroadcastPartition.objects.filter(
+        broadcast__status__in=FINAL_STATUSES, broadcast__created_at__lt=older_than)
+    while True:
+        ids = list(partitions.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += BroadcastPartition.objects.filter(id__in=ids).delete()[0]
+
+
+# Pruning -------------------------------------------------------------------
+
+def _archive_row(instance):
+    row = {}
+    for field in instance._meta.concrete_fields:
+        value = getattr(instance, field.attname)
+        row[field.attname] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return row
+
+
+def prune(model, older_than, archive_dir=None, batch_size=500):
+    """Delete rows created before `older_than`, appending them to
+    `<archive_dir>/<table>-<date>.jsonl.gz` first when an archive dir is set.
+
+    Broadcasts that have not finished are never pruned. Returns (rows, archive path).
+    """
+    rows = model.objects.filter(created_at__lt=older_than).order_by('id')
+    if model is BroadcastLog:
+        rows = rows.filter(status__in=FINAL_STATUSES)
+
+    archive_path = None
+    archive = None
+    if archive_dir:
+        Path(archive_dir).mkdir(parents=True, exist_ok=True)
+        archive_path = Path(archive_dir) / f'{model._meta.db_table}-{timezone.localdate().isoformat()}.jsonl.gz'
+
+    deleted = 0
+    try:
+        while True:
+            batch = list(rows[:batch_size])
+            if not batch:
+                break
+            if archive_path is not None:
+                if archive is None:
+                    archive = gzip.open(archive_path, 'at', encoding='utf-8')
+                for instance in batch:
+                    archive.write(json.dumps(_archive_row(instance), default=str) + '\n')
+                # Make sure the archive is on disk before the rows are gone
+                archive.flush()
+            with transaction.atomic():
+                model.objects.filter(id__in=[instance.id for instance in batch]).delete()
+            deleted += len(batch)
+    finally:
+        if archive is not None:
+            archive.close()
+    return deleted, archive_path
+
+
+# SQLite space --------------------------------------------------------------
+
+def database_stats():
+    """{'page_size', 'page_count', 'freelist_count', 'auto_vacuum', 'size'} or
+    None when the database is not SQLite."""
+    if connection.vendor != 'sqlite':
+        return None
+    stats = {}
+    with connection.cursor() as cursor:
+        for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'):
+            cursor.execute(f'PRAGMA {pragma}')
+            stats[pragma] = cursor.fetchone()[0]
+    stats['size'] = stats['page_size'] * stats['page_count']
+    return stats
+
+
+def enable_incremental_vacuum():
+    """Switch the database to auto_vacuum=INCREMENTAL. Needs one full VACUUM,
+    which rewrites the whole file and blocks writers while it runs."""
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+
+
+def incremental_vacuum(pages=None):
+    """Release up to `pages` free pages (all of them by default).
+    Returns the number of pages released."""
+    stats = before = database_stats()
+    if before is None or before['auto_vacuum'] != 2:
+        return 0
+    limit = pages or before['freelist_count']
+    with connection.cursor() as cursor:
+        # The sqlite3 module steps the pragma only once, which frees a single
+        # page, so repeat it until enough pages are released
+        while stats['freelist_count'] and before['page_count'] - stats['page_count'] < limit:
+            cursor.execute('PRAGMA incremental_vacuum(%d)' % (limit - (before['page_count'] - stats['page_count'])))
+            stats = database_stats()
+            if stats['page_count'] == before['page_count']:
+                break
+    return before['page_count'] - stats['page_count']
@@ -0,0 +1,247 @@
+"""
+Scheduled broadcast dispatching.
+
+Broadcasts created with a future `sendAt` (or with pacing options) are stored
+as BroadcastLog rows with status 'scheduled'. The dispatcher keeps the upcoming
+jobs in a min-heap ordered by `send_at`, loaded through the (status, send_at)
+index, and sleeps until the next job is due. Web processes wake it up with a
+UDP datagram when they schedule something new, so the table is only re-read
+when there is a reason to (plus a slow safety resync for missed wakeups).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import BroadcastLog
+from .analytics import record_broadcast
+import heapq
+import json
+import logging
+import select
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WAKEUP_ADDRESS = ('127.0.0.1', 8765)
+
+
+def _wakeup_address():
+    return tuple(getattr(settings, 'BROADCAST_DISPATCHER_WAKEUP_ADDRESS', DEFAULT_WAKEUP_ADDRESS))
+
+
+def notify_dispatcher():
+    """Tell a running dispatcher that new scheduled broadcasts exist.
+
+    Fire-and-forget: if no dispatcher is listening the datagram is dropped and
+    the dispatcher will pick the job up on its next resync.
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(b'wakeup', _wakeup_address())
+        finally:
+            sock.close()
+    except OSError:
+        logger.debug('Broadcast dispatcher wakeup could not be sent')
+
+
+class Pacer:
+    """Spread sends evenly so a broadcast never exceeds `rate` messages per
+    second and, when `window` is given, takes roughly `window` seconds.
+
+    Slots are computed from a fixed start time so sleeps do not drift.
+    """
+
+    def __init__(self, total, rate=None, window=None, clock=time.monotonic, sleep=time.sleep):
+        intervals = [0.0]
+        if rate:
+            intervals.append(1.0 / float(rate))
+        if window and total > 1:
+            intervals.append(float(window) / (total - 1))
+        self.interval = max(intervals)
+        self._clock = clock
+        self._sleep = sleep
+        self._start = None
+        self._sent = 0
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def wait(self):
+        """Block until the next send slot is due."""
+        now = self._clock()
+        if self._start is None:
+            self._start = now
+        due = self._start + self._sent * self.interval
+        if due > now:
+            self._sleep(due - now)
+        self._sent += 1
+
+    @classmethod
+    def for_broadcast(cls, broadcast_log, total):
+        return cls(total, rate=broadcast_log.send_rate, window=broadcast_log.spread_seconds)
+
+
+class BroadcastDispatcher:
+    """Time-ordered dispatcher for scheduled broadcasts."""
+
+    def __init__(self, workers=None, resync_seconds=None):
+        self.workers = workers or getattr(settings, 'BROADCAST_DISPATCHER_WORKERS', 2)
+        self.resync_seconds = resync_seconds or getattr(settings, 'BROADCAST_DISPATCHER_RESYNC_SECONDS', 300)
+        self._heap = []  # (send_at timestamp, BroadcastLog.id)
+        self._queued = set()
+        self._last_seen_id = 0
+        self._last_resync = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast')
+        self._sock = None
+
+    # Loading -----------------------------------------------------------
+
+    def load(self, full=False):
+        """Push scheduled jobs onto the heap.
+
+        Incremental loads only read rows newer than the last one seen; a full
+        load rebuilds the heap (used on start-up and for the periodic resync).
+        """
+        queryset = BroadcastLog.objects.filter(status='scheduled', send_at__isnull=False)
+        if full:
+            self._heap = []
+            self._queued = set()
+            self._last_resync = time.monotonic()
+        else:
+            queryset = queryset.filter(id__gt=self._last_seen_id)
+
+        loaded = 0
+        for log_id, send_at in queryset.order_by('send_at').values_list('id', 'send_at'):
+            self._last_seen_id = max(self._last_seen_id, log_id)
+            if log_id in self._queued:
+                continue
+            heapq.heappush(self._heap, (send_at.timestamp(), log_id))
+            self._queued.add(log_id)
+            loaded += 1
+        if loaded:
+            logger.info(f"Dispatcher loaded {loaded} scheduled broadcast(s), {len(self._heap)} queued")
+        return loaded
+
+    # Dispatching -------------------------------------------------------
+
+    def dispatch_due(self, now=None):
+        """Start every job whose send time has passed."""
+        now = now if now is not None else time.time()
+        started = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, log_id = heapq.heappop(self._heap)
+            self._queued.discard(log_id)
+            if self._claim(log_id, now):
+                self._executor.submit(self._run, log_id)
+                started += 1
+        return started
+
+    def _claim(self, log_id, now):
+        """Atomically move a due job from 'scheduled' to 'pending'.
+
+        The conditional UPDATE makes it safe to run several dispatchers: only
+        one of them gets a row count of 1. A job whose send_at was moved later
+        is pushed back onto the heap instead.
+        """
+        row = BroadcastLog.objects.filter(id=log_id, status='scheduled').values_list('send_at', flat=True).first()
+        if row is None:
+            return False
+        if row.timestamp() > now:
+            heapq.heappush(self._heap, (row.timestamp(), log_id))
+            self._queued.add(log_id)
+            return False
+        return BroadcastLog.objects.filter(id=log_id, status='scheduled').update(status='pending') == 1
+
+    def _run(self, log_id):
+        from .utils import runBroadcast, startShardedBroadcast
+
+        close_old_connections()
+        try:
+            broadcast_log = BroadcastLog.objects.get(id=log_id)
+            data = json.loads(broadcast_log.payload or '{}')
+            if data.get('shardSize'):
+                startShardedBroadcast(data, broadcast_log.device_id, broadcast_log=broadcast_log)
+                return
+            pacer = Pacer.for_broadcast(broadcast_log, len(data.get('recipients', [])))
+            logger.info(f"Dispatching scheduled broadcast {broadcast_log.broadcast_id} (interval={pacer.interval:.3f}s)")
+            response_data, _ = runBroadcast(data, broadcast_log.device_id, broadcast_log=broadcast_log, pacer=pacer)
+            logger.info(f"Scheduled broadcast {broadcast_log.broadcast_id} finished: {response_data.get('status')}")
+        except Exception:
+            logger.exception(f"Scheduled broadcast {log_id} crashed")
+            if BroadcastLog.objects.filter(id=log_id, status='pending').update(status='failed', payload=''):
+                record_broadcast(BroadcastLog.objects.get(id=log_id))
+        finally:
+            close_old_connections()
+
+    # Main loop ---------------------------------------------------------
+
+    def seconds_until_next(self, now=None):
+        now = now if now is not None else time.time()
+        until_resync = self.resync_seconds - (time.monotonic() - self._last_resync)
+        if not self._heap:
+            return max(until_resync, 0)
+        return max(min(self._heap[0][0] - now, until_resync), 0)
+
+    def _open_wakeup_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(_wakeup_address())
+        sock.setblocking(False)
+        return sock
+
+    def _sleep(self, timeout):
+        """Sleep until `timeout` elapses or a wakeup datagram arrives.
+
+        Returns True when woken up by a datagram.
+        """
+        if self._sock is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while True:
+                self._sock.recv(64)
+        except BlockingIOError:
+            pass
+        return True
+
+    def run_forever(self):
+        try:
+            self._sock = self._open_wakeup_socket()
+        except OSError:
+            logger.warning(f"Could not bind dispatcher wakeup socket {_wakeup_address()}; relying on resync only")
+            self._sock = None
+
+        self.load(full=True)
+        try:
+            while True:
+                self.dispatch_due()
+                woken = self._sleep(self.seconds_until_next())
+                if woken:
+                    self.load()
+                elif time.monotonic() - self._last_resync >= self.resync_seconds:
+                    self.load(full=True)
+                close_old_connections()
+        finally:
+            if self._sock is not None:
+                self._sock.close()
+            self._executor.shutdown(wait=True)
+
+
+def schedule_time(value):
+    """Normalise a `sendAt` value to an aware datetime (None if absent)."""
+    if not value:
+        return None
+    if isinstance(value, str):
+        from django.utils.dateparse import parse_datetime
+        value = parse_datetime(value)
+        if value is None:
+            raise ValueError('sendAt must be an ISO 8601 datetime')
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value
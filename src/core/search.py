@@ -0,0 +1,233 @@
+"""
+Full-text search over sent emails and broadcasts (SQLite FTS5).
+
+`core_search_index` is an FTS5 table with one row per Emails / BroadcastLog
+row: the subject plus the newsletter title and content parsed out of the
+message JSON. It is kept in sync by post_save / post_delete signals
+(connected in CoreConfig.ready) and can be rebuilt with
+`manage.py rebuild_search_index`. Saves that name their `update_fields`
+are only re-indexed when an indexed column is among them.
+
+On other databases the table does not exist, indexing is a no-op and
+searching raises SearchUnavailable.
+"""
+from django.db import connection
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.utils.html import strip_tags
+from .models import BroadcastLog, Emails
+from .devices import device_key
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'core_search_index'
+
+# Column weights for bm25(), in table column order (unindexed columns first)
+SUBJECT_WEIGHT, TITLE_WEIGHT, CONTENT_WEIGHT = 10.0, 5.0, 1.0
+
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "kind UNINDEXED, object_id UNINDEXED, device_id UNINDEXED, subject, title, content, "
+    "tokenize = 'porter unicode61 remove_diacritics 2')"
+)
+
+KINDS = {'email': Emails, 'broadcast': BroadcastLog}
+# Documents are keyed by rowid so updates and deletes never scan the index
+_KIND_OFFSETS = {'email': 0, 'broadcast': 1}
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+# Columns a saved row is indexed from (attnames and field names)
+INDEXED_FIELDS = {'subject', 'message', 'device', 'device_id'}
+
+# (alias, database name) -> whether the index table exists; cleared when
+# migrations or rebuild() may have created or dropped it
+_available = {}
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text index."""
+
+
+def fts_available(using=None):
+    conn = using or connection
+    if conn.vendor != 'sqlite':
+        return False
+    key = (conn.alias, conn.settings_dict['NAME'])
+    available = _available.get(key)
+    if available is None:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            available = _available[key] = cursor.fetchone() is not None
+    return available
+
+
+def clear_cache(**kwargs):
+    _available.clear()
+
+
+def _rowid(kind, pk):
+    return pk * len(_KIND_OFFSETS) + _KIND_OFFSETS[kind]
+
+
+def _document(kind, instance):
+    from .utils import _parse_newsletter
+
+    newsletter = _parse_newsletter({'subject': instance.subject or '', 'message': instance.message or ''})
+    return (
+        _rowid(kind, instance.pk),
+        kind,
+        instance.pk,
+        instance.device_id or '',
+        instance.subject or '',
+        strip_tags(str(newsletter['newsletter_title'] or '')),
+        strip_tags(str(newsletter['newsletter_content'] or '')),
+    )
+
+
+_INSERT_SQL = (
+    f'INSERT INTO {FTS_TABLE} (rowid, kind, object_id, device_id, subject, title, content) '
+    'VALUES (%s, %s, %s, %s, %s, %s, %s)'
+)
+
+
+def index_object(kind, instance):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [_rowid(kind, instance.pk)])
+        cursor.execute(_INSERT_SQL, _document(kind, instance))
+
+
+def remove_object(kind, pk):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [_rowid(kind, pk)])
+
+
+def rebuild(kinds=None, using=None):
+    """(Re)create the index and add every email and broadcast to it (the
+    models of `kinds`, default KINDS, e.g. historical ones in a migration).
+    Returns the number of documents."""
+    conn = using or connection
+    if conn.vendor != 'sqlite':
+        raise SearchUnavailable('Full-text search needs SQLite with FTS5')
+    count = 0
+    clear_cache()
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE_TABLE_SQL)
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        for kind, model in (kinds or KINDS).items():
+            rows = (model.objects.using(conn.alias).only('id', 'device_id', 'subject', 'message')
+                    .iterator(chunk_size=1000))
+            batch = []
+            for instance in rows:
+                batch.append(_document(kind, instance))
+                if len(batch) >= 1000:
+                    cursor.executemany(_INSERT_SQL, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(_INSERT_SQL, batch)
+                count += len(batch)
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return count
+
+
+def match_expression(query):
+    """Turn free text into a safe FTS5 query: every word must match, the last
+    one as a prefix so results update while typing."""
+    words = _WORD_RE.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(query, device_id=None, kind=None, limit=20, offset=0):
+    """Ranked matches as dicts (best first) plus whether more results exist."""
+    if not fts_available():
+        raise SearchUnavailable('Full-text search needs SQLite with FTS5')
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+
+    sql = (
+        f"SELECT kind, object_id, device_id, "
+        f"bm25({FTS_TABLE}, 0, 0, 0, %s, %s, %s) AS rank, "
+        f"snippet({FTS_TABLE}, -1, '<mark>', '</mark>', '…', 12) "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+    )
+    params = [SUBJECT_WEIGHT, TITLE_WEIGHT, CONTENT_WEIGHT, expression]
+    if device_id:
+        sql += ' AND device_id = %s'
+        params.append(device_id)
+    if kind:
+        sql += ' AND kind = %s'
+        params.append(kind)
+    sql += ' ORDER BY rank LIMIT %s OFFSET %s'
+    params += [limit + 1, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Load the matching rows' summary columns, one query per kind
+    objects = {}
+    for kind_name, model in KINDS.items():
+        ids = [row[1] for row in rows if row[0] == kind_name]
+        if ids:
+            fields = ['id', 'subject', 'created_at'] + (['broadcast_id'] if kind_name == 'broadcast' else [])
+            for instance in model.objects.filter(id__in=ids).only(*fields):
+                objects[(kind_name, instance.id)] = instance
+
+    results = []
+    for kind_name, object_id, row_device_id, rank, snippet in rows:
+        instance = objects.get((kind_name, object_id))
+        if instance is None:
+            continue
+        result = {
+            'type': kind_name,
+            'id': object_id,
+            'device_id': device_key(row_device_id or None),
+            'subject': instance.subject,
+            'snippet': snippet,
+            # bm25 is lower-is-better; flip it so higher means more relevant
+            'score': round(-rank, 4),
+            'created_at': instance.created_at.isoformat() if instance.created_at else None,
+        }
+        if kind_name == 'broadcast':
+            result['broadcast_id'] = instance.broadcast_id
+        results.append(result)
+    return results, has_more
+
+
+# Signals -----------------------------------------------------------------
+
+def _indexer(kind):
+    def on_save(sender, instance, update_fields=None, **kwargs):
+        if update_fields is not None and not INDEXED_FIELDS & set(update_fields):
+            return
+        try:
+            if fts_available():
+                index_object(kind, instance)
+        except Exception:
+            logger.exception(f'Failed to index {kind} {instance.pk} for search')
+
+    def on_delete(sender, instance, **kwargs):
+        try:
+            if fts_available():
+                remove_object(kind, instance.pk)
+        except Exception:
+            logger.exception(f'Failed to remove {kind} {instance.pk} from search')
+    return on_save, on_delete
+
+
+def connect_signals():
+    for kind, model in KINDS.items():
+        on_save, on_delete = _indexer(kind)
+        post_save.connect(on_save, sender=model, weak=False, dispatch_uid=f'search-index-{kind}')
+        post_delete.connect(on_delete, sender=model, weak=False, dispatch_uid=f'search-unindex-{kind}')
+    post_migrate.connect(clear_cache, dispatch_uid='search-clear-cache')
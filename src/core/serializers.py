@@ -1,17 +1,35 @@
 from rest_framework.serializers import ModelSerializer
 from rest_framework import serializers
-from .models import Emails, Subscriber, BroadcastLog
+from .models import Emails, Subscriber, BroadcastLog, BroadcastTiming
+from .devices import device_key
+
+
+class DeviceKeyField(serializers.Field):
+    """Shows a `device` foreign key as the client's X-Device-ID value"""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return device_key(value)
+
 
 class EmailSerializer(ModelSerializer):
+    device_id = DeviceKeyField()
+
     class Meta:
         model = Emails
-        fields = '__all__'
+        exclude = ['device']
 
 
 class SubscriberSerializer(ModelSerializer):
+    device_id = DeviceKeyField()
+
     class Meta:
         model = Subscriber
-        fields = '__all__'
+        # Lookup columns maintained by Subscriber.save()
+        exclude = ['device', 'email_normalized', 'domain_reversed']
 
 
 class BroadcastSerializer(serializers.Serializer):
@@ -35,9 +53,85 @@ class BroadcastSerializer(serializers.Serializer):
     eventDate = serializers.CharField(max_length=100, required=False, allow_blank=True)
     eventTime = serializers.CharField(max_length=100, required=False, allow_blank=True)
     eventLocation = serializers.CharField(max_length=500, required=False, allow_blank=True)
+    # Optional scheduling / pacing fields
+    sendAt = serializers.DateTimeField(required=False, allow_null=True)
+    spreadSeconds = serializers.IntegerField(required=False, min_value=0)
+    sendRate = serializers.FloatField(required=False, allow_null=True, min_value=0.01)
+    # Optional sharded execution: recipients per partition
+    shardSize = serializers.IntegerField(required=False, min_value=1)
+    # Optional outbound transport: SendGrid HTTP API (default), pooled SMTP or
+    # weighted over settings.BROADCAST_TRANSPORTS
+    transport = serializers.ChoiceField(choices=['sendgrid', 'smtp', 'balanced'], required=False)
+
+
+class BroadcastTimingSerializer(ModelSerializer):
+
+    class Meta:
+        model = BroadcastTiming
+        exclude = ['broadcast', 'request_state']
 
 
 class BroadcastLogSerializer(ModelSerializer):
+    device_id = DeviceKeyField()
+    # null until the broadcast has been sent
+    timing = BroadcastTimingSerializer(read_only=True, default=None)
+
+    class Meta:
+        model = BroadcastLog
+        # payload is the dispatcher's and shard workers' copy of the request
+        exclude = ['device', 'payload']
+
+
+# Columns loaded for history lists; the message body is left in the database
+BROADCAST_LIST_FIELDS = [
+    'id', 'device_id', 'broadcast_id', 'subject', 'sender_email', 'sender_name', 'recipients_count',
+    'sent_count', 'failed_count', 'delivered_count', 'bounced_count', 'complaint_count', 'status',
+    'created_at', 'send_at',
+]
+
+# Phase timings loaded with them (the merge state of sharded broadcasts is not)
+BROADCAST_TIMING_FIELDS = [
+    f'timing__{field.name}' for field in BroadcastTiming._meta.concrete_fields if field.name != 'request_state'
+]
+
+
+class BroadcastLogListSerializer(ModelSerializer):
+    device_id = DeviceKeyField()
+    timing = BroadcastTimingSerializer(read_only=True, default=None)
+
     class Meta:
         model = BroadcastLog
-        fields = '__all__'
+        fields = BROADCAST_LIST_FIELDS + ['timing']
+
+
+class SubscriberBulkFilterSerializer(serializers.Serializer):
+    device_id = serializers.CharField(max_length=255, required=False)
+    domain = serializers.CharField(max_length=254, required=False)
+    is_active = serializers.BooleanField(required=False, allow_null=True, default=None)
+    created_before = serializers.DateTimeField(required=False)
+    # next_after of the previous response
+    after = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, data):
+        if not data.get('device_id') and not data.get('domain') and not data.get('created_before'):
+            raise serializers.ValidationError('Filter needs device_id, domain or created_before')
+        return data
+
+
+class SubscriberBulkSerializer(serializers.Serializer):
+    """Bulk activate / deactivate / delete by ids, emails or a filter"""
+    action = serializers.ChoiceField(choices=['activate', 'deactivate', 'delete'])
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False)
+    # Not EmailField: clean-up lists may hold malformed addresses that were stored anyway
+    emails = serializers.ListField(child=serializers.CharField(max_length=254), required=False, allow_empty=False)
+    filter = SubscriberBulkFilterSerializer(required=False)
+    dry_run = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        targets = [name for name in ('ids', 'emails', 'filter') if name in data]
+        if len(targets) != 1:
+            raise serializers.ValidationError('Give exactly one of ids, emails or filter')
+        limit = self.context.get('max_items')
+        if limit and len(data.get(targets[0]) or []) > limit:
+            raise serializers.ValidationError(f'At most {limit} {targets[0]} per request')
+        return data
@@ -0,0 +1,290 @@
+"""
+Sharded broadcast execution.
+
+A sharded broadcast splits its recipients into BroadcastPartition rows. Any
+number of worker processes (on one or several nodes sharing the database) run
+`manage.py run_broadcast_worker`, claim partitions through a lease and keep it
+alive with a heartbeat. A partition whose lease expires is reclaimed by another
+worker.
+
+Recipients are reserved in small batches by advancing the partition cursor
+*before* they are sent, so a reclaimed partition resumes after the last
+reserved batch and nobody is sent to twice. Recipients of a batch that was
+reserved but not finished by a dead worker are counted as failed.
+
+A worker that cannot create its transport (e.g. a misconfigured node) only
+releases its lease on the partition, so a healthy worker picks it up; the
+broadcast and its other partitions are left alone. A partition claimed more
+than BROADCAST_SHARD_MAX_ATTEMPTS times (released, or crashing its workers
+every time) is marked failed instead, with its unsent recipients counted as
+failed in the broadcast roll-up.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from .models import BroadcastLog, BroadcastPartition, BroadcastTiming
+from .progress import publish
+from .analytics import record_broadcast
+from .timing import BroadcastTimer, merge_states, save_timing
+from .transports import create_transport, merge_reports, transport_report
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Partitions no worker will claim again
+FINISHED = ('done', 'failed')
+
+
+def create_partitions(broadcast_log, recipients, shard_size):
+    """Split `recipients` into partitions of at most `shard_size` emails."""
+    shard_size = max(int(shard_size), 1)
+    partitions = []
+    for index, start in enumerate(range(0, len(recipients), shard_size)):
+        chunk = recipients[start:start + shard_size]
+        partitions.append(BroadcastPartition(
+            broadcast=broadcast_log,
+            index=index,
+            recipients=json.dumps(chunk),
+            recipients_count=len(chunk),
+        ))
+    BroadcastPartition.objects.bulk_create(partitions)
+    publish(broadcast_log.broadcast_id, len(recipients), 0, 0, status='pending', previous={})
+    return len(partitions)
+
+
+def rollup(broadcast_log_id):
+    """Aggregate partition progress into the BroadcastLog.
+
+    While partitions are still open only the counters are updated; once every
+    partition is done the final status is written exactly once.
+    """
+    from .utils import _broadcast_status, _record_broadcast_email
+
+    totals = BroadcastPartition.objects.filter(broadcast_id=broadcast_log_id).aggregate(
+        sent=Sum('sent_count'),
+        failed=Sum('failed_count'),
+        recipients=Sum('recipients_count'),
+        open=Count('id', filter=~Q(status__in=FINISHED)),
+    )
+    sent = totals['sent'] or 0
+    failed = totals['failed'] or 0
+    # Partitions are sent side by side
+    transport_stats = merge_reports(
+        BroadcastPartition.objects.filter(broadcast_id=broadcast_log_id).values_list('transport_stats', flat=True),
+        parallel=True,
+    )
+    pending_logs = BroadcastLog.objects.filter(id=broadcast_log_id, status='pending')
+
+    broadcast_log = BroadcastLog.objects.only('broadcast_id', 'recipients_count', 'created_at').get(id=broadcast_log_id)
+    if totals['open']:
+        if pending_logs.update(sent_count=sent, failed_count=failed, transport_stats=transport_stats):
+            _rollup_timing(broadcast_log)
+        publish(broadcast_log.broadcast_id, broadcast_log.recipients_count, sent, failed)
+        return None
+
+    # Recipients reserved by a worker that died mid-batch were never confirmed
+    skipped = max((totals['recipients'] or 0) - sent - failed, 0)
+    failed += skipped
+    status = _broadcast_status(sent, failed)
+    if pending_logs.update(sent_count=sent, failed_count=failed, status=status, transport_stats=transport_stats,
+                           payload='') == 1:
+        _rollup_timing(broadcast_log)
+        publish(broadcast_log.broadcast_id, broadcast_log.recipients_count, sent, failed, status)
+        broadcast_log = BroadcastLog.objects.get(id=broadcast_log_id)
+        record_broadcast(broadcast_log)
+        if sent > 0:
+            _record_broadcast_email(broadcast_log.device_id, broadcast_log.subject, broadcast_log.message)
+        logger.info(f"Sharded broadcast {broadcast_log.broadcast_id} finished: {status} "
+                    f"(sent={sent}, failed={failed}, skipped={skipped})")
+    return status
+
+
+def _rollup_timing(broadcast_log):
+    """Merge the phase timings of the send request and of every partition;
+    the total is the time since the broadcast was created."""
+    request_state = BroadcastTiming.objects.filter(broadcast=broadcast_log).values_list('request_state', flat=True).first()
+    states = BroadcastPartition.objects.filter(broadcast=broadcast_log).values_list('timing', flat=True)
+    save_timing(broadcast_log, merge_states([request_state, *states]),
+                total_seconds=(timezone.now() - broadcast_log.created_at).total_seconds())
+
+
+class _Heartbeat(threading.Thread):
+    """Renews a partition lease in the background while it is being sent."""
+
+    def __init__(self, worker, partition_id):
+        super().__init__(daemon=True, name=f'lease-{partition_id}')
+        self.worker = worker
+        self.partition_id = partition_id
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.worker.lease_seconds / 3.0):
+                if not self.worker.renew(self.partition_id):
+                    logger.warning(f"Lease on partition {self.partition_id} lost by {self.worker.owner}")
+                    self.lost = True
+                    return
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ShardWorker:
+    """Claims partitions and sends them, one at a time."""
+
+    def __init__(self, owner=None, lease_seconds=None, batch_size=None, idle_seconds=None, max_attempts=None):
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease_seconds = lease_seconds or getattr(settings, 'BROADCAST_SHARD_LEASE_SECONDS', 60)
+        self.batch_size = batch_size or getattr(settings, 'BROADCAST_SHARD_BATCH_SIZE', 25)
+        self.idle_seconds = idle_seconds or getattr(settings, 'BROADCAST_SHARD_IDLE_SECONDS', 5)
+        self.max_attempts = max_attempts or getattr(settings, 'BROADCAST_SHARD_MAX_ATTEMPTS', 5)
+
+    def _lease_expiry(self):
+        return timezone.now() + timedelta(seconds=self.lease_seconds)
+
+    def _owned(self, partition_id):
+        return BroadcastPartition.objects.filter(id=partition_id, lease_owner=self.owner, status='claimed')
+
+    def claim(self):
+        """Claim one pending partition, or one whose lease has expired."""
+        now = timezone.now()
+        claimable = Q(status='pending') | Q(status='claimed', lease_expires_at__lt=now)
+        candidates = BroadcastPartition.objects.filter(claimable).order_by('id').values_list('id', flat=True)[:20]
+        for partition_id in list(candidates):
+            claimed = BroadcastPartition.objects.filter(claimable, id=partition_id).update(
+                status='claimed',
+                lease_owner=self.owner,
+                lease_expires_at=self._lease_expiry(),
+                heartbeat_at=now,
+                attempts=F('attempts') + 1,
+            )
+            if claimed:
+                return BroadcastPartition.objects.select_related('broadcast').get(id=partition_id)
+        return None
+
+    def renew(self, partition_id):
+        return self._owned(partition_id).update(
+            lease_expires_at=self._lease_expiry(),
+            heartbeat_at=timezone.now(),
+        ) == 1
+
+    def release(self, partition_id):
+        """Give a claimed partition back to the pending pool."""
+        return self._owned(partition_id).update(status='pending', lease_owner='', lease_expires_at=None) == 1
+
+    def fail(self, partition_id):
+        """Give up on a claimed partition: recipients not sent yet count as failed."""
+        return self._owned(partition_id).update(
+            status='failed', lease_expires_at=None, failed_count=F('recipients_count') - F('sent_count')) == 1
+
+    def process(self, partition):
+        """Send the unreserved remainder of a claimed partition. Returns False
+        when the partition was released without being worked on."""
+        from .scheduler import Pacer
+        from .utils import _deliver, _prepare_broadcast
+
+        broadcast_log = partition.broadcast
+        if partition.attempts > self.max_attempts:
+            logger.error(f"Partition {partition.id} of broadcast {broadcast_log.broadcast_id} was claimed "
+                         f"{partition.attempts - 1} times without finishing; marking it failed")
+            self.fail(partition.id)
+            rollup(broadcast_log.id)
+            return True
+        if partition.attempts > 1:
+            logger.info(f"{self.owner} reclaimed partition {partition.id} at cursor {partition.cursor}")
+
+        data = json.loads(broadcast_log.payload or '{}')
+        try:
+            transport = create_transport(data.get('transport'))
+        except Exception:
+            logger.exception(f"{self.owner} cannot create a transport; releasing partition {partition.id}")
+            self.release(partition.id)
+            return False
+
+        timer = BroadcastTimer()
+        with timer.phase('render'):
+            prepared = _prepare_broadcast(data)
+        prepared['custom_args'] = {'broadcast_id': broadcast_log.broadcast_id}
+        recipients = json.loads(partition.recipients)
+        partitions_count = BroadcastPartition.objects.filter(broadcast=broadcast_log).count()
+        pacer = Pacer(
+            len(recipients),
+            rate=broadcast_log.send_rate / partitions_count if broadcast_log.send_rate else None,
+            window=broadcast_log.spread_seconds,
+        )
+
+        heartbeat = _Heartbeat(self, partition.id)
+        heartbeat.start()
+        cursor = partition.cursor
+        # Transport stats and timings of earlier attempts at this partition, then of this one
+        previous_stats = partition.transport_stats
+        previous_timing = partition.timing
+        sent_total = failed_total = 0
+        started = time.monotonic()
+        try:
+            while cursor < len(recipients) and not heartbeat.lost:
+                end = min(cursor + self.batch_size, len(recipients))
+                # Reserve the batch before sending; renews the lease as well
+                reserved = self._owned(partition.id).filter(cursor=cursor).update(
+                    cursor=end,
+                    lease_expires_at=self._lease_expiry(),
+                    heartbeat_at=timezone.now(),
+                )
+                if not reserved:
+                    logger.warning(f"{self.owner} lost partition {partition.id} before cursor {cursor}")
+                    break
+
+                sent, failed_emails = _deliver(transport, prepared, recipients[cursor:end],
+                                               pacer if pacer.enabled else None, timer=timer)
+                for failure in failed_emails:
+                    logger.warning(f"Broadcast {broadcast_log.broadcast_id} failed for {failure['email']}: {failure['error']}")
+
+                sent_total += sent
+                failed_total += len(failed_emails)
+                stats = transport_report(transport, sent_total, failed_total, time.monotonic() - started)
+                with timer.phase('bookkeeping'):
+                    BroadcastPartition.objects.filter(id=partition.id).update(
+                        sent_count=F('sent_count') + sent,
+                        failed_count=F('failed_count') + len(failed_emails),
+                        transport_stats=merge_reports([previous_stats, stats]),
+                        timing=merge_states([previous_timing, timer.state()]),
+                    )
+                    cursor = end
+                    rollup(broadcast_log.id)
+
+            if cursor >= len(recipients):
+                self._owned(partition.id).update(status='done', lease_expires_at=None)
+        finally:
+            heartbeat.stop()
+            heartbeat.join()
+            transport.close()
+        rollup(broadcast_log.id)
+        return True
+
+    def run(self, once=False):
+        """Process partitions until interrupted (or until idle with `once`)."""
+        while True:
+            close_old_connections()
+            partition = self.claim()
+            if partition is None:
+                if once:
+                    return
+                time.sleep(self.idle_seconds)
+                continue
+            try:
+                if not self.process(partition):
+                    # Leave the released partition to other workers for a while
+                    time.sleep(self.idle_seconds)
+            except Exception:
+                logger.exception(f"Partition {partition.id} crashed in {self.owner}; lease will expire")
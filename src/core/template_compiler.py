@@ -0,0 +1,392 @@
+"""
+Compile-time optimisation of the newsletter templates.
+
+The newsletter templates are sent to every recipient, so their size is paid
+once per message. This loader rewrites their *source* once, when Django first
+loads them (the cached loader keeps the result for the life of the process):
+
+- rules from <style> blocks are inlined into the matching elements, which email
+  clients need anyway; rules that cannot be inlined (pseudo-classes, @media,
+  `*`) stay in a much smaller <style> block, @media ones marked !important so
+  they still win over the inline styles;
+- comments and insignificant whitespace are removed.
+
+Django template syntax is left untouched, so the output renders exactly like
+the original template: <style> blocks holding template tags ({% %}, {# #}) are
+only minified, never inlined, since their rules depend on the context, and the
+content of <pre> elements is kept as written.
+"""
+from django.conf import settings
+from django.template.loaders.filesystem import Loader as FilesystemLoader
+from html.parser import HTMLParser
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMPILED_TEMPLATES = ('newsletter-announcement.html', 'newsletter-event.html')
+
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+BLOCK_TAGS = {
+    'html', 'head', 'body', 'meta', 'title', 'link', 'style', 'table', 'thead', 'tbody', 'tr', 'td', 'th',
+    'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'svg', 'path', 'center', 'br', 'pre',
+    '!doctype',
+}
+
+_COMMENT_RE = re.compile(r'<!--(?!\[if)(?!<!\[endif).*?-->', re.S)
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_STYLE_BLOCK_RE = re.compile(r'<style[^>]*>(.*?)</style>', re.S | re.I)
+_STYLE_ATTR_RE = re.compile(r'''(\sstyle\s*=\s*)("([^"]*)"|'([^']*)')''', re.I)
+_COMPOUND_RE = re.compile(r'^([a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$')
+_TOKEN_RE = re.compile(r'(<[^<>]*>|{%.*?%}|{#.*?#})', re.S)
+_TEMPLATE_TAG_RE = re.compile(r'({{.*?}}|{%.*?%}|{#.*?#})', re.S)
+_PRE_RE = re.compile(r'<pre\b[^>]*>.*?</pre\s*>', re.S | re.I)
+
+
+# CSS parsing -----------------------------------------------------------
+
+def _split_outside(text, sep):
+    """Split on `sep` outside of quotes and parentheses."""
+    parts, depth, quote, current = [], 0, None, []
+    for ch in text:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in '\'"':
+            quote = ch
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(''.join(current))
+            current = []
+            continue
+        current.append(ch)
+    parts.append(''.join(current))
+    return parts
+
+
+def _parse_declarations(body):
+    declarations = []
+    for item in _split_outside(body, ';'):
+        if ':' not in item:
+            continue
+        prop, value = item.split(':', 1)
+        prop = prop.strip().lower()
+        value = ' '.join(value.split())
+        if prop and value:
+            declarations.append((prop, value))
+    return declarations
+
+
+def _parse_stylesheet(css):
+    """Return a list of (prelude, body) blocks; @-rules keep their raw body."""
+    css = _CSS_COMMENT_RE.sub('', css)
+    blocks, depth, start, prelude = [], 0, 0, ''
+    for i, ch in enumerate(css):
+        if ch == '{':
+            if depth == 0:
+                prelude = css[start:i].strip()
+                start = i + 1
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                blocks.append((prelude, css[start:i]))
+                start = i + 1
+    return blocks
+
+
+def _specificity(compounds):
+    ids = classes = tags = 0
+    for tag, qualifiers in compounds:
+        ids += qualifiers.count('#')
+        classes += qualifiers.count('.')
+        tags += 1 if tag else 0
+    return ids, classes, tags
+
+
+def _parse_selector(selector):
+    """Parse a descendant selector made of tag/.class/#id compounds.
+
+    Returns a list of (tag, qualifiers) or None when it cannot be inlined.
+    """
+    compounds = []
+    for part in selector.split():
+        match = _COMPOUND_RE.match(part)
+        if not match or not part:
+            return None
+        compounds.append((match.group(1) or '', match.group(2) or ''))
+    return compounds or None
+
+
+def _minify_css(css):
+    css = _CSS_COMMENT_RE.sub('', css)
+    out = []
+    for i, part in enumerate(_TEMPLATE_TAG_RE.split(css)):
+        if i % 2:
+            out.append(part)
+            continue
+        # Keep a space where the text meets a template tag, e.g. `0 {{ gap }}px`
+        collapsed = ' '.join(part.split())
+        if collapsed and part[0].isspace():
+            collapsed = ' ' + collapsed
+        if collapsed and part[-1].isspace():
+            collapsed += ' '
+        collapsed = re.sub(r'\s*([{};:,>])\s*', r'\1', collapsed)
+        out.append(collapsed.replace(';}', '}'))
+    return ''.join(out).strip()
+
+
+def _has_block_tags(text):
+    return '{%' in text or '{#' in text
+
+
+def _serialize_rules(rules, important=False):
+    out = []
+    for selector, declarations in rules:
+        body = ';'.join(
+            f"{prop}:{value}{' !important' if important and '!important' not in value else ''}"
+            for prop, value in declarations
+        )
+        out.append(f'{selector}{{{body}}}')
+    return ''.join(out)
+
+
+# Element matching ------------------------------------------------------
+
+def _compound_matches(compound, element):
+    tag, qualifiers = compound
+    if tag and tag != element['tag']:
+        return False
+    for kind, name in re.findall(r'([.#])([\w-]+)', qualifiers):
+        if kind == '.' and name not in element['classes']:
+            return False
+        if kind == '#' and name != element['id']:
+            return False
+    return True
+
+
+def _selector_matches(compounds, stack):
+    if not _compound_matches(compounds[-1], stack[-1]):
+        return False
+    ancestors = len(stack) - 1
+    for compound in reversed(compounds[:-1]):
+        while ancestors > 0:
+            ancestors -= 1
+            if _compound_matches(compound, stack[ancestors]):
+                break
+        else:
+            return False
+    return True
+
+
+class _StyleInliner(HTMLParser):
+    """Collects the inline style for every start tag, keyed by source offset."""
+
+    def __init__(self, source, rules):
+        super().__init__(convert_charrefs=False)
+        self.rules = rules
+        self.stack = []
+        self.styles = {}  # offset -> (raw start tag, declarations)
+        self._line_offsets = [0]
+        for line in source.splitlines(keepends=True):
+            self._line_offsets.append(self._line_offsets[-1] + len(line))
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self._line_offsets[line - 1] + column
+
+    def _element(self, tag, attrs):
+        attrs = dict(attrs)
+        return {
+            'tag': tag,
+            'id': attrs.get('id') or '',
+            'classes': set((attrs.get('class') or '').split()),
+        }
+
+    def _collect(self, tag, attrs, void):
+        self.stack.append(self._element(tag, attrs))
+        matched = {}
+        for _, _, compounds, declarations in self.rules:
+            if _selector_matches(compounds, self.stack):
+                for prop, value in declarations:
+                    matched.pop(prop, None)
+                    matched[prop] = value
+        if matched:
+            self.styles[self._offset()] = (self.get_starttag_text(), matched)
+        if void:
+            self.stack.pop()
+
+    def handle_starttag(self, tag, attrs):
+        self._collect(tag, attrs, tag in VOID_TAGS)
+
+    def handle_startendtag(self, tag, attrs):
+        self._collect(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i]['tag'] == tag:
+                del self.stack[i:]
+                return
+
+
+def _with_inline_style(start_tag, declarations):
+    inlined = ';'.join(f'{prop}:{value}' for prop, value in declarations.items()).replace('"', "'")
+    match = _STYLE_ATTR_RE.search(start_tag)
+    if match:
+        existing = match.group(3) if match.group(3) is not None else match.group(4)
+        # Declarations already in the attribute come last so they still win
+        merged = f'{inlined};{existing}' if existing.strip() else inlined
+        return f'{start_tag[:match.start()]}{match.group(1)}"{merged}"{start_tag[match.end():]}'
+    end = -2 if start_tag.endswith('/>') else -1
+    return f'{start_tag[:end].rstrip()} style="{inlined}"{start_tag[end:]}'
+
+
+def inline_css(source):
+    """Move <style> rules onto the elements they match."""
+    style_blocks = _STYLE_BLOCK_RE.findall(source)
+    if not style_blocks:
+        return source
+
+    inlinable, residual, media = [], [], []
+    order = 0
+    for css in style_blocks:
+        if _has_block_tags(css):
+            continue
+        for prelude, body in _parse_stylesheet(css):
+            if prelude.startswith('@'):
+                media.append(f'{prelude}{{{_minify_media(body)}}}')
+                continue
+            declarations = _parse_declarations(body)
+            for selector in (s.strip() for s in prelude.split(',')):
+                compounds = _parse_selector(selector)
+                if compounds is None:
+                    residual.append((selector, declarations))
+                else:
+                    inlinable.append((_specificity(compounds), order, compounds, declarations))
+                    order += 1
+    # Apply in cascade order: specificity first, then source order
+    inlinable.sort(key=lambda rule: (rule[0], rule[1]))
+
+    parser = _StyleInliner(source, inlinable)
+    parser.feed(source)
+    parser.close()
+
+    out, last = [], 0
+    for offset in sorted(parser.styles):
+        start_tag, declarations = parser.styles[offset]
+        out.append(source[last:offset])
+        out.append(_with_inline_style(start_tag, declarations))
+        last = offset + len(start_tag)
+    out.append(source[last:])
+    source = ''.join(out)
+
+    remaining = _serialize_rules(residual) + ''.join(media)
+    replacement = f'<style>{remaining}</style>' if remaining else ''
+    first = [True]
+
+    def _replace(match):
+        if _has_block_tags(match.group(1)):
+            return match.group(0)
+        if first[0]:
+            first[0] = False
+            return replacement
+        return ''
+    return _STYLE_BLOCK_RE.sub(_replace, source)
+
+
+def _minify_media(body):
+    rules = []
+    for prelude, rule_body in _parse_stylesheet(body):
+        rules.append((prelude, _parse_declarations(rule_body)))
+    # Media rules must beat the inlined styles
+    return _serialize_rules(rules, important=True)
+
+
+def _tag_name(token):
+    match = re.match(r'</?([\w!-]+)', token)
+    return match.group(1).lower() if match else ''
+
+
+def _html_neighbour(tokens, index, step):
+    """Nearest HTML tag next to tokens[index], skipping template tags and
+    whitespace. Returns None when text comes first."""
+    index += step
+    while 0 <= index < len(tokens):
+        token = tokens[index]
+        if token.startswith('<'):
+            return token
+        if token.startswith(('{%', '{#')) or not token.strip():
+            index += step
+            continue
+        return None
+    return ''
+
+
+def minify_html(source):
+    """Strip comments and insignificant whitespace, keeping template tags intact."""
+    source = _COMMENT_RE.sub('', source)
+    source = _STYLE_BLOCK_RE.sub(lambda m: f'<style>{_minify_css(m.group(1))}</style>', source)
+
+    # <pre> content is set aside so its whitespace survives
+    preformatted = []
+
+    def _set_aside(match):
+        preformatted.append(match.group(0))
+        return f'<pre \x00{len(preformatted) - 1}\x00>'
+    source = _PRE_RE.sub(_set_aside, source)
+    source = ' '.join(source.split())
+
+    # Whitespace between two tags is not rendered when one of them is block-level
+    tokens = _TOKEN_RE.split(source)
+    out = []
+    for i, token in enumerate(tokens):
+        if token == ' ':
+            before = _html_neighbour(tokens, i, -1)
+            after = _html_neighbour(tokens, i, 1)
+            if before is not None and after is not None and (
+                    before == '' or after == '' or
+                    _tag_name(before) in BLOCK_TAGS or _tag_name(after) in BLOCK_TAGS):
+                continue
+        out.append(token)
+    source = ''.join(out).strip()
+    for i, block in enumerate(preformatted):
+        source = source.replace(f'<pre \x00{i}\x00>', block, 1)
+    return source
+
+
+def compile_newsletter_html(source):
+    return minify_html(inline_css(source))
+
+
+def source_version(source):
+    """Short content hash identifying a compiled template."""
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+
+def compiled_template_names():
+    return tuple(getattr(settings, 'NEWSLETTER_COMPILED_TEMPLATES', DEFAULT_COMPILED_TEMPLATES))
+
+
+# Template loader -------------------------------------------------------
+
+class Loader(FilesystemLoader):
+    """Filesystem loader that compiles the newsletter templates on load.
+
+    Wrap it in django.template.loaders.cached.Loader so compilation happens
+    once per process.
+    """
+
+    def get_contents(self, origin):
+        source = super().get_contents(origin)
+        if not getattr(settings, 'NEWSLETTER_COMPILE_TEMPLATES', True) or origin.template_name not in compiled_template_names():
+            return source
+        compiled = compile_newsletter_html(source)
+        logger.info(
+            f"Compiled {origin.template_name}: {len(source.encode())} -> {len(compiled.encode())} bytes "
+            f"(version {source_version(compiled)})"
+        )
+        return compiled
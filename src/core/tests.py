@@ -1,3 +1,1581 @@
-from django.test import TestCase
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from rest_framework.test import APIClient
+from datetime import date, datetime, timedelta
+from django.utils import timezone
+from django.http import JsonResponse
+from django.template import Context, Template
+from importlib import import_module
+from django.apps import apps
+from django.core.management import call_command
+from pathlib import Path
+from . import analytics, assets, bulk, devices, fastjson, fields, middleware, personalize, progress, providers, render_cache, retention, search, template_compiler, timing, transports, webhooks
+from .models import (BroadcastDailyStat, BroadcastLog, BroadcastPartition, BroadcastTiming, DeliveryEvent, Device,
+                     Emails, Subscriber, SubscriberDailyStat, Suppression)
+from .ratelimit import TokenBucket
+from .sharding import ShardWorker
+from .transports import BalancedTransport, CircuitBreaker, NotSentError, SMTPPoolTransport, TransportError
+from .scheduler import BroadcastDispatcher, Pacer
+from .providers import ProviderError
+from .lanes import LaneScheduler
+import base64
+import decimal
+import gzip
+import uuid
+import zlib
+import http.client
+import io
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class FakeResponse:
+    def __init__(self, status_code=202):
+        self.status_code = status_code
+
+
+class FakeProviderClient:
+    """Stands in for the pooled SendGrid client; `fail(message)` may raise."""
+
+    def __init__(self, fail=None):
+        self.sent = []
+        self.fail = fail
+        self.stats = {}
+
+    def send(self, message):
+        if self.fail is not None:
+            self.fail(message)
+        self.sent.append(message)
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+
+@override_settings(SENDGRID_API_KEY='SG.test', CACHES=LOCMEM_CACHE, BROADCAST_TRANSPORT='sendgrid')
+class BroadcastTestCase(TestCase):
+    """Broadcasts sent through a fake provider client."""
+
+    def setUp(self):
+        self.provider = FakeProviderClient()
+        patcher = mock.patch.dict(providers._clients, {'sendgrid': self.provider})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def broadcast(self, recipients, **extra):
+        body = dict({'subject': 'Hello', 'message': 'Lorem ipsum', 'recipients': recipients}, **extra)
+        return self.client.post('/api/broadcast/send/', body, format='json')
+
+
+class TimingTests(TestCase):
+
+    def test_percentiles_and_merge(self):
+        first, second = timing.BroadcastTimer(), timing.BroadcastTimer()
+        for _ in range(98):
+            first.call(0.010)
+        second.call(0.500)
+        second.call(0.500)
+        second.add('render', 0.25)
+        merged = timing.merge_states([first.state(), second.state(), {}])
+        self.assertEqual(merged['calls'], 100)
+        self.assertAlmostEqual(merged['seconds']['render'], 0.25)
+        result = timing.summary(merged)
+        self.assertAlmostEqual(result['provider_p50_ms'], 10, delta=0.5)
+        self.assertAlmostEqual(result['provider_p99_ms'], 500, delta=25)
+        self.assertEqual(timing.summary(timing.merge_states([]))['provider_p99_ms'], 0)
+
+
+class BroadcastTimingTests(BroadcastTestCase):
+
+    def test_timing_is_stored_and_returned(self):
+        response = self.broadcast(['a@example.com', 'b@example.com', 'c@example.com'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['timing']['provider_calls'], 3)
+        log = BroadcastLog.objects.get(broadcast_id=response.json()['broadcast_id'])
+        self.assertEqual(log.timing.provider_calls, 3)
+
+        history = self.client.get('/api/broadcasts/').json()['results']
+        self.assertEqual(history[0]['timing']['provider_calls'], 3)
+
+    def test_timing_write_failure_does_not_fail_the_broadcast(self):
+        with mock.patch.object(BroadcastTiming.objects, 'update_or_create',
+                               side_effect=OperationalError('database is locked')) as write, \
+                mock.patch('core.timing.time.sleep'), self.assertLogs('core.timing', 'ERROR'):
+            response = self.broadcast(['a@example.com'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'sent')
+        self.assertEqual(write.call_count, timing.SAVE_ATTEMPTS)
+        self.assertEqual(len(self.provider.sent), 1)
+
+
+class PoolTestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(self.path)
+        if self.path == '/drop':
+            # Took the request, then went away without answering
+            self.close_connection = True
+            return
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        # Closes keep-alive connections without saying so
+        self.close_connection = self.server.close_idle
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PoolTestHandler)
+        self.server.received = []
+        self.server.close_idle = False
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.pool = providers.HTTPConnectionPool(f'http://127.0.0.1:{self.server.server_port}', size=2, timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def post(self, path='/send'):
+        return self.pool.request('POST', path, body=b'{}')[0]
+
+    def test_connections_are_reused(self):
+        self.assertEqual([self.post(), self.post()], [202, 202])
+        self.assertEqual((self.pool.stats['connects'], self.pool.stats['reused']), (1, 1))
+
+    def test_connection_closed_by_the_server_is_not_reused(self):
+        self.server.close_idle = True
+        self.post()
+        time.sleep(0.1)
+        self.assertEqual(self.post(), 202)
+        # Seen before writing, not by a failed write
+        self.assertEqual((self.pool.stats['connects'], self.pool.stats['reconnects']), (2, 0))
+        self.assertEqual(self.server.received, ['/send', '/send'])
+
+    def test_request_lost_after_it_was_written_is_not_replayed(self):
+        self.post()
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.post('/drop')
+        self.assertEqual(self.server.received, ['/send', '/drop'])
+        self.assertEqual(self.pool.stats['errors'], 1)
+
+    def test_write_failure_is_retried_only_before_any_byte(self):
+        def stale(conn, written):
+            def request(*args, **kwargs):
+                conn.sent = written
+                raise BrokenPipeError()
+            conn.request = request
+            return conn
+
+        self.post()
+        conn = self.pool._idle.queue[-1][0]
+        stale(conn, written=False)
+        self.assertEqual(self.post(), 202)
+        self.assertEqual(self.pool.stats['reconnects'], 1)
+
+        conn = self.pool._idle.queue[-1][0]
+        stale(conn, written=True)
+        with self.assertRaises(BrokenPipeError):
+            self.post()
+        self.assertEqual(self.server.received, ['/send', '/send'])
+
+    def test_refused_connect_is_raised_as_not_sent(self):
+        port = self.server.server_port
+        self.server.shutdown()
+        self.server.server_close()
+        pool = providers.HTTPConnectionPool(f'http://127.0.0.1:{port}', size=1, timeout=5)
+        with self.assertRaises(providers.RequestNotSent):
+            pool.request('POST', '/send', body=b'{}')
+        self.assertEqual(pool.stats['errors'], 1)
+
+    def test_sendgrid_classes_come_from_the_lazy_loader(self):
+        loaded = (mock.Mock(), mock.Mock(), mock.Mock())
+        with mock.patch.object(providers, '_sendgrid', loaded), mock.patch('core.transports.provider_client'):
+            transport = transports.SendGridTransport()
+        self.assertEqual((transport._mail, transport._custom_arg), loaded[1:])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BROADCAST_PROGRESS_STREAM_INTERVAL=0.01, BROADCAST_PROGRESS_STREAM_TIMEOUT=0.1,
+                   BROADCAST_PROGRESS_STREAM_MAX=1)
+class ProgressStreamTests(TestCase):
+
+    def setUp(self):
+        BroadcastLog.objects.create(broadcast_id='b1', subject='Hi', message='Hello', recipients_count=2)
+        self.snapshot = progress.publish('b1', 2, 1, 0, previous={})
+        self.url = '/api/broadcast/b1/progress/stream/'
+
+    def read(self, response):
+        try:
+            return ''.join(chunk.decode('utf-8') for chunk in response.streaming_content)
+        finally:
+            response.close()
+
+    def test_stream_ends_with_the_broadcast(self):
+        progress.publish('b1', 2, 2, 0, status='sent')
+        body = self.read(self.client.get(self.url))
+        self.assertIn('event: progress', body)
+        self.assertIn('id: 2:', body)
+        self.assertTrue(body.endswith('event: done\ndata: {}\n\n'))
+
+    def test_reconnect_skips_the_snapshot_already_seen(self):
+        event_id = f"{self.snapshot['version']}:{self.snapshot['timestamp']}"
+        body = self.read(self.client.get(self.url, HTTP_LAST_EVENT_ID=event_id))
+        self.assertNotIn('event: progress', body)
+        self.assertTrue(body.endswith('event: timeout\ndata: {}\n\n'))
+        self.assertIn('event: progress', self.read(self.client.get(self.url)))
+
+    def test_open_streams_are_capped(self):
+        first = self.client.get(self.url)
+        second = self.client.get(self.url)
+        self.assertEqual(second.status_code, 503)
+        self.assertEqual(second['Retry-After'], '5')
+        # Closing a stream that was never read frees its slot
+        first.close()
+        third = self.client.get(self.url)
+        self.assertEqual(third.status_code, 200)
+        third.close()
+
+
+class DeviceScopeTests(TestCase):
+
+    def setUp(self):
+        devices.clear_cache()
+        self.addCleanup(devices.clear_cache)
+        self.client = APIClient()
+
+    def test_reads_with_an_unknown_device_are_empty_and_create_nothing(self):
+        Emails.objects.create(subject='Hi', message='x', email='a@example.com')
+        Subscriber.objects.create(email='a@example.com')
+        for path in ['/api/emails/', '/api/subscribers/', '/api/broadcasts/', '/api/analytics/',
+                     '/api/subscribers/search/?q=a', '/api/search/?q=hi']:
+            response = self.client.get(path, HTTP_X_DEVICE_ID='made-up')
+            self.assertEqual(response.status_code, 200, path)
+        self.assertEqual(self.client.get('/api/emails/', HTTP_X_DEVICE_ID='made-up').json(), [])
+        self.assertEqual(self.client.get('/api/subscribers/', HTTP_X_DEVICE_ID='made-up').json(), [])
+        self.assertEqual(len(self.client.get('/api/emails/').json()), 1)
+        self.assertFalse(Device.objects.exists())
+
+    def test_writes_create_the_device(self):
+        response = self.client.post('/api/subscribers/', {'email': 'b@example.com'}, format='json',
+                                    HTTP_X_DEVICE_ID='phone')
+        self.assertEqual(response.status_code, 201)
+        device = Device.objects.get(key='phone')
+        self.assertEqual(Subscriber.objects.get(email='b@example.com').device_id, device.id)
+        listed = self.client.get('/api/subscribers/', HTTP_X_DEVICE_ID='phone').json()
+        self.assertEqual([row['email'] for row in listed], ['b@example.com'])
+
+
+class SubscriberSearchTests(BroadcastTestCase):
+
+    def find(self, query, **params):
+        response = self.client.get('/api/subscribers/search/', dict(params, q=query))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def emails(self, query, **params):
+        return [row['email'] for row in self.find(query, **params)['results']]
+
+    def test_broadcast_recipients_are_searchable(self):
+        self.assertEqual(self.broadcast(['Ann.Lee@Example.COM', 'bob@news.example.com', 'carl@example.org']).status_code, 200)
+        self.assertEqual(self.emails('ANN.L'), ['Ann.Lee@Example.COM'])
+        self.assertEqual(self.emails('@example.com'), ['Ann.Lee@Example.COM', 'bob@news.example.com'])
+
+    def test_bulk_writes_fill_the_lookup_columns(self):
+        Subscriber.objects.bulk_create([Subscriber(email='Dora@Example.com'), Subscriber(email='eve@example.net')])
+        self.assertEqual(self.emails('dora'), ['Dora@Example.com'])
+        eve = Subscriber.objects.get(email='eve@example.net')
+        eve.email = 'Eve@Mail.Example.com'
+        Subscriber.objects.bulk_update([eve], ['email'])
+        self.assertEqual(self.emails('@example.com'), ['Dora@Example.com', 'Eve@Mail.Example.com'])
+        Subscriber.objects.filter(id=eve.id).update(email='eve@example.org')
+        self.assertEqual(self.emails('@example.org'), ['eve@example.org'])
+        self.assertEqual(self.emails('@example.com'), ['Dora@Example.com'])
+
+    def test_prefix_search_pages(self):
+        for email in ('ann@example.com', 'anna@example.org', 'annie@example.net', 'bob@example.com'):
+            Subscriber.objects.create(email=email)
+        Subscriber.objects.filter(email='anna@example.org').update(is_active=False)
+        first = self.find('ann', limit=2)
+        self.assertEqual(([row['email'] for row in first['results']], first['has_more']),
+                         (['ann@example.com', 'anna@example.org'], True))
+        second = self.find('ann', limit=2, after=first['next_after'])
+        self.assertEqual(([row['email'] for row in second['results']], second['has_more'], second['next_after']),
+                         (['annie@example.net'], False, None))
+        self.assertEqual(self.emails('ann', active='false'), ['anna@example.org'])
+
+    def test_domain_search_takes_subdomains_only(self):
+        for email in ('a@example.com', 'b@mail.example.com', 'c@example-x.com', 'd@notexample.com',
+                      'e@example.com.evil.org', 'f@example.co'):
+            Subscriber.objects.create(email=email)
+        self.assertEqual(self.emails('@Example.com'), ['a@example.com', 'b@mail.example.com'])
+        first = self.find('@example.com', limit=1)
+        self.assertEqual(self.emails('@example.com', after=first['next_after']), ['b@mail.example.com'])
+        self.assertEqual(self.client.get('/api/subscribers/search/?q=@').status_code, 400)
+
+
+@override_settings(SUBSCRIBER_BULK_CHUNK_SIZE=2, SUBSCRIBER_BULK_MAX_ITEMS=3)
+class SubscriberBulkTests(TestCase):
+
+    def setUp(self):
+        devices.clear_cache()
+        self.addCleanup(devices.clear_cache)
+        self.client = APIClient()
+        self.phone, self.tablet = Device.objects.create(key='phone'), Device.objects.create(key='tablet')
+        for i in range(3):
+            Subscriber.objects.create(email=f'p{i}@example.com', device=self.phone)
+            Subscriber.objects.create(email=f't{i}@example.com', device=self.tablet)
+        Subscriber.objects.create(email='other@example.org', device=self.phone)
+
+    def bulk(self, body, **headers):
+        return self.client.post('/api/subscribers/bulk/', body, format='json', **headers)
+
+    def rollups(self):
+        return {row.device_id: (row.reactivated, row.deactivated) for row in SubscriberDailyStat.objects.all()}
+
+    def test_filter_is_processed_in_keyset_chunks_up_to_max_items(self):
+        body = {'action': 'deactivate', 'filter': {'domain': 'example.com'}}
+        with CaptureQueriesContext(connection) as queries:
+            result = bulk.apply('deactivate', Subscriber.objects.all(), filters=body['filter'], limit=4)
+        self.assertEqual((result['matched'], result['changed'], result['has_more']), (4, 4, True))
+        # One chunk of ids at a time, each with one SELECT and one UPDATE
+        statements = [query['sql'].split()[0] for query in queries if 'core_subscriber"' in query['sql']]
+        self.assertEqual(statements, ['SELECT', 'UPDATE', 'SELECT', 'UPDATE'])
+        Subscriber.objects.filter(domain_reversed__startswith='com.example').update(is_active=True)
+        SubscriberDailyStat.objects.all().delete()
+
+        first = self.bulk(body).json()
+        self.assertEqual((first['matched'], first['changed'], first['has_more']), (3, 3, True))
+        body['filter']['after'] = first['next_after']
+        second = self.bulk(body).json()
+        self.assertEqual((second['matched'], second['changed'], second['has_more'], second['next_after']),
+                         (3, 3, False, None))
+        self.assertFalse(Subscriber.objects.filter(email__endswith='@example.com', is_active=True).exists())
+        self.assertTrue(Subscriber.objects.get(email='other@example.org').is_active)
+        self.assertEqual(self.rollups(), {self.phone.id: (0, 3), self.tablet.id: (0, 3)})
+
+    def test_filter_only_by_creation_date_is_capped(self):
+        response = self.bulk({'action': 'delete', 'filter': {'created_before': timezone.now().isoformat()}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['matched'], response.json()['has_more']), (3, True))
+        self.assertEqual(Subscriber.objects.count(), 4)
+
+    def test_ids_and_emails(self):
+        ids = list(Subscriber.objects.filter(device=self.phone).order_by('id').values_list('id', flat=True))[:3]
+        self.bulk({'action': 'deactivate', 'ids': ids[:2]})
+        SubscriberDailyStat.objects.all().delete()
+
+        result = self.bulk({'action': 'activate', 'emails': ['P0@Example.com', 't0@example.com', 'gone@example.com']},
+                           HTTP_X_DEVICE_ID='phone').json()
+        # Scoped to the device: the tablet's subscriber is not found
+        self.assertEqual((result['requested'], result['matched'], result['changed']), (3, 1, 1))
+        self.assertEqual(result['not_found_sample'], ['t0@example.com', 'gone@example.com'])
+        self.assertEqual(self.rollups(), {self.phone.id: (1, 0)})
+
+        result = self.bulk({'action': 'delete', 'ids': ids, 'dry_run': True}).json()
+        self.assertEqual((result['matched'], result['changed'], result['dry_run']), (3, 3, True))
+        self.assertEqual(Subscriber.objects.count(), 7)
+
+        result = self.bulk({'action': 'delete', 'ids': ids}).json()
+        self.assertEqual((result['changed'], Subscriber.objects.count()), (3, 4))
+        # Only the subscriber still active when deleted counts as deactivated
+        self.assertEqual(self.rollups(), {self.phone.id: (1, 2)})
+
+    def test_validation(self):
+        self.assertEqual(self.bulk({'action': 'delete', 'ids': [1, 2, 3, 4]}).status_code, 400)
+        self.assertEqual(self.bulk({'action': 'delete', 'ids': [1], 'emails': ['a@example.com']}).status_code, 400)
+        self.assertEqual(self.bulk({'action': 'delete', 'filter': {'is_active': True}}).status_code, 400)
+        self.assertEqual(Subscriber.objects.count(), 7)
+
+
+@override_settings(NEWSLETTER_IMAGES={'logo': 'https://cdn.example.com/logo.png', 'banner': 'https://cdn.example.com/banner.png'},
+                   INSTAGRAM_ICON_URL='https://cdn.example.com/instagram.png', NEWSLETTER_ASSET_BASE_URL='')
+class ImageURLTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.images = Path(directory.name)
+        self.manifest = self.images / 'dist' / 'manifest.json'
+        patcher = mock.patch.object(assets, 'MANIFEST_PATH', self.manifest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        assets.image_urls.cache_clear()
+        self.addCleanup(assets.image_urls.cache_clear)
+
+    def test_configured_urls_without_a_manifest(self):
+        urls = assets.image_urls()
+        self.assertEqual(urls['logo'], 'https://cdn.example.com/logo.png')
+        self.assertEqual(urls['banner'], 'https://cdn.example.com/banner.png')
+        # Falls back to the <KEY>_ICON_URL setting, then to ''
+        self.assertEqual(urls['instagram'], 'https://cdn.example.com/instagram.png')
+        self.assertEqual(urls['tiktok'], '')
+
+    def test_optimized_images_are_served_from_hashed_paths(self):
+        from PIL import Image
+
+        Image.new('RGB', (400, 200), 'white').save(self.images / 'logo.png')
+        command = import_module('core.management.commands.optimize_images')
+        with mock.patch.multiple(command, IMAGES_DIR=self.images, OPTIMIZED_DIR=self.images / 'dist',
+                                 MANIFEST_PATH=self.manifest, NEWSLETTER_IMAGE_SOURCES={'logo': ('logo.png', 180, 180)}):
+            call_command('optimize_images', stdout=io.StringIO(), stderr=io.StringIO())
+        path = json.loads(self.manifest.read_text())['images']['logo']
+        self.assertRegex(path, r'^images/dist/logo\.[0-9a-f]{12}\.(png|jpg)$')
+        with Image.open(self.images / path.split('/', 1)[1]) as image:
+            self.assertLessEqual(max(image.size), 180)
+
+        # The manifest is only used with a public origin to serve it from
+        self.assertEqual(assets.image_urls()['logo'], 'https://cdn.example.com/logo.png')
+        assets.image_urls.cache_clear()
+        with self.settings(NEWSLETTER_ASSET_BASE_URL='https://news.example.com/'):
+            urls = assets.image_urls()
+        self.assertEqual(urls['logo'], f'https://news.example.com/static/{path}')
+        # Images missing from the manifest keep their configured URL
+        self.assertEqual(urls['banner'], 'https://cdn.example.com/banner.png')
+
+    def test_unreadable_manifest_is_ignored(self):
+        self.manifest.parent.mkdir()
+        self.manifest.write_text('{not json')
+        with self.settings(NEWSLETTER_ASSET_BASE_URL='https://news.example.com'):
+            self.assertEqual(assets.image_urls()['logo'], 'https://cdn.example.com/logo.png')
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        devices.clear_cache()
+        self.addCleanup(devices.clear_cache)
+        self.client = APIClient()
+
+    def email(self, subject, title, content, device=None):
+        return Emails.objects.create(subject=subject, message=json.dumps({'title': title, 'content': content}),
+                                     email='a@example.com', device=device)
+
+    def indexed(self, email):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT title, content FROM {search.FTS_TABLE} WHERE rowid = %s', [search._rowid('email', email.id)])
+            return cursor.fetchone()
+
+    def test_rows_are_indexed_without_markup(self):
+        email = self.email('Spring news', '<b>Spring</b> sale', '<p class="lead">Tulips &amp; roses</p>')
+        self.assertEqual(self.indexed(email), ('Spring sale', 'Tulips &amp; roses'))
+        # Markup is not searchable; the last word matches as a prefix
+        self.assertEqual(search.search('lead')[0], [])
+        results, has_more = search.search('tulip ros')
+        self.assertEqual(([result['id'] for result in results], has_more), ([email.id], False))
+
+        email_id = email.id
+        email.delete()
+        email.id = email_id
+        self.assertIsNone(self.indexed(email))
+        self.assertEqual(search.search('tulips')[0], [])
+
+    def test_saves_of_other_columns_are_not_reindexed(self):
+        email = self.email('Spring news', 'Spring', 'Tulips')
+        with mock.patch.object(search, 'index_object') as index:
+            email.email = 'b@example.com'
+            email.save(update_fields=['email'])
+            index.assert_not_called()
+            email.save(update_fields=['device'])
+            email.save(update_fields=['subject'])
+            self.assertEqual(index.call_count, 2)
+
+    def test_availability_is_cached(self):
+        search.clear_cache()
+        self.assertTrue(search.fts_available())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(search.fts_available())
+            self.email('Spring news', 'Spring', 'Tulips')
+        self.assertFalse([query for query in queries if 'sqlite_master' in query['sql']])
+        with self.assertNumQueries(1):
+            search.clear_cache()
+            search.fts_available()
+
+    def test_reindex_migration_strips_markup(self):
+        email = self.email('Spring news', 'Spring', '<p>Tulips</p>')
+        with connection.cursor() as cursor:
+            # As backfilled by migration 0008
+            cursor.execute(f'UPDATE {search.FTS_TABLE} SET content = %s WHERE rowid = %s',
+                           ['<p>Tulips</p>', search._rowid('email', email.id)])
+        migration = import_module('core.migrations.0019_reindex_search')
+        migration.reindex(apps, mock.Mock(connection=connection))
+        self.assertEqual(self.indexed(email), ('Spring', 'Tulips'))
+
+    def test_endpoint_is_scoped_to_the_device(self):
+        phone = Device.objects.create(key='phone')
+        mine = self.email('Spring news', 'Spring', 'Tulips', device=phone)
+        self.email('Autumn news', 'Autumn', 'Tulips')
+        response = self.client.get('/api/search/?q=tulips', HTTP_X_DEVICE_ID='phone')
+        self.assertEqual([(row['id'], row['device_id']) for row in response.json()['results']], [(mine.id, 'phone')])
+        self.assertEqual(len(self.client.get('/api/search/?q=tulips').json()['results']), 2)
+        self.assertEqual(self.client.get('/api/search/?q=tulips&type=nope').status_code, 400)
+
+
+class BroadcastHistoryTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        now = timezone.now()
+        # Three broadcasts share a created_at, so pages must break ties on id
+        moments = [now, now - timedelta(minutes=1), now - timedelta(minutes=1), now - timedelta(minutes=1),
+                   now - timedelta(minutes=2)]
+        for index, moment in enumerate(moments):
+            log = BroadcastLog.objects.create(broadcast_id=f'b{index}', subject=f'Broadcast {index}', message='Body',
+                                              status='sent', payload='{"recipients": ["a@example.com"]}')
+            BroadcastLog.objects.filter(id=log.id).update(created_at=moment)
+        self.expected = list(BroadcastLog.objects.order_by('-created_at', '-id').values_list('broadcast_id', flat=True))
+
+    def page(self, **params):
+        response = self.client.get('/api/broadcasts/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_walk_ties_on_created_at(self):
+        seen, cursor = [], None
+        for _ in range(3):
+            page = self.page(limit=2, **({'cursor': cursor} if cursor else {}))
+            seen += [row['broadcast_id'] for row in page['results']]
+            cursor = page['next_cursor']
+            self.assertEqual(page['has_more'], cursor is not None)
+        self.assertIsNone(cursor)
+        self.assertEqual(seen, self.expected)
+        # The tie spans the first page boundary
+        self.assertEqual(self.expected[1:4], ['b3', 'b2', 'b1'])
+
+    def test_invalid_cursors(self):
+        for cursor in ('!!!', base64.urlsafe_b64encode(b'garbage').decode(),
+                       base64.urlsafe_b64encode(b'2026-01-01T00:00:00|x').decode(),
+                       base64.urlsafe_b64encode(b'yesterday|1').decode(), '%FF'):
+            response = self.client.get('/api/broadcasts/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.page(limit=0)['results']), 1)
+        self.assertEqual(len(self.page(limit=-5)['results']), 1)
+        with mock.patch('core.utils.HISTORY_MAX_PAGE_SIZE', 3):
+            self.assertEqual(len(self.page(limit=1000)['results']), 3)
+        self.assertEqual(self.client.get('/api/broadcasts/', {'limit': 'ten'}).status_code, 400)
+
+    def test_list_leaves_out_the_body_and_payload(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.page()['results']
+        self.assertEqual(len(rows), 5)
+        self.assertNotIn('message', rows[0])
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('"core_broadcastlog"."message"', sql)
+        self.assertNotIn('"core_broadcastlog"."payload"', sql)
+        self.assertNotIn('request_state', sql)
+
+    def test_detail_defers_the_payload(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/broadcasts/b0/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['message'], 'Body')
+        self.assertNotIn('payload', response.json())
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertIn('"core_broadcastlog"."message"', sql)
+        self.assertNotIn('"core_broadcastlog"."payload"', sql)
+        self.assertEqual(self.client.get('/api/broadcasts/missing/').status_code, 404)
+
+
+TEMPLATE_SOURCES = {'newsletter.html': '<h1>{{ title }}</h1>'}
+
+
+def render_entry(key, size):
+    return {'key': key, 'size': size}
+
+
+class RenderCacheTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(render_cache, '_cache', render_cache.RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lru_is_bounded_by_entries_and_bytes(self):
+        cache = render_cache.RenderCache(max_entries=2, max_bytes=100)
+        cache.put('a', render_entry('a', 10))
+        cache.put('b', render_entry('b', 10))
+        cache.get('a')
+        cache.put('c', render_entry('c', 10))
+        # 'b' was the least recently used
+        self.assertIsNone(cache.peek('b'))
+        self.assertEqual([cache.peek(key)['key'] for key in ('a', 'c')], ['a', 'c'])
+
+        cache.put('d', render_entry('d', 95))
+        self.assertEqual((cache.stats['entries'], cache.stats['bytes']), (1, 95))
+        cache.put('e', render_entry('e', 101))
+        self.assertIsNone(cache.peek('e'))
+        self.assertEqual(cache.stats['evictions'], 3)
+
+    @override_settings(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                                   'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', TEMPLATE_SOURCES)]}}])
+    def test_key_follows_template_source_and_context(self):
+        self.addCleanup(TEMPLATE_SOURCES.update, {'newsletter.html': TEMPLATE_SOURCES['newsletter.html']})
+        first = render_cache.render_newsletter('newsletter.html', {'title': 'Spring'})
+        self.assertEqual((first['html'], first['cached']), ('<h1>Spring</h1>', False))
+        # Equivalent context (whitespace, Unicode normal form) hits the same entry
+        again = render_cache.render_newsletter('newsletter.html', {'title': ' Spring\r\n'})
+        self.assertEqual((again['key'], again['cached']), (first['key'], True))
+
+        TEMPLATE_SOURCES['newsletter.html'] = '<h2>{{ title }}</h2>'
+        edited = render_cache.render_newsletter('newsletter.html', {'title': 'Spring'})
+        self.assertNotEqual((edited['key'], edited['version']), (first['key'], first['version']))
+        self.assertEqual((edited['html'], edited['cached']), ('<h2>Spring</h2>', False))
+
+
+@override_settings(MERGE_TAG_DEFAULTS={})
+class PreviewTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(render_cache, '_cache', render_cache.RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.body = {'subject': 'Hi {{first_name|default:"there"}}',
+                     'message': json.dumps({'title': 'Spring sale', 'content': 'Hello {{first_name}}!'})}
+
+    def test_preview_is_cached_and_personalised(self):
+        Subscriber.objects.create(email='ann@example.com', fields={'first_name': 'Ann & Co'})
+        response = self.client.post('/api/broadcast/preview/', self.body, format='json')
+        self.assertEqual(response.status_code, 200)
+        first = response.json()
+        self.assertEqual((first['subject'], first['cached']), ('Hi there', False))
+        self.assertEqual(first['merge_fields'], ['first_name', 'unsubscribe_url'])
+        self.assertIn('Spring sale', first['html'])
+        self.assertIn('Hello !', first['html'])
+
+        response = self.client.post('/api/broadcast/preview/?email=ann@example.com', self.body, format='json')
+        personal = response.json()
+        self.assertEqual((personal['render_key'], personal['cached']), (first['render_key'], True))
+        self.assertEqual(personal['subject'], 'Hi Ann & Co')
+        self.assertIn('Hello Ann &amp; Co!', personal['html'])
+        self.assertIn('Hello Ann & Co!', personal['text'])
+
+        response = self.client.get(f'/api/broadcast/preview/{first["render_key"]}/?html=1&email=ann@example.com')
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(response.content.decode(), personal['html'])
+
+    def test_missing_fields_and_keys(self):
+        self.assertEqual(self.client.post('/api/broadcast/preview/', {'subject': 'Hi'}, format='json').status_code, 400)
+        self.assertEqual(self.client.get('/api/broadcast/preview/0123abc/').status_code, 404)
+
+
+@override_settings(REQUEST_DECOMPRESSION={'paths': ['/api/subscribers/bulk/'], 'max_bytes': 2048})
+class CompressionMiddlewareTests(TestCase):
+
+    def setUp(self):
+        # Middleware options are read when the client's handler loads it
+        self.client = APIClient()
+
+    def post(self, path, body, encoding):
+        return self.client.post(path, body, content_type='application/json', HTTP_CONTENT_ENCODING=encoding)
+
+    def test_inflate_is_capped(self):
+        data = b'x' * 3000
+        self.assertEqual(middleware.inflate(gzip.compress(data), 'gzip', 3000), data)
+        self.assertEqual(middleware.inflate(zlib.compress(data), 'deflate', 3000), data)
+        with self.assertRaisesRegex(middleware.InflateError, 'more than 2999 bytes'):
+            middleware.inflate(gzip.compress(data), 'gzip', 2999)
+        with self.assertRaisesRegex(middleware.InflateError, 'Truncated'):
+            middleware.inflate(gzip.compress(data)[:-12], 'gzip', 3000)
+        with self.assertRaisesRegex(middleware.InflateError, 'Invalid deflate'):
+            middleware.inflate(b'not deflate', 'deflate', 3000)
+
+    def test_compressed_request_bodies(self):
+        Subscriber.objects.create(email='a@example.com')
+        body = json.dumps({'action': 'deactivate', 'emails': ['a@example.com']}).encode()
+        response = self.post('/api/subscribers/bulk/', gzip.compress(body), 'gzip')
+        self.assertEqual((response.status_code, response.json()['changed']), (200, 1))
+
+        bomb = json.dumps({'action': 'deactivate', 'emails': ['a@example.com' + ' ' * 4000]}).encode()
+        response = self.post('/api/subscribers/bulk/', gzip.compress(bomb), 'gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('more than 2048 bytes', response.json()['error'])
+
+    def test_other_paths_and_encodings_are_refused(self):
+        body = gzip.compress(json.dumps({'email': 'a@example.com'}).encode())
+        self.assertEqual(self.post('/api/subscribers/', body, 'gzip').status_code, 415)
+        self.assertEqual(self.post('/api/subscribers/bulk/', body, 'br').status_code, 415)
+        self.assertFalse(Subscriber.objects.exists())
+
+    def test_large_json_responses_are_compressed_but_not_the_browsable_api(self):
+        response = self.client.get('/api/', HTTP_ACCEPT='application/json', HTTP_ACCEPT_ENCODING='gzip;q=1, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertIsInstance(json.loads(gzip.decompress(response.content)), list)
+
+        response = self.client.get('/api/', HTTP_ACCEPT='text/html', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertGreater(len(response.content), 1024)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        response = self.client.get('/api/', HTTP_ACCEPT='application/json', HTTP_ACCEPT_ENCODING='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_compressed_responses_get_a_weak_etag(self):
+        def view(request):
+            response = JsonResponse({'items': ['item'] * 500})
+            response['ETag'] = '"abc"'
+            return response
+
+        compress = middleware.ResponseCompressionMiddleware(view)
+        response = compress(RequestFactory().get('/api/items/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual((response['Content-Encoding'], response['ETag']), ('gzip', 'W/"abc"'))
+        # Outside the API prefixes nothing changes
+        response = compress(RequestFactory().get('/admin/items/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual((response.has_header('Content-Encoding'), response['ETag']), (False, '"abc"'))
+
+
+class FastJSONTests(TestCase):
+
+    def test_output_matches_drf(self):
+        from rest_framework.renderers import JSONRenderer
+
+        data = {
+            'created_at': datetime.fromisoformat('2026-03-01T12:30:05.123456+02:00'),
+            'naive': datetime(2026, 3, 1, 12, 30),
+            'day': date(2026, 3, 1),
+            'amount': decimal.Decimal('1.50'),
+            'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'text': 'line\u2028separator\u2029paragraph “quoted” é',
+            'nested': [{'a': None, 'b': True, 'c': 1.5}],
+        }
+        self.assertEqual(fastjson.FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertIn(b'\\u2028', fastjson.FastJSONRenderer().render(data))
+        self.assertEqual(fastjson.FastJSONRenderer().render(None), b'')
+
+    def test_parser_matches_drf(self):
+        from rest_framework.exceptions import ParseError
+        from rest_framework.parsers import JSONParser
+
+        body = json.dumps({'emails': ['ä@example.com'], 'count': 2}).encode()
+        self.assertEqual(fastjson.FastJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body)))
+        with self.assertRaises(ParseError):
+            fastjson.FastJSONParser().parse(io.BytesIO(b'{"emails": '))
+
+
+class TokenBucketTests(TestCase):
+
+    def bucket(self, rate, burst=None):
+        self.now = 1000.0
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'ratelimit.sqlite3')
+        return TokenBucket('test', rate, burst, reserve={'transactional': 0.0, 'bulk': 0.2}, path=path,
+                           clock=lambda: self.now)
+
+    def test_bulk_leaves_the_reserve_to_transactional_sends(self):
+        bucket = self.bucket(rate=10)
+        for _ in range(8):
+            self.assertEqual(bucket.try_acquire(priority='bulk'), 0)
+        # 2 tokens left: the bulk reserve
+        self.assertAlmostEqual(bucket.try_acquire(priority='bulk'), 0.1)
+        self.assertEqual(bucket.try_acquire(priority='transactional'), 0)
+        self.assertEqual(bucket.try_acquire(priority='transactional'), 0)
+        self.assertAlmostEqual(bucket.try_acquire(priority='transactional'), 0.1)
+        self.now += 0.35
+        self.assertEqual(bucket.try_acquire(priority='bulk'), 0)
+
+    def test_small_burst_does_not_starve_bulk(self):
+        bucket = self.bucket(rate=1, burst=1)
+        self.assertEqual(bucket.floor('bulk'), 0)
+        self.assertEqual(bucket.try_acquire(priority='bulk'), 0)
+        self.assertAlmostEqual(bucket.try_acquire(priority='bulk'), 1.0)
+        self.now += 1
+        self.assertEqual(bucket.try_acquire(priority='bulk'), 0)
+        # A larger burst keeps its full reserve
+        self.assertAlmostEqual(self.bucket(rate=1, burst=1.2).floor('bulk'), 0.2)
+        self.assertAlmostEqual(self.bucket(rate=10).floor('bulk'), 2.0)
+
+
+class CompressedTextTests(TestCase):
+
+    def stored(self, instance):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT message FROM {Emails._meta.db_table} WHERE id = %s', [instance.id])
+            return cursor.fetchone()[0]
+
+    def test_compressed_bodies_read_back(self):
+        body = 'Lorem ipsum dolor sit amet. ' * 40
+        email = Emails.objects.create(subject='Hi', message=body, email='a@example.com')
+        rows, _, _ = retention.compress_bodies(Emails, timezone.now() + timedelta(days=1))
+        self.assertEqual(rows, 1)
+        self.assertTrue(self.stored(email).startswith(fields.COMPRESSED_PREFIX))
+        self.assertEqual(Emails.objects.get(id=email.id).message, body)
+
+    def test_escaped_bodies_are_compressed(self):
+        body = '\x01' + 'Lorem ipsum dolor sit amet. ' * 40
+        email = Emails.objects.create(subject='Hi', message=body, email='a@example.com')
+        self.assertTrue(self.stored(email).startswith(fields.ESCAPED_PREFIX))
+        rows, _, _ = retention.compress_bodies(Emails, timezone.now() + timedelta(days=1))
+        self.assertEqual(rows, 1)
+        self.assertTrue(self.stored(email).startswith(fields.COMPRESSED_PREFIX))
+        self.assertEqual(Emails.objects.get(id=email.id).message, body)
+
+    def test_plain_text_cannot_pass_for_compressed(self):
+        for body in ['zlib:not base64!', 'zlib:' + fields.compress_text('forged')[len(fields.COMPRESSED_PREFIX):],
+                     fields.compress_text('forged'), fields.ESCAPED_PREFIX + 'x', '\x01']:
+            email = Emails.objects.create(subject='Hi', message=str(body), email='a@example.com')
+            self.assertEqual(Emails.objects.get(id=email.id).message, str(body))
+
+    def test_undecodable_values_are_returned_raw(self):
+        email = Emails.objects.create(subject='Hi', message='x', email='a@example.com')
+        broken = fields.CompressedText(fields.COMPRESSED_PREFIX + 'bm90IHpsaWI=')
+        Emails.objects.filter(id=email.id).update(message=broken)
+        self.assertEqual(Emails.objects.get(id=email.id).message, broken)
+
+    def test_legacy_prefix_migration(self):
+        migration = import_module('core.migrations.0017_compressed_text_prefix')
+        legacy = Emails.objects.create(subject='Hi', message='x', email='a@example.com')
+        Emails.objects.filter(id=legacy.id).update(
+            message=fields.CompressedText('zlib:' + fields.compress_text('old body')[len(fields.COMPRESSED_PREFIX):]))
+        plain = Emails.objects.create(subject='Hi', message='zlib: is a library', email='a@example.com')
+        migration.move_to_marked_prefix(apps, None)
+        self.assertEqual(Emails.objects.get(id=legacy.id).message, 'old body')
+        self.assertEqual(Emails.objects.get(id=plain.id).message, 'zlib: is a library')
+
+
+class AnalyticsTests(TestCase):
+
+    def test_subscriber_series_adds_up_devices(self):
+        first, second = Device.objects.create(key='one'), Device.objects.create(key='two')
+        analytics.record_subscribers(first.id, added=3)
+        analytics.record_subscribers(second.id, added=2, deactivated=1)
+        analytics.record_subscribers(None, added=1)
+        analytics.record_subscribers(None, reactivated=1)
+        self.assertEqual(SubscriberDailyStat.objects.filter(device__isnull=True).count(), 1)
+
+        today = timezone.localdate()
+        series = analytics.subscriber_series(*analytics.date_range(2))
+        self.assertEqual(series[0], {'date': (today - timedelta(days=1)).isoformat(), 'added': 0, 'reactivated': 0,
+                                     'deactivated': 0, 'net': 0, 'active': 0})
+        self.assertEqual(series[1], {'date': today.isoformat(), 'added': 6, 'reactivated': 1, 'deactivated': 1,
+                                     'net': 6, 'active': 6})
+        self.assertEqual(analytics.subscriber_series(today, today, device_id=second.id)[0]['active'], 1)
+
+        # Earlier days count towards the running total
+        self.assertEqual(analytics.subscriber_series(today + timedelta(days=1), today + timedelta(days=1))[0]['active'], 6)
+
+    def test_null_device_rows_are_unique(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SubscriberDailyStat.objects.bulk_create([SubscriberDailyStat(day=timezone.localdate()),
+                                                     SubscriberDailyStat(day=timezone.localdate())])
+        log = BroadcastLog(broadcast_id='b1', status='sent', recipients_count=2, sent_count=2,
+                           created_at=timezone.now())
+        analytics.record_broadcast(log)
+        analytics.record_broadcast(log)
+        row = BroadcastDailyStat.objects.get()
+        self.assertEqual((row.broadcasts, row.sent), (2, 4))
+
+
+class ShardWorkerTests(BroadcastTestCase):
+
+    def start(self, count=4, shard_size=2):
+        response = self.broadcast([f'user{i}@example.com' for i in range(count)], shardSize=shard_size)
+        self.assertEqual(response.status_code, 202)
+        return BroadcastLog.objects.get(broadcast_id=response.json()['broadcast_id'])
+
+    def worker(self, name):
+        return ShardWorker(owner=name, lease_seconds=60, batch_size=1, idle_seconds=0)
+
+    def test_partitions_are_sent_and_rolled_up(self):
+        log = self.start()
+        self.worker('a').run(once=True)
+        log.refresh_from_db()
+        self.assertEqual((log.status, log.sent_count, log.failed_count), ('sent', 4, 0))
+        self.assertEqual(len(self.provider.sent), 4)
+        self.assertEqual(log.timing.provider_calls, 4)
+        self.assertFalse(log.partitions.exclude(status='done').exists())
+
+    def test_expired_lease_is_reclaimed_after_the_reserved_cursor(self):
+        log = self.start(count=3, shard_size=3)
+        first, second = self.worker('a'), self.worker('b')
+        partition = first.claim()
+        self.assertIsNone(second.claim())
+        # `a` reserved the first recipient, then died
+        BroadcastPartition.objects.filter(id=partition.id).update(
+            cursor=1, lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        reclaimed = second.claim()
+        self.assertEqual((reclaimed.id, reclaimed.attempts, reclaimed.lease_owner), (partition.id, 2, 'b'))
+        self.assertFalse(first.renew(partition.id))
+        second.process(reclaimed)
+
+        log.refresh_from_db()
+        self.assertEqual(len(self.provider.sent), 2)
+        # The reserved but unconfirmed recipient counts as failed, and is not resent
+        self.assertEqual((log.status, log.sent_count, log.failed_count), ('partial', 2, 1))
+
+    def test_transport_failure_releases_only_the_partition(self):
+        log = self.start()
+        worker = self.worker('a')
+        partition = worker.claim()
+        sibling = BroadcastPartition.objects.exclude(id=partition.id).get()
+        with mock.patch('core.sharding.create_transport', side_effect=TransportError('not configured')), \
+                self.assertLogs('core.sharding', 'ERROR'):
+            self.assertFalse(worker.process(partition))
+
+        partition.refresh_from_db()
+        self.assertEqual((partition.status, partition.lease_owner, partition.lease_expires_at), ('pending', '', None))
+        sibling.refresh_from_db()
+        self.assertEqual(sibling.status, 'pending')
+        log.refresh_from_db()
+        self.assertEqual(log.status, 'pending')
+
+        # A healthy worker sends it later
+        self.worker('b').run(once=True)
+        log.refresh_from_db()
+        self.assertEqual((log.status, log.sent_count), ('sent', 4))
+
+    def test_partition_is_failed_after_max_attempts(self):
+        log = self.start()
+        worker = ShardWorker(owner='a', lease_seconds=60, batch_size=1, idle_seconds=0, max_attempts=2)
+        partition = worker.claim()
+        with mock.patch('core.sharding.create_transport', side_effect=TransportError('not configured')), \
+                self.assertLogs('core.sharding', 'ERROR'):
+            self.assertFalse(worker.process(partition))
+            self.assertFalse(worker.process(worker.claim()))
+            # The third claim gives up without trying again
+            with mock.patch.object(worker, 'release') as release:
+                self.assertTrue(worker.process(worker.claim()))
+            release.assert_not_called()
+
+        partition.refresh_from_db()
+        self.assertEqual((partition.status, partition.attempts, partition.failed_count), ('failed', 3, 2))
+        worker.run(once=True)
+        log.refresh_from_db()
+        self.assertEqual((log.status, log.sent_count, log.failed_count), ('partial', 2, 2))
+
+    def test_partition_crashing_its_workers_is_failed(self):
+        log = self.start(count=2, shard_size=2)
+        partition = self.worker('a').claim()
+        # The worker reserved and sent the first recipient, then crashed
+        BroadcastPartition.objects.filter(id=partition.id).update(
+            cursor=1, sent_count=1, lease_expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertLogs('core.sharding', 'ERROR'):
+            ShardWorker(owner='b', lease_seconds=60, batch_size=1, idle_seconds=0, max_attempts=1).run(once=True)
+
+        log.refresh_from_db()
+        self.assertEqual(self.provider.sent, [])
+        self.assertEqual((log.status, log.sent_count, log.failed_count), ('partial', 1, 1))
+        self.assertEqual(log.partitions.get().status, 'failed')
+
+
+WEBHOOK_KEY = ec.generate_private_key(ec.SECP256R1())
+WEBHOOK_PUBLIC_KEY = base64.b64encode(WEBHOOK_KEY.public_key().public_bytes(
+    serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).decode('ascii')
+WEBHOOK_OPTIONS = {'public_key': WEBHOOK_PUBLIC_KEY, 'flush_interval': 0}
+
+
+def webhook_event(event, email, event_id, **extra):
+    return dict({'event': event, 'email': email, 'timestamp': 1700000000, 'sg_event_id': event_id}, **extra)
+
+
+@override_settings(WEBHOOK_EVENTS=WEBHOOK_OPTIONS)
+class WebhookTests(TestCase):
+
+    def setUp(self):
+        # Buffers are built from the settings of their first request
+        patcher = mock.patch.object(webhooks, '_buffer', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def post(self, payload, timestamp=None, key=WEBHOOK_KEY, signature=None, path='/api/webhooks/sendgrid/'):
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(time.time()) if timestamp is None else timestamp)
+        if signature is None:
+            signature = base64.b64encode(key.sign(timestamp.encode('ascii') + body, ec.ECDSA(hashes.SHA256())))
+        return self.client.post(path, body, content_type='application/json',
+                                HTTP_X_TWILIO_EMAIL_EVENT_WEBHOOK_SIGNATURE=signature,
+                                HTTP_X_TWILIO_EMAIL_EVENT_WEBHOOK_TIMESTAMP=timestamp)
+
+    def test_signed_events_are_accepted(self):
+        response = self.post([webhook_event('delivered', 'a@example.com', 'e1'), {'event': 'nope'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual(response.json()['rejected'], 1)
+        self.assertTrue(DeliveryEvent.objects.filter(event_id='e1').exists())
+
+    def test_bad_missing_or_stale_signatures_are_refused(self):
+        payload = [webhook_event('bounce', 'a@example.com', 'e1')]
+        self.assertEqual(self.post(payload, key=ec.generate_private_key(ec.SECP256R1())).status_code, 403)
+        self.assertEqual(self.post(payload, signature='bm90IGEgc2lnbmF0dXJl').status_code, 403)
+        self.assertEqual(self.client.post('/api/webhooks/sendgrid/', payload, format='json').status_code, 403)
+        self.assertEqual(self.post(payload, timestamp=int(time.time()) - 3600).status_code, 403)
+        self.assertFalse(DeliveryEvent.objects.exists())
+
+    @override_settings(WEBHOOK_EVENTS={'flush_interval': 0})
+    def test_unconfigured_webhook_is_refused(self):
+        with self.assertLogs('core.webhooks', 'ERROR'):
+            response = self.post([webhook_event('spamreport', 'a@example.com', 'e1')])
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Suppression.objects.exists())
+
+    @override_settings(WEBHOOK_EVENTS={'token': 'secret', 'flush_interval': 0})
+    def test_token_fallback(self):
+        payload = [webhook_event('delivered', 'a@example.com', 'e1')]
+        self.assertEqual(self.client.post('/api/webhooks/sendgrid/?token=wrong', payload, format='json').status_code, 403)
+        self.assertEqual(self.client.post('/api/webhooks/sendgrid/?token=secret', payload, format='json').status_code, 200)
+
+    def test_replayed_events_are_stored_once(self):
+        log = BroadcastLog.objects.create(broadcast_id='b1', subject='Hi', message='Hello', status='sent')
+        payload = [webhook_event('delivered', 'a@example.com', 'e1', broadcast_id='b1'),
+                   webhook_event('delivered', 'b@example.com', 'e2', broadcast_id='b1')]
+        self.post(payload)
+        self.post(payload)
+        self.assertEqual(DeliveryEvent.objects.count(), 2)
+        log.refresh_from_db()
+        self.assertEqual(log.delivered_count, 2)
+
+    def test_suppressing_events(self):
+        Subscriber.objects.create(email='spam@example.com')
+        Subscriber.objects.create(email='soft@example.com')
+        counts = webhooks.write_events(webhooks.parse_events([
+            webhook_event('spamreport', 'Spam@Example.com', 'e1'),
+            webhook_event('bounce', 'soft@example.com', 'e2', type='blocked'),
+        ])[0])
+        self.assertEqual(counts['suppressed'], 1)
+        self.assertEqual(counts['deactivated'], 1)
+        self.assertEqual(list(Suppression.objects.values_list('email', 'reason')), [('spam@example.com', 'spamreport')])
+        self.assertFalse(Subscriber.objects.get(email='spam@example.com').is_active)
+        self.assertTrue(Subscriber.objects.get(email='soft@example.com').is_active)
+        self.assertEqual(webhooks.exclude_suppressed(['a@example.com', 'SPAM@example.com', 'soft@example.com']),
+                         (['a@example.com', 'soft@example.com'], ['SPAM@example.com']))
+
+
+class PacerTests(TestCase):
+
+    def test_interval_is_the_slower_of_rate_and_window(self):
+        self.assertEqual(Pacer(11, rate=2).interval, 0.5)
+        self.assertEqual(Pacer(11, rate=100, window=5).interval, 0.5)
+        self.assertFalse(Pacer(1, window=60).enabled)
+
+    def test_slots_do_not_drift(self):
+        now, sleeps = [100.0], []
+
+        def sleep(seconds):
+            sleeps.append(round(seconds, 6))
+            now[0] += seconds + 0.1  # oversleeps every time
+
+        pacer = Pacer(4, rate=1, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            pacer.wait()
+        # Each slot is due a second after the start, not after the previous wakeup
+        self.assertEqual(sleeps, [1.0, 0.9, 0.9])
+
+
+@override_settings(SENDGRID_API_KEY='SG.test', CACHES=LOCMEM_CACHE)
+class DispatcherTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        for target in ('core.utils.notify_dispatcher', 'core.utils.runBroadcast'):
+            patcher = mock.patch(target, return_value=({'status': 'sent'}, 200))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def dispatcher(self):
+        dispatcher = BroadcastDispatcher(workers=1)
+        self.addCleanup(dispatcher._executor.shutdown)
+        # Run jobs inline
+        dispatcher._executor = mock.Mock(submit=lambda fn, *args: fn(*args))
+        return dispatcher
+
+    def schedule(self, send_at=None, **extra):
+        if send_at is not None:
+            extra['sendAt'] = send_at.isoformat()
+        body = dict({'subject': 'Hello', 'message': 'Lorem ipsum', 'recipients': ['a@example.com', 'b@example.com']},
+                    **extra)
+        response = self.client.post('/api/broadcast/send/', body, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], 'scheduled')
+        return BroadcastLog.objects.get(broadcast_id=response.json()['broadcast_id'])
+
+    def sent(self):
+        from . import utils
+        return [call.kwargs['broadcast_log'].id for call in utils.runBroadcast.call_args_list]
+
+    def test_due_broadcasts_are_sent_in_time_order(self):
+        later = self.schedule(timezone.now() + timedelta(hours=2))
+        sooner = self.schedule(timezone.now() + timedelta(hours=1))
+        dispatcher = self.dispatcher()
+        self.assertEqual(dispatcher.load(full=True), 2)
+        self.assertEqual(dispatcher._heap[0][1], sooner.id)
+        self.assertEqual(dispatcher.dispatch_due(), 0)
+
+        self.assertEqual(dispatcher.dispatch_due(now=sooner.send_at.timestamp()), 1)
+        self.assertEqual(self.sent(), [sooner.id])
+        self.assertEqual(BroadcastLog.objects.get(id=sooner.id).status, 'pending')
+        self.assertEqual(BroadcastLog.objects.get(id=later.id).status, 'scheduled')
+        self.assertEqual(dispatcher.dispatch_due(now=later.send_at.timestamp()), 1)
+        self.assertEqual(self.sent(), [sooner.id, later.id])
+
+    def test_new_jobs_are_loaded_incrementally(self):
+        dispatcher = self.dispatcher()
+        first = self.schedule(timezone.now() + timedelta(minutes=5))
+        self.assertEqual(dispatcher.load(full=True), 1)
+        second = self.schedule(timezone.now() + timedelta(minutes=1))
+        self.assertEqual(dispatcher.load(), 1)
+        self.assertEqual(dispatcher.load(), 0)
+        self.assertEqual([log_id for _, log_id in sorted(dispatcher._heap)], [second.id, first.id])
+
+    def test_a_job_is_claimed_once(self):
+        log = self.schedule(timezone.now() + timedelta(minutes=5))
+        first, second = self.dispatcher(), self.dispatcher()
+        first.load(full=True)
+        second.load(full=True)
+        due = log.send_at.timestamp()
+        self.assertEqual(first.dispatch_due(now=due), 1)
+        self.assertEqual(second.dispatch_due(now=due), 0)
+        self.assertEqual(self.sent(), [log.id])
+
+    def test_postponed_job_goes_back_on_the_heap(self):
+        log = self.schedule(timezone.now() + timedelta(minutes=5))
+        dispatcher = self.dispatcher()
+        dispatcher.load(full=True)
+        later = log.send_at + timedelta(hours=1)
+        BroadcastLog.objects.filter(id=log.id).update(send_at=later)
+        self.assertEqual(dispatcher.dispatch_due(now=log.send_at.timestamp()), 0)
+        self.assertEqual(dispatcher._heap, [(later.timestamp(), log.id)])
+        self.assertEqual(self.sent(), [])
+
+    def test_paced_broadcasts_are_scheduled(self):
+        log = self.schedule(spreadSeconds=10)
+        self.assertEqual(Pacer.for_broadcast(log, 3).interval, 5)
+        dispatcher = self.dispatcher()
+        dispatcher.load(full=True)
+        self.assertEqual(dispatcher.dispatch_due(), 1)
+        self.assertEqual(self.sent(), [log.id])
+
+
+class BroadcastPayloadTests(BroadcastTestCase):
+    """BroadcastLog.payload holds the recipients only until they are needed."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('core.utils.notify_dispatcher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def dispatch(self, log):
+        dispatcher = BroadcastDispatcher(workers=1)
+        self.addCleanup(dispatcher._executor.shutdown)
+        dispatcher._executor = mock.Mock(submit=lambda fn, *args: fn(*args))
+        dispatcher.load(full=True)
+        self.assertEqual(dispatcher.dispatch_due(now=log.send_at.timestamp()), 1)
+        log.refresh_from_db()
+        return log
+
+    def schedule(self, **extra):
+        send_at = timezone.now() + timedelta(minutes=5)
+        response = self.broadcast(['a@example.com', 'b@example.com'], sendAt=send_at.isoformat(), **extra)
+        self.assertEqual(response.status_code, 202)
+        log = BroadcastLog.objects.get(broadcast_id=response.json()['broadcast_id'])
+        self.assertEqual(json.loads(log.payload)['recipients'], ['a@example.com', 'b@example.com'])
+        return log
+
+    def test_scheduled_broadcast_clears_the_payload_once_sent(self):
+        log = self.dispatch(self.schedule())
+        self.assertEqual((log.status, log.sent_count, log.payload), ('sent', 2, ''))
+
+    def test_sharded_broadcasts_keep_the_recipients_in_the_partitions_only(self):
+        response = self.broadcast(['a@example.com', 'b@example.com'], shardSize=1)
+        log = BroadcastLog.objects.get(broadcast_id=response.json()['broadcast_id'])
+        self.assertEqual(json.loads(log.payload), {'subject': 'Hello', 'message': 'Lorem ipsum', 'shardSize': 1})
+
+        scheduled = self.dispatch(self.schedule(shardSize=1))
+        self.assertNotIn('recipients', json.loads(scheduled.payload))
+        self.assertEqual(scheduled.partitions.count(), 2)
+
+        ShardWorker(owner='a', lease_seconds=60, batch_size=1, idle_seconds=0).run(once=True)
+        for log in (log, scheduled):
+            log.refresh_from_db()
+            self.assertEqual((log.status, log.payload), ('sent', ''))
+
+
+class MergeTemplateTests(TestCase):
+
+    def test_values_are_escaped_in_the_html_part_only(self):
+        merge = personalize.compile_message('Hi {{first_name}}', '<p>Hi {{first_name}}</p>', 'Hi {{first_name}}')
+        subject, html, text = merge.render({'first_name': 'Tom & <b>Jerry</b>'})
+        self.assertEqual(html, '<p>Hi Tom &amp; &lt;b&gt;Jerry&lt;/b&gt;</p>')
+        self.assertEqual(text, 'Hi Tom & <b>Jerry</b>')
+        self.assertEqual(subject, 'Hi Tom & <b>Jerry</b>')
+
+    @override_settings(MERGE_TAG_DEFAULTS={'first_name': 'reader', 'city': 'your city'})
+    def test_defaults(self):
+        # Django's autoescape turns the quotes of a default into entities
+        html = personalize.MergeTemplate('<p>{{ first_name|default:&quot;R&amp;D team&quot; }} in {{city}}</p>', html=True)
+        self.assertEqual(html.fill({}), '<p>R&amp;D team in your city</p>')
+        self.assertEqual(html.fill({'first_name': '', 'city': None}), '<p>R&amp;D team in your city</p>')
+        self.assertEqual(html.fill({'first_name': 'Ann', 'city': 'Oslo'}), '<p>Ann in Oslo</p>')
+        text = personalize.MergeTemplate("{{first_name|default:'R&D team'}}, {{first_name}}")
+        self.assertEqual(text.fill({}), 'R&D team, reader')
+
+    def test_unknown_tags(self):
+        merge = personalize.MergeTemplate('Hi {{nickname}}{{ 1st }}{{first name}}')
+        self.assertEqual(merge.fields, {'nickname'})
+        # Unknown fields are left empty; what is not a merge tag is left alone
+        self.assertEqual(merge.fill({}), 'Hi {{ 1st }}{{first name}}')
+        self.assertEqual(personalize.MergeTemplate('No tags').fill({'first_name': 'Ann'}), 'No tags')
+
+    def test_values_are_not_merged_again(self):
+        merge = personalize.compile_message('{{first_name}}', '<p>{{first_name}}</p>', '{{first_name}} {{email}}')
+        subject, html, text = merge.render({'first_name': '{{email}}', 'email': 'ann@example.com'})
+        self.assertEqual((subject, html), ('{{email}}', '<p>{{email}}</p>'))
+        self.assertEqual(text, '{{email}} ann@example.com')
+
+    def test_unsubscribe_placeholder(self):
+        merge = personalize.MergeTemplate(f'<a href="{personalize.UNSUBSCRIBE_PLACEHOLDER}">x</a>', html=True)
+        self.assertEqual(merge.fill({'unsubscribe_url': 'https://example.com/u?a=1&b=2'}),
+                         '<a href="https://example.com/u?a=1&amp;b=2">x</a>')
+
+
+class TemplateCompilerTests(TestCase):
+    SOURCE = """<html><head>
+<style>
+    /* brand */
+    .title { color: {{ brand_color }}; margin: 0 {{ gap }}px; }
+    a:hover { color: red; }
+</style>
+<style>
+    {% if dark %}
+    body { background: #000; }
+    {% endif %}
+</style>
+</head><body>
+    <!-- greeting -->
+    <p class="title">Hey {{ subscriber_name|default:"there" }},</p>
+    <p>{{ newsletter_content }}</p>
+    <pre>line 1
+    indented   line</pre>
+</body></html>"""
+
+    def render(self, source, **context):
+        context = {'brand_color': '#123456', 'gap': 4, 'newsletter_content': 'Hi {{first_name}}', **context}
+        return Template(source).render(Context(context))
+
+    def test_template_syntax_and_merge_tags_survive(self):
+        compiled = template_compiler.compile_newsletter_html(self.SOURCE)
+        self.assertIn('<p class="title" style="color:{{ brand_color }};margin:0 {{ gap }}px">', compiled)
+        self.assertIn('{{ subscriber_name|default:"there" }}', compiled)
+        self.assertNotIn('greeting', compiled)
+        html = self.render(compiled)
+        self.assertIn('style="color:#123456;margin:0 4px">Hey there,</p>', html)
+        # Merge tags in the content are left for the per-recipient pass
+        self.assertIn('<p>Hi {{first_name}}</p>', html)
+        self.assertIn('<p>Hi Ann</p>', personalize.MergeTemplate(html, html=True).fill({'first_name': 'Ann'}))
+
+    def test_style_blocks_with_template_tags_are_not_inlined(self):
+        compiled = template_compiler.compile_newsletter_html(self.SOURCE)
+        self.assertIn('<style>a:hover{color:red}</style>', compiled)
+        self.assertIn('{% if dark %}', compiled)
+        self.assertIn('<body>', compiled)
+        self.assertNotIn('#000', self.render(compiled, dark=False))
+        self.assertIn('body{background:#000}', self.render(compiled, dark=True))
+
+    def test_pre_whitespace_is_kept(self):
+        compiled = template_compiler.compile_newsletter_html(self.SOURCE)
+        self.assertIn('<pre>line 1\n    indented   line</pre>', compiled)
+        self.assertIn('</p><pre>', compiled)
+
+    def test_newsletter_templates_keep_their_template_tags(self):
+        templates = Path(__file__).resolve().parent.parent / 'newsletterservice' / 'templates'
+        tag = template_compiler._TEMPLATE_TAG_RE
+        for name in template_compiler.DEFAULT_COMPILED_TEMPLATES:
+            source = (templates / name).read_text()
+            compiled = template_compiler.compile_newsletter_html(source)
+            self.assertLess(len(compiled), len(source))
+            self.assertEqual(sorted(set(tag.findall(compiled))),
+                             sorted(set(tag.findall(template_compiler._COMMENT_RE.sub('', source)))))
+
+
+class FakeSMTP:
+    """The smtplib session of a FakeSMTPBackend."""
+
+    def __init__(self, server):
+        self.server = server
+        self.dropped = False
+
+    def noop(self):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return 250, b'OK'
+
+    def sendmail(self, from_email, recipients, data):
+        if self.server.fail is not None:
+            raise self.server.fail
+        self.server.received.append((self, recipients, data))
+        return {}
+
+
+class FakeSMTPBackend:
+    """Stands in for Django's SMTP EmailBackend."""
+
+    def __init__(self, server):
+        self.server = server
+        self.connection = None
+
+    def open(self):
+        if self.connection is None:
+            if self.server.refuse:
+                raise ConnectionRefusedError('Connection refused')
+            self.connection = FakeSMTP(self.server)
+            self.server.sessions.append(self.connection)
+
+    def close(self):
+        self.connection = None
+
+
+@override_settings(DEFAULT_FROM_EMAIL='news@example.com')
+class SMTPPoolTests(TestCase):
+
+    def setUp(self):
+        self.received, self.sessions, self.fail, self.refuse = [], [], None, False
+        self.pool = SMTPPoolTransport(size=1, max_messages=2, connection_factory=lambda: FakeSMTPBackend(self))
+
+    def send(self, to_email):
+        self.pool.send(to_email, 'Hello', '<p>Hello</p>', 'Hello', {'broadcast_id': 7})
+
+    def test_connections_are_reused_and_recycled(self):
+        for i in range(5):
+            self.send(f'user{i}@example.com')
+        self.assertEqual([recipients for _, recipients, _ in self.received], [[f'user{i}@example.com'] for i in range(5)])
+        # Two messages per connection
+        self.assertEqual(len(self.sessions), 3)
+        self.assertEqual(self.pool.stats['connects'], 3)
+        self.assertEqual(self.pool.stats['messages'], 5)
+
+    def test_body_is_rendered_once(self):
+        with mock.patch.object(transports, 'EmailMultiAlternatives', wraps=transports.EmailMultiAlternatives) as build:
+            self.send('a@example.com')
+            self.send('b@example.com')
+        self.assertEqual(build.call_count, 1)
+        first, second = (data.decode() for _, _, data in self.received)
+        self.assertIn('To: a@example.com\r\n', first)
+        self.assertIn('To: b@example.com\r\n', second)
+        self.assertIn('X-SMTPAPI: {"unique_args": {"broadcast_id": 7}}', first)
+        self.assertEqual(first.split('From: ', 1)[1], second.split('From: ', 1)[1])
+        self.assertNotEqual(first.split('Message-ID: ')[1][:40], second.split('Message-ID: ')[1][:40])
+
+    def test_connection_dropped_while_idle_is_replaced(self):
+        self.send('a@example.com')
+        self.sessions[0].dropped = True
+        with mock.patch.object(self.pool, 'check_after', 0), self.assertLogs('core.transports', 'WARNING'):
+            self.send('b@example.com')
+        self.assertEqual(self.pool.stats['reconnects'], 1)
+        self.assertIs(self.received[1][0], self.sessions[1])
+
+    def test_failure_after_mail_from_is_not_retried(self):
+        self.send('a@example.com')
+        self.fail = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        with self.assertRaises(TransportError) as raised:
+            self.send('b@example.com')
+        # The server may have taken the message: it is neither retried nor failed over
+        self.assertNotIsInstance(raised.exception, NotSentError)
+        self.assertEqual(transports.classify_error(raised.exception), 'error')
+        self.assertEqual(len(self.sessions), 1)
+        self.assertEqual((self.pool.stats['errors'], self.pool.stats['reconnects']), (1, 0))
+
+    def test_unreachable_server_is_not_sent(self):
+        self.refuse = True
+        with self.assertRaises(NotSentError) as raised:
+            self.send('a@example.com')
+        self.assertEqual(transports.classify_error(raised.exception), 'unsent')
+        self.refuse = False
+        self.send('a@example.com')
+        self.assertEqual(len(self.received), 1)
+
+
+class FakeTransport:
+    """A balanced transport member; `fail(to_email)` may raise."""
+    concurrency = 1
+
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.sent = []
+
+    def send(self, to_email, subject, html, text=None, custom_args=None):
+        if self.fail is not None:
+            self.fail(to_email)
+        self.sent.append(to_email)
+
+    def close(self):
+        pass
+
+
+def provider_error(status):
+    def fail(to_email):
+        raise ProviderError(f'HTTP {status}', status)
+    return fail
+
+
+def not_sent(to_email):
+    raise providers.RequestNotSent('connection refused')
+
+
+@override_settings(TRANSPORT_CIRCUIT_BREAKER={'min_requests': 4, 'window': 10, 'cooldown': 30, 'max_wait': 0})
+class BalancedTransportTests(TestCase):
+
+    def setUp(self):
+        # Breakers are per process and outlive a transport
+        patcher = mock.patch.dict(transports._breakers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sends_follow_the_weights(self):
+        heavy, light = FakeTransport(), FakeTransport()
+        balanced = BalancedTransport([('heavy', 'sendgrid', heavy, 3), ('light', 'smtp', light, 1)])
+        for i in range(8):
+            balanced.send(f'user{i}@example.com', 'Hi', '<p>Hi</p>')
+        self.assertEqual((len(heavy.sent), len(light.sent)), (6, 2))
+        self.assertEqual(balanced.concurrency, 2)
+
+    def test_failover_and_breaker(self):
+        primary, secondary = FakeTransport(not_sent), FakeTransport()
+        balanced = BalancedTransport([('primary', 'sendgrid', primary, 100), ('secondary', 'smtp', secondary, 1)])
+        with self.assertLogs('core.transports', 'WARNING'):
+            for i in range(6):
+                balanced.send(f'user{i}@example.com', 'Hi', '<p>Hi</p>')
+        self.assertEqual(len(secondary.sent), 6)
+        # Four errors open the circuit: later sends skip the primary
+        self.assertEqual(transports.breaker_states()['primary']['state'], 'open')
+        report = balanced.report(1.0)
+        self.assertEqual(report['primary']['errors'], 4)
+        self.assertEqual(report['primary']['failovers'], 4)
+        self.assertEqual(report['secondary']['sent'], 6)
+
+    def test_rejected_messages_are_not_retried(self):
+        primary, secondary = FakeTransport(provider_error(400)), FakeTransport()
+        balanced = BalancedTransport([('primary', 'sendgrid', primary, 100), ('secondary', 'smtp', secondary, 1)])
+        with self.assertRaises(ProviderError):
+            balanced.send('a@example.com', 'Hi', '<p>Hi</p>')
+        self.assertEqual(secondary.sent, [])
+        self.assertEqual(transports.breaker_states()['primary']['error_rate'], 0)
+
+    def test_errors_after_sending_are_not_failed_over(self):
+        def timeout(to_email):
+            raise TimeoutError('timed out')
+
+        for fail, error in ((provider_error(503), ProviderError), (timeout, TimeoutError)):
+            transports._breakers.clear()
+            primary, secondary = FakeTransport(fail), FakeTransport()
+            balanced = BalancedTransport([('primary', 'sendgrid', primary, 100), ('secondary', 'smtp', secondary, 1)])
+            # The provider may have taken the message: another transport would send it twice
+            with self.assertRaises(error):
+                balanced.send('a@example.com', 'Hi', '<p>Hi</p>')
+            self.assertEqual(secondary.sent, [])
+            report = balanced.report(1.0)
+            self.assertEqual((report['primary']['errors'], report['primary']['failed']), (1, 1))
+            self.assertEqual(report['primary']['failovers'] + report['secondary']['failovers'], 0)
+            self.assertEqual(transports.breaker_states()['primary']['error_rate'], 1)
+
+    def test_no_healthy_transport(self):
+        balanced = BalancedTransport([('only', 'sendgrid', FakeTransport(not_sent), 1)])
+        with self.assertRaises(providers.RequestNotSent), self.assertLogs('core.transports', 'WARNING'):
+            balanced.send('a@example.com', 'Hi', '<p>Hi</p>')
+        self.assertEqual(balanced.report(1.0)['only']['failed'], 1)
+
+    def test_breaker_recovers_through_a_trial_send(self):
+        now = [0.0]
+        breaker = CircuitBreaker('test', window=10, min_requests=4, cooldown=30, max_cooldown=100,
+                                 clock=lambda: now[0])
+        with self.assertLogs('core.transports', 'WARNING'):
+            for outcome in ('ok', 'ok', 'throttled', 'ok'):
+                breaker.record(outcome)
+        # One 429 in four is over the 20% throttle threshold
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.acquire())
+        now[0] = 30
+        self.assertTrue(breaker.acquire())
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertFalse(breaker.acquire())
+        with self.assertLogs('core.transports', 'WARNING'):
+            breaker.record('error')
+        # Consecutive trips double the cooldown
+        self.assertEqual(breaker.retry_in(), 60)
+        now[0] = 90
+        self.assertTrue(breaker.acquire())
+        breaker.record('ok')
+        self.assertEqual((breaker.state, breaker.trips), ('closed', 0))
+
+
+class LaneSchedulerTests(TestCase):
+
+    def start(self, scheduler, lane, order):
+        def run():
+            scheduler.acquire(lane)
+            order.append(lane)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def wait_for_queue(self, scheduler, lane, depth):
+        deadline = time.monotonic() + 5
+        while scheduler.stats()['lanes'][lane]['depth'] != depth:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+
+    def test_bulk_never_takes_the_reserved_slots(self):
+        scheduler = LaneScheduler(3, {'transactional': 1})
+        self.assertEqual((scheduler.limit('bulk'), scheduler.limit('transactional')), (2, 3))
+        scheduler.acquire('bulk')
+        scheduler.acquire('bulk')
+        order = []
+        bulk = self.start(scheduler, 'bulk', order)
+        self.wait_for_queue(scheduler, 'bulk', 1)
+        # The third slot is held for transactional sends
+        scheduler.acquire('transactional')
+        self.assertEqual(order, [])
+
+        scheduler.release('bulk')
+        bulk.join(5)
+        self.assertEqual(order, ['bulk'])
+        stats = scheduler.stats()['lanes']
+        self.assertEqual((stats['bulk']['in_flight'], stats['transactional']['in_flight']), (2, 1))
+
+    def test_freed_slot_goes_to_transactional_first(self):
+        scheduler = LaneScheduler(2, {'transactional': 1})
+        scheduler.acquire('bulk')
+        scheduler.acquire('transactional')
+        order = []
+        bulk = self.start(scheduler, 'bulk', order)
+        self.wait_for_queue(scheduler, 'bulk', 1)
+        transactional = self.start(scheduler, 'transactional', order)
+        self.wait_for_queue(scheduler, 'transactional', 1)
+
+        scheduler.release('bulk')
+        transactional.join(5)
+        self.assertEqual(order, ['transactional'])
+        scheduler.release('transactional')
+        bulk.join(5)
+        self.assertEqual(order, ['transactional', 'bulk'])
+
+    def test_waits_are_recorded(self):
+        now = [0.0]
+        scheduler = LaneScheduler(2, clock=lambda: now[0])
+        scheduler.record('bulk', 0.5)
+        scheduler.record('bulk', 1.5)
+        wait = scheduler.stats()['lanes']['bulk']['wait_ms']
+        self.assertEqual((wait['avg'], wait['max']), (1000, 1500))
+        with scheduler.slot('transactional'):
+            self.assertEqual(scheduler.stats()['lanes']['transactional']['in_flight'], 1)
+        self.assertEqual(scheduler.stats()['lanes']['transactional']['calls'], 1)
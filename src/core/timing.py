@@ -0,0 +1,156 @@
+"""
+Phase timings of broadcasts.
+
+A BroadcastTimer adds up how long a broadcast spends in each phase of the
+pipeline:
+
+- validation: request checks and suppression filtering
+- upsert: saving the recipients as subscribers
+- render: the template render and each recipient's personalisation
+- queue: waiting for a send lane slot and a rate-limit token (core.lanes)
+- provider: provider calls, whose latencies also go into a histogram for
+  the p50 / p99
+- delivery: wall time of the sending loop
+- bookkeeping: BroadcastLog, partition and analytics writes
+
+Phases that run on several threads at once (render, queue, provider) add up
+the time of every thread, so they can exceed the delivery wall time.
+
+A timer's state() is plain JSON and merges with others (merge_states), so
+the partitions of a sharded broadcast, sent by different processes, roll up
+into one BroadcastTiming. Percentiles come from log-spaced histogram buckets
+and are accurate to about 5%.
+"""
+from contextlib import contextmanager
+from django.db import DatabaseError, OperationalError, transaction
+from .models import BroadcastTiming
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('validation', 'upsert', 'render', 'queue', 'provider', 'delivery', 'bookkeeping')
+
+# Writes of a timing row tried while the database is locked by other writers
+SAVE_ATTEMPTS = 3
+
+# Histogram buckets grow by 5% from 10 microseconds
+BUCKET_BASE = 0.00001
+BUCKET_GROWTH = 1.05
+
+
+def _bucket(seconds):
+    return str(max(int(math.log(max(seconds, BUCKET_BASE) / BUCKET_BASE, BUCKET_GROWTH)), 0))
+
+
+def percentile(histogram, fraction):
+    """Latency in seconds at `fraction` of a {bucket: count} histogram (the
+    upper bound of its bucket)."""
+    total = sum(histogram.values())
+    if not total:
+        return 0.0
+    rank = fraction * total
+    seen = 0
+    for bucket in sorted(histogram, key=int):
+        seen += histogram[bucket]
+        if seen >= rank:
+            break
+    return BUCKET_BASE * BUCKET_GROWTH ** (int(bucket) + 1)
+
+
+class BroadcastTimer:
+    """Thread-safe phase totals and provider call latencies."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.calls = 0
+        self.histogram = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.seconds[phase] += seconds
+
+    def call(self, seconds):
+        """Record one provider call."""
+        bucket = _bucket(seconds)
+        with self._lock:
+            self.seconds['provider'] += seconds
+            self.calls += 1
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def state(self):
+        with self._lock:
+            return {
+                'elapsed': time.perf_counter() - self.started,
+                'seconds': dict(self.seconds),
+                'calls': self.calls,
+                'histogram': dict(self.histogram),
+            }
+
+
+def merge_states(states):
+    """Add up timer states (elapsed included)."""
+    merged = {'elapsed': 0.0, 'seconds': dict.fromkeys(PHASES, 0.0), 'calls': 0, 'histogram': {}}
+    for state in states:
+        if not state:
+            continue
+        merged['elapsed'] += state.get('elapsed', 0)
+        for phase, seconds in state.get('seconds', {}).items():
+            merged['seconds'][phase] = merged['seconds'].get(phase, 0) + seconds
+        merged['calls'] += state.get('calls', 0)
+        for bucket, count in state.get('histogram', {}).items():
+            merged['histogram'][bucket] = merged['histogram'].get(bucket, 0) + count
+    return merged
+
+
+def summary(state, total_seconds=None):
+    """Milliseconds per phase, as stored on BroadcastTiming and returned by
+    the API. `total_seconds` defaults to the state's elapsed time."""
+    elapsed = state.get('elapsed', 0) if total_seconds is None else total_seconds
+    timing = {'total_ms': round(elapsed * 1000, 2)}
+    for phase in PHASES:
+        timing[f'{phase}_ms'] = round(state['seconds'].get(phase, 0) * 1000, 2)
+    timing['provider_calls'] = state['calls']
+    timing['provider_p50_ms'] = round(percentile(state['histogram'], 0.5) * 1000, 2)
+    timing['provider_p99_ms'] = round(percentile(state['histogram'], 0.99) * 1000, 2)
+    return timing
+
+
+def save_timing(broadcast_log, state, request_state=None, total_seconds=None):
+    """Store the timing of `broadcast_log` from a timer `state`; sharded
+    broadcasts keep the state of their send request in `request_state` to
+    merge the partitions into later. Returns the summary.
+
+    Timings are bookkeeping written after the mail went out: a write that
+    still fails after SAVE_ATTEMPTS is logged, never raised."""
+    timing = summary(state, total_seconds)
+    defaults = dict(timing)
+    if request_state is not None:
+        defaults['request_state'] = request_state
+    for attempt in range(1, SAVE_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                BroadcastTiming.objects.update_or_create(broadcast=broadcast_log, defaults=defaults)
+            break
+        except OperationalError:
+            # e.g. "database is locked" under concurrent SQLite writers
+            if attempt == SAVE_ATTEMPTS:
+                logger.exception(f'Failed to save the timing of broadcast {broadcast_log.broadcast_id}')
+                break
+            time.sleep(0.05 * attempt)
+        except DatabaseError:
+            logger.exception(f'Failed to save the timing of broadcast {broadcast_log.broadcast_id}')
+            break
+    return timing
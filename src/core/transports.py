@@ -0,0 +1,591 @@
+"""
+Outbound transports used by broadcasts.
+
+Every transport exposes `send(to_email, subject, html, text, custom_args)`
+(raising on failure), `close()` and a `concurrency` hint: how many sends may be in flight
+at once. The SendGrid HTTP API transport is used by default; the SMTP pool
+keeps a few authenticated connections open for the whole broadcast and is a
+high-throughput fallback when the HTTP API is throttled. `custom_args`
+(e.g. the broadcast_id) come back on the provider's event webhooks.
+
+BalancedTransport spreads sends over several transports or SendGrid API keys
+(settings.BROADCAST_TRANSPORTS) by weight. Each has a circuit breaker, kept
+for the life of the process, that opens on a high error or 429 rate. A send
+moves on to the next transport only when the provider cannot have accepted
+it (a 429, or a connection that failed before the request was written), so
+a throttled key or an unreachable host does not fail the rest of the
+broadcast and no message is delivered twice.
+"""
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.message import forbid_multi_line_headers
+from django.core.mail.utils import DNS_NAME
+from email.utils import formatdate, make_msgid
+from .providers import load_sendgrid, provider_client, RequestNotSent, sendgrid_installed
+from collections import deque
+import json
+import logging
+import queue
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TransportError(Exception):
+    """A message could not be handed to the provider."""
+
+
+class SendGridTransport:
+    name = 'sendgrid'
+    concurrency = 1
+
+    def __init__(self, account='sendgrid', api_key=None, host=None):
+        _, self._mail, self._custom_arg = load_sendgrid()
+        # The process-wide client keeps its connections open between broadcasts
+        self.client = provider_client(account, api_key, host)
+
+    def send(self, to_email, subject, html, text=None, custom_args=None):
+        msg = self._mail(
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to_emails=to_email,
+            subject=subject,
+            html_content=html
+        )
+        if custom_args:
+            msg.custom_arg = [self._custom_arg(key, str(value)) for key, value in custom_args.items()]
+        response = self.client.send(msg)
+        logger.info(f'SendGrid response: status={getattr(response, "status_code", None)}')
+        status_code = getattr(response, 'status_code', 0)
+        if status_code < 200 or status_code >= 300:
+            raise TransportError(f'SendGrid send failed, status={status_code}')
+
+    def close(self):
+        pass
+
+
+class NotSentError(TransportError):
+    """The message never reached the server (e.g. it could not be
+    connected to), so it may be sent again."""
+
+
+class PreparedMessage:
+    """A message rendered once and sent to many recipients.
+
+    The MIME body (and the headers every copy shares) is encoded when the
+    PreparedMessage is built; `render()` only writes the per-recipient
+    headers in front of it.
+    """
+
+    def __init__(self, subject, html, text=None, from_email=None):
+        self.from_email = from_email or settings.DEFAULT_FROM_EMAIL
+        msg = EmailMultiAlternatives(subject, text or '', self.from_email)
+        msg.attach_alternative(html, 'text/html')
+        mime = msg.message()
+        del mime['Date']
+        del mime['Message-ID']
+        self._shared = mime.as_bytes(linesep='\r\n')
+
+    def render(self, to_email, custom_args=None):
+        headers = [('To', to_email), ('Date', formatdate(localtime=settings.EMAIL_USE_LOCALTIME)),
+                   ('Message-ID', make_msgid(domain=DNS_NAME))]
+        if custom_args:
+            # SendGrid's SMTP relay reads custom args from the X-SMTPAPI header
+            headers.append(('X-SMTPAPI', json.dumps({'unique_args': custom_args})))
+        lines = ['%s: %s\r\n' % forbid_multi_line_headers(name, value, settings.DEFAULT_CHARSET)
+                 for name, value in headers]
+        return ''.join(lines).encode('utf-8') + self._shared
+
+
+class _PooledConnection:
+    def __init__(self, factory):
+        self._factory = factory
+        self.connection = None
+        self.sent = 0
+        self.last_used = 0
+
+    def alive(self):
+        """Whether the open session still answers a NOOP."""
+        try:
+            return self.connection.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def ensure_open(self):
+        """The smtplib session, connecting and logging in when needed."""
+        if self.connection is None:
+            self.connection = self._factory()
+        self.connection.open()
+        return self.connection.connection
+
+    def reset(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.sent = 0
+
+
+class SMTPPoolTransport:
+    """A small pool of persistent authenticated SMTP connections.
+
+    Each connection sends many messages and is recycled after
+    `max_messages` or on any error. A connection left idle for a while is
+    checked with a NOOP before its next message and replaced when the server
+    has dropped it; that is the only retry, as a failure once MAIL FROM was
+    sent may come after the server took the message. A message whose
+    connection could not be opened at all raises NotSentError.
+
+    The MIME body of a broadcast is encoded once (PreparedMessage) and only
+    the recipient headers are written per message.
+    """
+    name = 'smtp'
+    # Seconds a connection may sit idle before it is checked with a NOOP
+    check_after = 1.0
+
+    def __init__(self, size=None, max_messages=None, connection_factory=None, options=None):
+        self.size = size or getattr(settings, 'SMTP_POOL_SIZE', 4)
+        self.options = options if options is not None else getattr(settings, 'BROADCAST_SMTP', {}) or {}
+        self.max_messages = max_messages or getattr(settings, 'SMTP_POOL_MAX_MESSAGES', 100)
+        self._factory = connection_factory or self._default_connection
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._prepared = (None, None)
+        self.stats = {'messages': 0, 'connects': 0, 'reconnects': 0, 'errors': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    @property
+    def concurrency(self):
+        return self.size
+
+    def _default_connection(self):
+        options = self.options
+        return get_connection(
+            backend='django.core.mail.backends.smtp.EmailBackend',
+            host=options.get('host', settings.EMAIL_HOST),
+            port=options.get('port', settings.EMAIL_PORT),
+            username=options.get('username', settings.EMAIL_HOST_USER),
+            password=options.get('password', settings.EMAIL_HOST_PASSWORD),
+            use_tls=options.get('use_tls', settings.EMAIL_USE_TLS),
+            timeout=options.get('timeout', 30),
+            fail_silently=False,
+        )
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return _PooledConnection(self._factory)
+        return self._idle.get()
+
+    def prepare(self, subject, html, text=None):
+        """The PreparedMessage for this content; the last one is kept, so
+        every send of a broadcast shares it."""
+        key = (subject, html, text)
+        with self._lock:
+            if self._prepared[0] == key:
+                return self._prepared[1]
+        prepared = PreparedMessage(subject, html, text)
+        with self._lock:
+            self._prepared = (key, prepared)
+        return prepared
+
+    def send(self, to_email, subject, html, text=None, custom_args=None):
+        prepared = self.prepare(subject, html, text)
+        self.send_message(prepared.from_email, [to_email], prepared.render(to_email, custom_args))
+
+    def send_message(self, from_email, recipients, data):
+        """Send the encoded message `data` over a pooled connection."""
+        pooled = self._acquire()
+        try:
+            if (pooled.connection is not None and time.monotonic() - pooled.last_used >= self.check_after
+                    and not pooled.alive()):
+                logger.warning('SMTP connection was closed by the server, reconnecting')
+                pooled.reset()
+                self._count('reconnects')
+            if pooled.connection is None:
+                self._count('connects')
+            try:
+                smtp = pooled.ensure_open()
+            except (smtplib.SMTPException, OSError) as e:
+                self._count('errors')
+                pooled.reset()
+                raise NotSentError(f'SMTP connection failed: {e}') from e
+            try:
+                smtp.sendmail(from_email, recipients, data)
+            except (smtplib.SMTPException, OSError) as e:
+                self._count('errors')
+                pooled.reset()
+                raise TransportError(f'SMTP send failed: {e}') from e
+            pooled.sent += 1
+            pooled.last_used = time.monotonic()
+            self._count('messages')
+            if pooled.sent >= self.max_messages:
+                pooled.reset()
+        finally:
+            self._idle.put(pooled)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().reset()
+            except queue.Empty:
+                break
+        logger.info(f'SMTP pool closed: {self.stats}')
+
+
+# Circuit breakers and weighted dispatch ------------------------------------
+
+DEFAULT_CIRCUIT_BREAKER = {
+    'window': 50,
+    'min_requests': 10,
+    'error_threshold': 0.5,
+    'throttle_threshold': 0.2,
+    'cooldown': 30,
+    'max_cooldown': 300,
+    'max_wait': 10,
+}
+
+
+def breaker_settings():
+    options = dict(DEFAULT_CIRCUIT_BREAKER)
+    options.update(getattr(settings, 'TRANSPORT_CIRCUIT_BREAKER', {}) or {})
+    return options
+
+
+def classify_error(exc):
+    """'throttled' (HTTP 429), 'unsent' (the request never reached the
+    provider), 'rejected' (any other 4xx but 401/403: the message or
+    recipient was refused, another provider would refuse it too) or 'error'
+    (5xx, authentication, timeouts and other failures after sending)."""
+    if isinstance(exc, (RequestNotSent, NotSentError)):
+        return 'unsent'
+    status = getattr(exc, 'status_code', None)
+    if status == 429:
+        return 'throttled'
+    if status is not None and 400 <= status < 500 and status not in (401, 403):
+        return 'rejected'
+    return 'error'
+
+
+class CircuitBreaker:
+    """Health of one transport.
+
+    Closed, it records the outcome of the last `window` sends and opens when
+    the share of errors or of 429s reaches its threshold. Open, it refuses
+    sends for `cooldown` seconds (doubled on every consecutive trip, up to
+    `max_cooldown`), then goes half-open and lets a single trial send
+    through: success closes it, failure opens it again.
+    """
+
+    def __init__(self, name, window=50, min_requests=10, error_threshold=0.5, throttle_threshold=0.2,
+                 cooldown=30, max_cooldown=300, clock=time.monotonic, **_):
+        self.name = name
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.throttle_threshold = throttle_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.state = 'closed'
+        self.trips = 0
+        self.retry_at = 0
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether acquire() would let a send through now."""
+        with self._lock:
+            return self.state == 'closed' or (self.state == 'open' and self.clock() >= self.retry_at)
+
+    def acquire(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.clock() >= self.retry_at:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def record(self, outcome):
+        """Record 'ok', 'error' or 'throttled' for a send let through."""
+        with self._lock:
+            if self.state == 'half_open':
+                if outcome == 'ok':
+                    self.state, self.trips = 'closed', 0
+                    self._outcomes.clear()
+                    logger.info(f'Transport {self.name} recovered, circuit closed')
+                else:
+                    self._open()
+                return
+            if self.state == 'open':
+                # A send started before the circuit opened
+                return
+            self._outcomes.append(outcome)
+            count = len(self._outcomes)
+            if count < self.min_requests:
+                return
+            if (self._outcomes.count('error') / count >= self.error_threshold
+                    or self._outcomes.count('throttled') / count >= self.throttle_threshold):
+                self._open()
+
+    def _open(self):
+        self.trips += 1
+        cooldown = min(self.cooldown * 2 ** (self.trips - 1), self.max_cooldown)
+        self.state = 'open'
+        self.retry_at = self.clock() + cooldown
+        self._outcomes.clear()
+        logger.warning(f'Transport {self.name} unhealthy, circuit open for {cooldown}s')
+
+    def retry_in(self):
+        """Seconds until a send may be let through again."""
+        with self._lock:
+            if self.state == 'closed':
+                return 0
+            return max(self.retry_at - self.clock(), 0)
+
+    def snapshot(self):
+        with self._lock:
+            count = len(self._outcomes)
+            return {
+                'state': self.state,
+                'trips': self.trips,
+                'retry_in': round(max(self.retry_at - self.clock(), 0), 1) if self.state == 'open' else 0,
+                'window': count,
+                'error_rate': round(self._outcomes.count('error') / count, 3) if count else 0,
+                'throttle_rate': round(self._outcomes.count('throttled') / count, 3) if count else 0,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(name):
+    """The process-wide breaker of transport `name`, so that its health
+    carries over from one broadcast to the next."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name, **breaker_settings())
+    return breaker
+
+
+def breaker_states():
+    return {name: breaker.snapshot() for name, breaker in list(_breakers.items())}
+
+
+STAT_COUNTERS = ('sent', 'failed', 'throttled', 'errors', 'failovers')
+
+
+def _stats_row(kind, **counts):
+    row = {'type': kind}
+    row.update({name: counts.get(name, 0) for name in STAT_COUNTERS})
+    return row
+
+
+def _finish_report(report, seconds):
+    for row in report.values():
+        row['seconds'] = round(seconds, 3)
+        row['rate'] = round(row['sent'] / seconds, 2) if seconds else 0
+    return report
+
+
+def transport_report(transport, sent, failed, seconds):
+    """Per-transport counters and throughput (sent per second of
+    `seconds`) of a delivery run, for BroadcastLog.transport_stats."""
+    if hasattr(transport, 'report'):
+        return transport.report(seconds)
+    return _finish_report({transport.name: _stats_row(transport.name, sent=sent, failed=failed)}, seconds)
+
+
+def merge_reports(reports, parallel=False):
+    """Add up transport reports. Runs that overlap in time (`parallel`, e.g.
+    the partitions of a sharded broadcast) take the longest run's seconds,
+    consecutive ones the sum."""
+    merged = {}
+    seconds = 0
+    for report in reports:
+        for name, row in (report or {}).items():
+            total = merged.setdefault(name, _stats_row(row.get('type', name)))
+            for counter in STAT_COUNTERS:
+                total[counter] += row.get(counter, 0)
+        run = max((row.get('seconds', 0) for row in (report or {}).values()), default=0)
+        seconds = max(seconds, run) if parallel else seconds + run
+    return _finish_report(merged, seconds)
+
+
+class _Member:
+    __slots__ = ('name', 'kind', 'transport', 'weight', 'current', 'breaker', 'stats')
+
+    def __init__(self, name, kind, transport, weight):
+        self.name = name
+        self.kind = kind
+        self.transport = transport
+        self.weight = weight
+        self.current = 0
+        self.breaker = circuit_breaker(name)
+        self.stats = _stats_row(kind)
+
+
+class BalancedTransport:
+    """Weighted dispatch over several transports, with failover.
+
+    Sends are spread by smooth weighted round-robin over the transports
+    whose circuit is not open. A send refused with a 429 or that never
+    reached the provider is retried on the next transport. Any other failure
+    (a 4xx rejection, a 5xx, a timeout or reset after the request went out)
+    fails the send: the provider may have accepted the message, and another
+    transport would deliver it twice. When every circuit is open, a send
+    waits up to `max_wait` seconds for one to let a trial through.
+    """
+    name = 'balanced'
+
+    def __init__(self, members, max_wait=None):
+        if not members:
+            raise TransportError('No transports to balance')
+        self.members = [_Member(*member) for member in members]
+        self.max_wait = breaker_settings()['max_wait'] if max_wait is None else max_wait
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self):
+        return sum(member.transport.concurrency for member in self.members)
+
+    def _choose(self, tried):
+        with self._lock:
+            candidates = [m for m in self.members if m.name not in tried and m.breaker.available()]
+            if not candidates:
+                return None
+            total = sum(m.weight for m in candidates)
+            for member in candidates:
+                member.current += member.weight
+            chosen = max(candidates, key=lambda m: m.current)
+            chosen.current -= total
+            return chosen
+
+    def _count(self, member, counter):
+        with self._lock:
+            member.stats[counter] += 1
+
+    def _wait(self, tried, deadline):
+        """Sleep until an untried transport may let a send through; False
+        when none will before `deadline`."""
+        waits = [m.breaker.retry_in() for m in self.members if m.name not in tried]
+        remaining = deadline - time.monotonic()
+        if not waits or min(waits) > remaining:
+            return False
+        time.sleep(min(max(min(waits), 0.05), remaining, 1.0))
+        return True
+
+    def send(self, to_email, subject, html, text=None, custom_args=None):
+        tried = set()
+        last_error = previous = None
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            member = self._choose(tried)
+            if member is None:
+                if self._wait(tried, deadline):
+                    continue
+                if previous is not None:
+                    self._count(previous, 'failed')
+                if last_error is not None:
+                    raise last_error
+                raise TransportError('No healthy transport available')
+            if not member.breaker.acquire():
+                continue
+            tried.add(member.name)
+            if previous is not None:
+                self._count(previous, 'failovers')
+            try:
+                member.transport.send(to_email, subject, html, text, custom_args)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == 'rejected':
+                    member.breaker.record('ok')
+                    self._count(member, 'failed')
+                    raise
+                member.breaker.record('throttled' if kind == 'throttled' else 'error')
+                self._count(member, 'throttled' if kind == 'throttled' else 'errors')
+                if kind == 'error':
+                    self._count(member, 'failed')
+                    raise
+                logger.warning(f'Transport {member.name} failed for a send ({e}), failing over')
+                last_error, previous = e, member
+                continue
+            member.breaker.record('ok')
+            self._count(member, 'sent')
+            return
+
+    def report(self, seconds):
+        with self._lock:
+            report = {member.name: dict(member.stats) for member in self.members}
+        return _finish_report(report, seconds)
+
+    def close(self):
+        for member in self.members:
+            member.transport.close()
+
+
+def _member_transport(entry):
+    kind = entry.get('type', 'sendgrid')
+    name = entry.get('name') or kind
+    if kind == 'sendgrid':
+        if not sendgrid_installed():
+            raise TransportError('SendGrid not configured on server')
+        if name != 'sendgrid' and not entry.get('api_key'):
+            raise TransportError(f'Transport {name} has no api_key')
+        return SendGridTransport(name, entry.get('api_key'), entry.get('host'))
+    if kind == 'smtp':
+        options = {key: value for key, value in entry.items() if key not in ('name', 'type', 'weight', 'size')}
+        return SMTPPoolTransport(size=entry.get('size'), options=options)
+    raise TransportError(f'Unknown transport type for {name}: {kind}')
+
+
+def create_balanced_transport(entries=None):
+    """A BalancedTransport over `entries` (default settings.BROADCAST_TRANSPORTS);
+    entries with weight 0 are left out."""
+    entries = getattr(settings, 'BROADCAST_TRANSPORTS', []) if entries is None else entries
+    members = []
+    for entry in entries:
+        weight = float(entry.get('weight', 1))
+        if weight < 0:
+            raise TransportError(f'Negative weight for transport {entry.get("name")}')
+        if weight:
+            members.append((entry.get('name') or entry.get('type', 'sendgrid'), entry.get('type', 'sendgrid'),
+                            _member_transport(entry), weight))
+    if len({name for name, *_ in members}) != len(members):
+        raise TransportError('BROADCAST_TRANSPORTS names must be unique')
+    if not members:
+        raise TransportError('No BROADCAST_TRANSPORTS configured')
+    return BalancedTransport(members)
+
+
+TRANSPORTS = ('sendgrid', 'smtp', 'balanced')
+
+
+def create_transport(name=None):
+    """Create the transport called `name` (default settings.BROADCAST_TRANSPORT)."""
+    name = name or getattr(settings, 'BROADCAST_TRANSPORT', 'sendgrid')
+    if name == 'smtp':
+        return SMTPPoolTransport()
+    if name == 'sendgrid':
+        if not sendgrid_installed() or not getattr(settings, 'SENDGRID_API_KEY', ''):
+            raise TransportError('SendGrid not configured on server')
+        return SendGridTransport()
+    if name == 'balanced':
+        return create_balanced_transport()
+    raise TransportError(f'Unknown transport: {name}')
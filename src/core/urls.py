@@ -6,11 +6,27 @@ urlpatterns = [
     path('', views.getRoutes, name="routes" ),
     path('emails/', views.getEmails, name="emails"),
     path('emails/<str:pk>/', views.getEmail, name="email"),
+    path('search/', views.searchEmails, name="search"),
     
     # Broadcast endpoint for sending to multiple recipients
     path('broadcast/send/', views.broadcastEmail, name="broadcast-send"),
+    path('broadcast/preview/', views.broadcastPreview, name="broadcast-preview"),
+    path('broadcast/preview/<str:render_key>/', views.broadcastPreviewDetail, name="broadcast-preview-detail"),
+    path('broadcasts/', views.broadcasts, name="broadcasts"),
+    path('broadcasts/<str:broadcast_id>/', views.broadcastDetail, name="broadcast-detail"),
+    path('broadcast/<str:broadcast_id>/progress/', views.broadcastProgress, name="broadcast-progress"),
+    path('broadcast/<str:broadcast_id>/progress/stream/', views.broadcastProgressStream, name="broadcast-progress-stream"),
     
+    # Analytics endpoints (answered from the daily rollups)
+    path('analytics/', views.analytics, name="analytics"),
+    path('analytics/devices/', views.analyticsDevices, name="analytics-devices"),
+    path('providers/stats/', views.providerStats, name="provider-stats"),
+    path('lanes/', views.laneStats, name="lane-stats"),
+    path('webhooks/sendgrid/', views.sendgridWebhook, name="webhook-sendgrid"),
+
     # Subscriber endpoints
     path('subscribers/', views.subscribers, name="subscribers"),
+    path('subscribers/search/', views.subscriberSearch, name="subscriber-search"),
+    path('subscribers/bulk/', views.subscriberBulk, name="subscriber-bulk"),
     path('subscribers/<str:pk>/', views.subscriberDetail, name="subscriber-detail"),
 ]
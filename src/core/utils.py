@@ -1,41 +1,37 @@
 from rest_framework.response import Response
-from .models import Emails, Subscriber, BroadcastLog
-from .serializers import EmailSerializer, SubscriberSerializer, BroadcastLogSerializer
+from .models import Emails, Subscriber, BroadcastLog, BroadcastPartition, domain_q, normalize_email, reversed_domain
+from .serializers import EmailSerializer, SubscriberSerializer, BroadcastLogSerializer, BroadcastLogListSerializer, BROADCAST_LIST_FIELDS, BROADCAST_TIMING_FIELDS
+from .scheduler import notify_dispatcher, schedule_time
+from .sharding import FINISHED as PARTITION_FINISHED, create_partitions
+from .ratelimit import RateLimitTimeout
+from .assets import image_urls
+from .transports import breaker_states, create_transport, transport_report, TransportError
+from .providers import load_sendgrid, pool_stats, provider_client, sendgrid_installed
+from .render_cache import cached_render, render_newsletter
+from .devices import lookup_device
+from . import bulk, lanes, personalize, webhooks
+from .personalize import UNSUBSCRIBE_PLACEHOLDER
+from .progress import FINAL_STATUSES, ProgressTracker, StreamSlot, get_progress, open_stream, snapshot_from_log
+from .search import SearchUnavailable, search
+from .timing import BroadcastTimer, save_timing
+from .analytics import broadcast_series, date_range, device_failure_rates, record_broadcast, record_subscribers, subscriber_series
+from concurrent.futures import ThreadPoolExecutor
 from django.core.mail import send_mail, EmailMultiAlternatives, get_connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.conf import settings
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.db.models import Count, F, Min, Q, Sum
 from datetime import datetime
+from urllib.parse import quote
+import base64
 import uuid
 import logging
 import json
+import time
 
 logger = logging.getLogger(__name__)
 
-# Optional SendGrid integration
-try:
-    from sendgrid import SendGridAPIClient
-    from sendgrid.helpers.mail import Mail
-    SENDGRID_AVAILABLE = True
-except Exception:
-    SENDGRID_AVAILABLE = False
-
-
-def _get_image_url(key: str) -> str:
-    """Return an image URL for `key` from settings.NEWSLETTER_IMAGES or
-    fall back to common settings names like KEY_ICON_URL or KEY_URL.
-    """
-    imgs = getattr(settings, 'NEWSLETTER_IMAGES', {}) or {}
-    if key in imgs and imgs[key]:
-        return imgs[key]
-    # Try common fallback attribute names
-    for suffix in ('_ICON_URL', '_URL'):
-        attr = f"{key.upper()}{suffix}"
-        val = getattr(settings, attr, '')
-        if val:
-            return val
-    return ''
-
 
 def getEmailList(request, device_id):
     if device_id:
@@ -92,13 +88,8 @@ def createEmail(request, device_id):
     else:
         template_name = 'newsletter-announcement.html'
     
-    # Load image URLs from settings (prefer NEWSLETTER_IMAGES dict)
-    icon2_url = _get_image_url('icon2')
-    qr_code_url = _get_image_url('qr_code')
-    instagram_icon_url = _get_image_url('instagram')
-    tiktok_icon_url = _get_image_url('tiktok')
-    x_icon_url = _get_image_url('twitter')
-    whatsapp_icon_url = _get_image_url('whatsapp')
+    # Image URLs are resolved once at start-up
+    images = image_urls()
 
     # Common context for both templates
     context = {
@@ -107,14 +98,17 @@ def createEmail(request, device_id):
         'highlight_text': data.get('highlight_text', ''),
         'cta_text': data.get('cta_text', ''),
         'cta_url': data.get('cta_url', ''),
-        'icon2_image': icon2_url,
-        'qr_code_image': qr_code_url,
+        'icon2_image': images.get('icon2', ''),
+        'qr_code_image': images.get('qr_code', ''),
+        'icon_image': images.get('icon', ''),
+        'logo_image': images.get('logo', ''),
+        'background_image': images.get('header_bg', ''),
         'year': datetime.now().year,
         'unsubscribe_url': data.get('unsubscribe_url', '#'),
-        'instagram_icon': instagram_icon_url,
-        'tiktok_icon': tiktok_icon_url,
-        'x_icon': x_icon_url,
-        'whatsapp_icon': whatsapp_icon_url,
+        'instagram_icon': images.get('instagram', ''),
+        'tiktok_icon': images.get('tiktok', ''),
+        'x_icon': images.get('twitter', ''),
+        'whatsapp_icon': images.get('whatsapp', ''),
         'flyer_images': flyer_images,
     }
 
@@ -127,25 +121,34 @@ def createEmail(request, device_id):
             'event_location': data.get('event_location', ''),
         })
 
-    # Render the HTML template with context
-    html_content = render_to_string(template_name, context)
-    text_content = strip_tags(html_content)
+    # Render the HTML template with context (cached by content)
+    rendered = render_newsletter(template_name, context)
+    merge = personalize.compile_message(email.subject, rendered['html'], rendered['text'])
+    fields = personalize.subscriber_fields([email.email]).get(normalize_email(email.email)) if merge.needs_subscriber_fields else None
+    subject_content, html_content, text_content = merge.render(
+        dict(_recipient_values(email.email, fields), unsubscribe_url=context['unsubscribe_url']))
 
     # Send the email via SendGrid (required)
-    if not SENDGRID_AVAILABLE or not getattr(settings, 'SENDGRID_API_KEY', ''):
+    if not sendgrid_installed() or not getattr(settings, 'SENDGRID_API_KEY', ''):
         logger.error('SendGrid not configured: SENDGRID_API_KEY missing or sendgrid package not installed')
         return Response({'error': 'SendGrid not configured on server'}, status=500)
 
     try:
-        sg = SendGridAPIClient(getattr(settings, 'SENDGRID_API_KEY'))
+        Mail = load_sendgrid()[1]
+        sg = provider_client('sendgrid')
         msg = Mail(
             from_email=settings.DEFAULT_FROM_EMAIL,
             to_emails=email.email,
-            subject=email.subject,
+            subject=subject_content,
             html_content=text_content
         )
-        response = sg.send(msg)
+        # Ahead of any queued broadcast sends
+        with lanes.slot('transactional'):
+            response = sg.send(msg)
         logger.info(f"SendGrid single-send response: status={getattr(response, 'status_code', None)}")
+    except RateLimitTimeout:
+        logger.warning('SendGrid single-send rejected: provider rate limit exhausted')
+        return Response({'error': 'Email provider rate limit reached, please retry shortly'}, status=429)
     except Exception as e:
         logger.exception('SendGrid single-send failed')
         return Response({'error': 'Failed to send email via SendGrid'}, status=500)
@@ -182,62 +185,47 @@ def deleteEmail(request, pk, device_id):
 
 
 # Broadcast email functions
-def sendBroadcastEmail(request, device_id):
-    """
-    Send broadcast emails to multiple recipients at once.
-    Expects: { subject, message, recipients, senderEmail, senderName, broadcastId }
+def _parse_newsletter(data):
+    """Extract the newsletter fields from the broadcast message JSON.
+    Falls back to treating the message as plain content.
     """
-    data = request.data
-
-    # Validate required fields
-    if 'subject' not in data:
-        return Response({'error': 'Subject field is required'}, status=400)
-    
-    if 'message' not in data:
-        return Response({'error': 'Message field is required'}, status=400)
-    
-    if 'recipients' not in data or not isinstance(data['recipients'], list) or len(data['recipients']) == 0:
-        return Response({'error': 'Recipients list is required and must contain at least one email'}, status=400)
-
-    # Get broadcast details
     subject = data['subject']
     message = data['message']
-    recipients = data['recipients']
-    # Always use DEFAULT_FROM_EMAIL as the sender address (ignore any senderEmail provided)
-    sender_email = settings.DEFAULT_FROM_EMAIL
-    sender_name = data.get('senderName', '')
-    broadcast_id = data.get('broadcastId', str(uuid.uuid4()))
-    
-    # Parse the message JSON to extract newsletter data
-    # Initialize counters for subscriber creation/reactivation
-    new_subscribers = 0
-    updated_subscribers = 0
-
     try:
         newsletter_data = json.loads(message)
-        template_type = newsletter_data.get('template', 'announcement')
-        newsletter_title = newsletter_data.get('title', subject)
-        newsletter_content = newsletter_data.get('content', '')
-        highlight_text = newsletter_data.get('highlight_text', '')
-        cta_text = newsletter_data.get('cta_text', '')
-        cta_url = newsletter_data.get('cta_url', '')
-        event_date = newsletter_data.get('event_date', '')
-        event_time = newsletter_data.get('event_time', '')
-        event_location = newsletter_data.get('event_location', '')
-        flyer_images = newsletter_data.get('flyer_images', [])
-    except json.JSONDecodeError:
-        template_type = data.get('templateType', 'announcement')
-        newsletter_title = subject
-        newsletter_content = message
-        highlight_text = ''
-        cta_text = ''
-        cta_url = ''
-        event_date = ''
-        event_time = ''
-        event_location = ''
-        flyer_images = []
-
-    # Auto-save/update subscribers from recipients list (works for both branches)
+        return {
+            'template_type': newsletter_data.get('template', 'announcement'),
+            'newsletter_title': newsletter_data.get('title', subject),
+            'newsletter_content': newsletter_data.get('content', ''),
+            'highlight_text': newsletter_data.get('highlight_text', ''),
+            'cta_text': newsletter_data.get('cta_text', ''),
+            'cta_url': newsletter_data.get('cta_url', ''),
+            'event_date': newsletter_data.get('event_date', ''),
+            'event_time': newsletter_data.get('event_time', ''),
+            'event_location': newsletter_data.get('event_location', ''),
+            'flyer_images': newsletter_data.get('flyer_images', []),
+        }
+    except (json.JSONDecodeError, AttributeError):
+        return {
+            'template_type': data.get('templateType', 'announcement'),
+            'newsletter_title': subject,
+            'newsletter_content': message,
+            'highlight_text': '',
+            'cta_text': '',
+            'cta_url': '',
+            'event_date': '',
+            'event_time': '',
+            'event_location': '',
+            'flyer_images': [],
+        }
+
+
+def _upsert_subscribers(recipients, device_id):
+    """Auto-save/update subscribers from a recipients list.
+    Returns (new_subscribers, updated_subscribers).
+    """
+    new_subscribers = 0
+    updated_subscribers = 0
     for recipient_email in recipients:
         try:
             subscriber, created = Subscriber.objects.get_or_create(
@@ -256,172 +244,445 @@ def sendBroadcastEmail(request, device_id):
                 updated_subscribers += 1
         except Exception:
             pass
+    record_subscribers(device_id, added=new_subscribers, reactivated=updated_subscribers)
+    return new_subscribers, updated_subscribers
 
-    # Create broadcast log
+
+# Request keys replayed by the dispatcher for scheduled broadcasts and read
+# by the shard workers. The payload is cleared once the broadcast finishes.
+BROADCAST_PAYLOAD_KEYS = ('subject', 'message', 'recipients', 'senderName', 'templateType', 'shardSize', 'transport')
+
+
+def _broadcast_payload(data, recipients=False):
+    """Only deferred sends need the recipients; shard workers read theirs
+    from the partitions."""
+    return json.dumps({
+        key: data[key] for key in BROADCAST_PAYLOAD_KEYS
+        if key in data and (recipients or key != 'recipients')
+    })
+
+
+def _schedule_broadcast(data, device_id, broadcast_id, send_at):
+    """Store a broadcast for the dispatcher instead of sending it now"""
     broadcast_log = BroadcastLog.objects.create(
         device_id=device_id,
         broadcast_id=broadcast_id,
-        subject=subject,
-        message=message,
-        sender_email=sender_email,
-        sender_name=sender_name,
-        recipients_count=len(recipients),
-        status='pending'
+        subject=data['subject'],
+        message=data['message'],
+        sender_email=settings.DEFAULT_FROM_EMAIL,
+        sender_name=data.get('senderName', ''),
+        recipients_count=len(data['recipients']),
+        status='scheduled',
+        send_at=send_at,
+        spread_seconds=int(data.get('spreadSeconds') or 0),
+        send_rate=data.get('sendRate') or None,
+        payload=_broadcast_payload(data, recipients=True),
     )
+    notify_dispatcher()
+    logger.info(f"Broadcast {broadcast_id} scheduled for {send_at.isoformat()}")
 
-    # Require SendGrid for all sending (no SMTP fallback)
-    sent_count = 0
-    failed_count = 0
-    failed_emails = []
+    return Response({
+        'broadcast_id': broadcast_id,
+        'subject': broadcast_log.subject,
+        'recipients_count': broadcast_log.recipients_count,
+        'status': broadcast_log.status,
+        'send_at': send_at.isoformat(),
+        'spread_seconds': broadcast_log.spread_seconds,
+        'send_rate': broadcast_log.send_rate,
+    }, status=202)
 
-    # Log the default from email used for broadcasts
-    logger.info(f"Broadcasts will use DEFAULT_FROM_EMAIL={settings.DEFAULT_FROM_EMAIL}")
 
-    if not SENDGRID_AVAILABLE or not getattr(settings, 'SENDGRID_API_KEY', ''):
-        broadcast_log.status = 'failed'
-        broadcast_log.save()
-        logger.error('SendGrid not available or SENDGRID_API_KEY missing; broadcasts aborted')
-        return Response({'status': 'error', 'message': 'SendGrid not configured on server'}, status=500)
+def sendBroadcastEmail(request, device_id):
+    """
+    Send broadcast emails to multiple recipients at once.
+    Expects: { subject, message, recipients, senderEmail, senderName, broadcastId }
+    Optional: { sendAt, spreadSeconds, sendRate } to schedule and pace the broadcast,
+    { shardSize } to split it into partitions sent by `run_broadcast_worker` processes.
+    """
+    data = request.data
+    timer = BroadcastTimer()
+
+    with timer.phase('validation'):
+        # Validate required fields
+        if 'subject' not in data:
+            return Response({'error': 'Subject field is required'}, status=400)
+
+        if 'message' not in data:
+            return Response({'error': 'Message field is required'}, status=400)
+
+        if 'recipients' not in data or not isinstance(data['recipients'], list) or len(data['recipients']) == 0:
+            return Response({'error': 'Recipients list is required and must contain at least one email'}, status=400)
+
+        broadcast_id = data.get('broadcastId', str(uuid.uuid4()))
+
+        # Future or paced broadcasts are handed to the dispatcher so the request
+        # does not block for the whole send window
+        try:
+            send_at = schedule_time(data.get('sendAt'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+    paced = bool(data.get('spreadSeconds')) or bool(data.get('sendRate'))
+    if paced or (send_at and send_at > timezone.now()):
+        return _schedule_broadcast(data, device_id, broadcast_id, send_at or timezone.now())
 
+    if data.get('shardSize'):
+        response_data, status = startShardedBroadcast(data, device_id, broadcast_id=broadcast_id, timer=timer)
+        return Response(response_data, status=status)
+
+    response_data, status = runBroadcast(data, device_id, broadcast_id=broadcast_id, timer=timer)
+    return Response(response_data, status=status)
+
+
+def _prepare_broadcast(data):
+    """Resolve everything that is shared by all recipients of a broadcast:
+    the parsed newsletter, the template and the image URLs.
+    """
+    newsletter = _parse_newsletter(data)
+    template_type = newsletter['template_type']
+
+    # Image URLs are resolved once at start-up
+    images = image_urls()
+    base_context = {
+        'newsletter_title': newsletter['newsletter_title'],
+        'newsletter_content': newsletter['newsletter_content'],
+        'highlight_text': newsletter['highlight_text'],
+        'cta_text': newsletter['cta_text'],
+        'cta_url': newsletter['cta_url'],
+        'year': datetime.now().year,
+        # Firebase Storage URLs (no encoding!)
+        'icon2_image': images.get('icon2', ''),
+        'qr_code_image': images.get('qr_code', ''),
+        'icon_image': images.get('icon', ''),
+        'logo_image': images.get('logo', ''),
+        'background_image': images.get('header_bg', ''),
+        'background_header_image': images.get('header_bg', ''),
+        'background_footer_image': images.get('footer_bg', ''),
+        'flyer_images': newsletter['flyer_images'],  # Dynamic flyer images from admin upload
+        'instagram_icon': images.get('instagram', ''),
+        'tiktok_icon': images.get('tiktok', ''),
+        'x_icon': images.get('twitter', ''),
+        'whatsapp_icon': images.get('whatsapp', ''),
+    }
+
+    # Add event-specific fields if template type is 'event'
+    if template_type == 'event':
+        base_context.update({
+            'event_title': newsletter['newsletter_title'],
+            'event_date': newsletter['event_date'],
+            'event_time': newsletter['event_time'],
+            'event_location': newsletter['event_location'],
+        })
+
+    # Select template based on type
+    template_name = 'newsletter-event.html' if template_type == 'event' else 'newsletter-announcement.html'
+
+    # Render once per newsletter (previews, batches and re-sends share the
+    # cached render); merge tags and the unsubscribe link are filled in per
+    # recipient from the compiled segments
+    rendered = render_newsletter(template_name, dict(base_context, unsubscribe_url=UNSUBSCRIBE_PLACEHOLDER))
+
+    return {
+        'subject': data['subject'],
+        'sender_name': data.get('senderName', ''),
+        'template_name': template_name,
+        'context': base_context,
+        'html': rendered['html'],
+        'text': rendered['text'],
+        'render': rendered,
+        'merge': personalize.compile_message(data['subject'], rendered['html'], rendered['text']),
+    }
+
+
+def _unsubscribe_url(recipient_email):
+    # Generate unsubscribe URL for Angular frontend
+    return f'https://restless-society.web.app/unsubscribe?email={quote(recipient_email, safe="@")}'
+
+
+def _recipient_values(recipient_email, fields=None):
+    """Merge tag values of one recipient (see core.personalize)"""
+    return dict(fields or {}, email=recipient_email, unsubscribe_url=_unsubscribe_url(recipient_email))
+
+
+def _preview_response(request, rendered, subject=None):
+    # Previews are personalised for ?email= (its subscriber fields when it is
+    # one, the merge tag defaults otherwise)
+    preview_email = request.query_params.get('email', 'preview@example.com')
+    merge = personalize.compile_message(subject or '', rendered['html'], rendered['text'])
+    fields = personalize.subscriber_fields([preview_email]).get(normalize_email(preview_email))
+    subject_content, html, text = merge.render(_recipient_values(preview_email, fields))
+    # (not ?format=, which DRF reserves for renderer selection)
+    if request.query_params.get('html') in ('1', 'true'):
+        return HttpResponse(html, content_type='text/html; charset=utf-8')
+    return Response({
+        'render_key': rendered['key'],
+        'cached': rendered['cached'],
+        'template': rendered['template'],
+        'template_version': rendered['version'],
+        'subject': subject_content if subject is not None else None,
+        'merge_fields': sorted(merge.fields),
+        'html': html,
+        'text': text,
+    })
+
+
+def previewBroadcast(request):
+    """
+    Render a broadcast without sending it. Expects the broadcast body
+    ({ subject, message }); the render is cached, so the broadcast that
+    follows reuses it.
+    """
+    data = request.data
+    if 'subject' not in data:
+        return Response({'error': 'Subject field is required'}, status=400)
+    if 'message' not in data:
+        return Response({'error': 'Message field is required'}, status=400)
+
+    prepared = _prepare_broadcast(data)
+    return _preview_response(request, prepared['render'], subject=prepared['subject'])
+
+
+def getBroadcastPreview(request, render_key):
+    """A previous preview by its render key, while it is still cached"""
+    rendered = cached_render(render_key)
+    if rendered is None:
+        return Response({'error': 'Preview not found (expired from the render cache)'}, status=404)
+    return _preview_response(request, rendered)
+
+
+def _send_broadcast_recipient(transport, prepared, recipient_email, fields=None, timer=None):
+    """Send a prepared broadcast to one recipient, personalised with its
+    merge `fields`. Raises on provider failure.
+    """
+    timer = timer or BroadcastTimer()
+    started = time.perf_counter()
+    subject, html_content, text_content = prepared['merge'].render(_recipient_values(recipient_email, fields))
+    rendered = time.perf_counter()
+    timer.add('render', rendered - started)
+
+    with lanes.slot('bulk'):
+        calling = time.perf_counter()
+        timer.add('queue', calling - rendered)
+        try:
+            transport.send(recipient_email, subject, html_content, text_content, prepared.get('custom_args'))
+        finally:
+            timer.call(time.perf_counter() - calling)
+
+
+def _deliver(transport, prepared, recipients, pacer=None, progress=None, timer=None):
+    """Send a prepared broadcast to `recipients`, several at a time when the
+    transport allows it. Returns (sent_count, failed_emails).
+    """
+    timer = timer or BroadcastTimer()
+    started = time.perf_counter()
+    # One query per chunk of recipients, and none unless a merge tag needs it
+    with timer.phase('render'):
+        fields = personalize.subscriber_fields(recipients) if prepared['merge'].needs_subscriber_fields else {}
+
+    def send(recipient_email):
+        try:
+            _send_broadcast_recipient(transport, prepared, recipient_email,
+                                      fields.get(normalize_email(recipient_email)), timer)
+            result = None
+        except Exception as e:
+            result = {'email': recipient_email, 'error': str(e)}
+        if progress is not None:
+            progress.record(result is None)
+        return result
+
+    results = []
+    if transport.concurrency > 1:
+        with ThreadPoolExecutor(max_workers=transport.concurrency) as executor:
+            futures = []
+            for recipient_email in recipients:
+                if pacer is not None:
+                    pacer.wait()
+                futures.append(executor.submit(send, recipient_email))
+            results = [future.result() for future in futures]
+    else:
+        for recipient_email in recipients:
+            if pacer is not None:
+                pacer.wait()
+            results.append(send(recipient_email))
+
+    failed_emails = [result for result in results if result is not None]
+    timer.add('delivery', time.perf_counter() - started)
+    return len(results) - len(failed_emails), failed_emails
+
+
+def _broadcast_status(sent_count, failed_count):
+    if failed_count == 0:
+        return 'sent'
+    if sent_count == 0:
+        return 'failed'
+    return 'partial'
+
+
+def _record_broadcast_email(device_id, subject, message):
+    """Save broadcast email once"""
     try:
-        sg_client = SendGridAPIClient(getattr(settings, 'SENDGRID_API_KEY'))
-        logger.info('SendGrid client initialized for broadcasts')
-    except Exception as e:
+        Emails.objects.create(
+            device_id=device_id,
+            subject=subject,
+            message=message[:500],
+            email=settings.DEFAULT_FROM_EMAIL
+        )
+    except Exception:
+        pass
+
+
+def _broadcast_transport(broadcast_log, name=None):
+    """Create the transport for a broadcast, marking the log as failed when
+    it is unavailable. Returns (transport, error_response).
+    """
+    try:
+        transport = create_transport(name)
+        logger.info(f'{transport.name} transport initialized for broadcasts')
+    except TransportError as e:
+        broadcast_log.status = 'failed'
+        broadcast_log.payload = ''
+        broadcast_log.save()
+        record_broadcast(broadcast_log)
+        logger.error(f'Broadcast transport unavailable ({e}); broadcasts aborted')
+        return None, ({'status': 'error', 'message': str(e)}, 500)
+    except Exception:
         broadcast_log.status = 'failed'
+        broadcast_log.payload = ''
         broadcast_log.save()
-        logger.exception('Failed to initialize SendGrid client')
-        return Response({'status': 'error', 'message': 'Failed to initialize SendGrid client'}, status=500)
-
-    # Load image URLs from settings (prefer NEWSLETTER_IMAGES dict)
-    icon2_url = _get_image_url('icon2')
-    qr_code_url = _get_image_url('qr_code')
-    icon_url = _get_image_url('icon')
-    instagram_icon_url = _get_image_url('instagram')
-    tiktok_icon_url = _get_image_url('tiktok')
-    twitter_icon_url = _get_image_url('twitter')
-    whatsapp_icon_url = _get_image_url('whatsapp')
-    header_bg_url = _get_image_url('header_bg')
-    footer_bg_url = _get_image_url('footer_bg')
+        record_broadcast(broadcast_log)
+        logger.exception('Failed to initialize broadcast transport')
+        return None, ({'status': 'error', 'message': 'Failed to initialize email transport'}, 500)
+    return transport, None
 
-    for recipient_email in recipients:
-        try:
-            # Generate unsubscribe URL for Angular frontend
-            unsubscribe_url = f'https://restless-society.web.app/unsubscribe?email={recipient_email}'
-
-            # Create context for template with parsed newsletter data
-            context = {
-                'newsletter_title': newsletter_title,
-                'newsletter_content': newsletter_content,
-                'highlight_text': highlight_text,
-                'cta_text': cta_text,
-                'cta_url': cta_url,
-                'year': datetime.now().year,
-                'unsubscribe_url': unsubscribe_url,
-                # Firebase Storage URLs (no encoding!)
-                'icon2_image': icon2_url,
-                'qr_code_image': qr_code_url,
-                'icon_image': icon_url,
-                'background_header_image': header_bg_url,
-                'background_footer_image': footer_bg_url,
-                'flyer_images': flyer_images,  # Dynamic flyer images from admin upload
-                'instagram_icon': instagram_icon_url,
-                'tiktok_icon': tiktok_icon_url,
-                'x_icon': twitter_icon_url,
-                'whatsapp_icon': whatsapp_icon_url,
-            }
-            
-            # Add event-specific fields if template type is 'event'
-            if template_type == 'event':
-                context.update({
-                    'event_title': newsletter_title,
-                    'event_date': event_date,
-                    'event_time': event_time,
-                    'event_location': event_location,
-                })
-            
-            # Select template based on type
-            template_name = 'newsletter-event.html' if template_type == 'event' else 'newsletter-announcement.html'
-
-            # Render HTML template
-            try:
-                html_content = render_to_string(template_name, context)
-                text_content = strip_tags(html_content)
-                
-                # Create a fixed plain text message
-                debug_text = f"""
-{newsletter_title}
 
-{newsletter_content}
+def startShardedBroadcast(data, device_id, broadcast_id=None, broadcast_log=None, timer=None):
+    """
+    Split a validated broadcast into partitions for the shard workers and
+    return (response_data, http_status). Sending happens in the workers;
+    progress and phase timings roll up into the BroadcastLog.
+    """
+    timer = timer or BroadcastTimer()
+    # Bounced / complained addresses are neither sent to nor re-subscribed
+    with timer.phase('validation'):
+        recipients, suppressed = webhooks.exclude_suppressed(data['recipients'])
+    if broadcast_log is not None:
+        broadcast_id = broadcast_log.broadcast_id
+    elif not broadcast_id:
+        broadcast_id = str(uuid.uuid4())
 
-{highlight_text if highlight_text else ''}
+    with timer.phase('upsert'):
+        new_subscribers, updated_subscribers = _upsert_subscribers(recipients, device_id)
 
-{cta_text if cta_text else ''}: {cta_url if cta_url else ''}
+    with timer.phase('bookkeeping'):
+        if broadcast_log is None:
+            broadcast_log = BroadcastLog.objects.create(
+                device_id=device_id,
+                broadcast_id=broadcast_id,
+                subject=data['subject'],
+                message=data['message'],
+                sender_email=settings.DEFAULT_FROM_EMAIL,
+                sender_name=data.get('senderName', ''),
+                recipients_count=len(recipients),
+                status='pending',
+                payload=_broadcast_payload(data),
+            )
+        else:
+            # A scheduled broadcast: the partitions hold the recipients from now on
+            broadcast_log.payload = _broadcast_payload(data)
+            broadcast_log.save(update_fields=['payload'])
+        partitions = create_partitions(broadcast_log, recipients, data['shardSize'])
+    # Workers merge their partitions into it (core.sharding.rollup)
+    state = timer.state()
+    timing = save_timing(broadcast_log, state, request_state=state)
+    logger.info(f"Broadcast {broadcast_id} split into {partitions} partition(s) for shard workers")
 
----
-This email was sent by {sender_name}
-Year: {datetime.now().year}
-                """.strip()
-                
-                text_content = debug_text
-                
-            except Exception as render_error:
-                raise
+    return {
+        'broadcast_id': broadcast_id,
+        'subject': broadcast_log.subject,
+        'recipients_count': len(recipients),
+        'partitions': partitions,
+        'status': broadcast_log.status,
+        'suppressed_count': len(suppressed),
+        'timing': timing,
+        'subscribers_added': new_subscribers,
+        'subscribers_reactivated': updated_subscribers
+    }, 202
 
-            # Prepare from_email
-            if sender_name and '@' not in sender_name:
-                from_email_formatted = f'{sender_name} <{sender_email}>'
-            else:
-                from_email_formatted = sender_email
-
-            # Send email via SendGrid or SMTP
-           
-            # Send via SendGrid
-            try:
-                msg = Mail(
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to_emails=recipient_email,
-                    subject=subject,
-                    html_content=html_content
-                )
-                response = sg_client.send(msg)
-                logger.info(f'SendGrid response: status={getattr(response, "status_code", None)}')
-                status_code = getattr(response, 'status_code', 0)
-                if status_code < 200 or status_code >= 300:
-                    raise Exception(f'SendGrid send failed, status={status_code}')
-                sent_count += 1
-            except Exception:
-                raise
-            
-        except Exception as e:
-            failed_count += 1
-            failed_emails.append({'email': recipient_email, 'error': str(e)})
 
-    # No SMTP connection to close when using SendGrid
+def runBroadcast(data, device_id, broadcast_id=None, broadcast_log=None, pacer=None, timer=None):
+    """
+    Send a validated broadcast and return (response_data, http_status).
+    Used directly by the broadcast endpoint and by the dispatcher for
+    scheduled broadcasts (which pass their existing `broadcast_log` and a `pacer`).
+    The time spent in each phase is stored as the broadcast's BroadcastTiming.
+    """
+    timer = timer or BroadcastTimer()
+    # Get broadcast details
+    subject = data['subject']
+    message = data['message']
+    # Bounced / complained addresses are neither sent to nor re-subscribed
+    with timer.phase('validation'):
+        recipients, suppressed = webhooks.exclude_suppressed(data['recipients'])
+    # Always use DEFAULT_FROM_EMAIL as the sender address (ignore any senderEmail provided)
+    sender_email = settings.DEFAULT_FROM_EMAIL
+    sender_name = data.get('senderName', '')
+    if broadcast_log is not None:
+        broadcast_id = broadcast_log.broadcast_id
+    elif not broadcast_id:
+        broadcast_id = str(uuid.uuid4())
 
-    # Save broadcast email once
-    if sent_count > 0:
-        try:
-            Emails.objects.create(
+    # Auto-save/update subscribers from recipients list
+    with timer.phase('upsert'):
+        new_subscribers, updated_subscribers = _upsert_subscribers(recipients, device_id)
+
+    # Create broadcast log (scheduled broadcasts already have one)
+    with timer.phase('bookkeeping'):
+        if broadcast_log is None:
+            broadcast_log = BroadcastLog.objects.create(
                 device_id=device_id,
+                broadcast_id=broadcast_id,
                 subject=subject,
-                message=message[:500],
-                email=sender_email
+                message=message,
+                sender_email=sender_email,
+                sender_name=sender_name,
+                recipients_count=len(recipients),
+                status='pending'
             )
-        except Exception:
-            pass
 
-    # Update broadcast log
-    broadcast_log.sent_count = sent_count
-    broadcast_log.failed_count = failed_count
-    
-    if failed_count == 0:
-        broadcast_log.status = 'sent'
-    elif sent_count == 0:
-        broadcast_log.status = 'failed'
-    else:
-        broadcast_log.status = 'partial'
-    
-    broadcast_log.save()
+    # Log the default from email used for broadcasts
+    logger.info(f"Broadcasts will use DEFAULT_FROM_EMAIL={settings.DEFAULT_FROM_EMAIL}")
+
+    transport, error = _broadcast_transport(broadcast_log, data.get('transport'))
+    if error:
+        return error
+
+    # Parse the message JSON to extract newsletter data
+    with timer.phase('render'):
+        prepared = _prepare_broadcast(data)
+    # Echoed back on the provider's event webhooks
+    prepared['custom_args'] = {'broadcast_id': broadcast_id}
+    progress = ProgressTracker(broadcast_id, len(recipients))
+    started = time.monotonic()
+    try:
+        sent_count, failed_emails = _deliver(transport, prepared, recipients, pacer, progress, timer)
+    finally:
+        transport.close()
+    failed_count = len(failed_emails)
+    transport_stats = transport_report(transport, sent_count, failed_count, time.monotonic() - started)
+
+    with timer.phase('bookkeeping'):
+        if sent_count > 0:
+            _record_broadcast_email(device_id, subject, message)
+
+        # Update broadcast log
+        broadcast_log.sent_count = sent_count
+        broadcast_log.failed_count = failed_count
+        broadcast_log.status = _broadcast_status(sent_count, failed_count)
+        broadcast_log.transport_stats = transport_stats
+        broadcast_log.payload = ''
+        broadcast_log.save()
+        record_broadcast(broadcast_log)
+        progress.finish(broadcast_log.status)
+    timing = save_timing(broadcast_log, timer.state())
 
     # Prepare response
     response_data = {
@@ -430,7 +691,10 @@ Year: {datetime.now().year}
         'recipients_count': len(recipients),
         'sent_count': sent_count,
         'failed_count': failed_count,
+        'suppressed_count': len(suppressed),
         'status': broadcast_log.status,
+        'transport_stats': transport_stats,
+        'timing': timing,
         'subscribers_added': new_subscribers,
         'subscribers_reactivated': updated_subscribers
     }
@@ -438,7 +702,304 @@ Year: {datetime.now().year}
     if failed_emails:
         response_data['failed_emails'] = failed_emails
 
-    return Response(response_data, status=200 if sent_count > 0 else 500)
+    return response_data, 200 if sent_count > 0 or not recipients else 500
+
+
+# Search functions
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+
+def searchNewsletters(request, device_id):
+    """
+    Ranked full-text search over sent emails and broadcasts.
+    Query params: q (required), type (email|broadcast), page, page_size
+    """
+    params = request.query_params
+    query = params.get('q', '').strip()
+    if not query:
+        return Response({'error': 'Query parameter q is required'}, status=400)
+    kind = params.get('type') or None
+    if kind not in (None, 'email', 'broadcast'):
+        return Response({'error': 'type must be email or broadcast'}, status=400)
+    try:
+        page = max(int(params.get('page', 1)), 1)
+        page_size = min(max(int(params.get('page_size', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return Response({'error': 'page and page_size must be integers'}, status=400)
+
+    try:
+        results, has_more = search(query, device_id=device_id, kind=kind, limit=page_size, offset=(page - 1) * page_size)
+    except SearchUnavailable as e:
+        return Response({'error': str(e)}, status=501)
+
+    return Response({
+        'query': query,
+        'page': page,
+        'page_size': page_size,
+        'has_more': has_more,
+        'results': results,
+    })
+
+
+# Broadcast history functions
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def _encode_cursor(broadcast_log):
+    raw = f"{broadcast_log.created_at.isoformat()}|{broadcast_log.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """Return (created_at, id) of the last row of the previous page"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.rsplit('|', 1)
+        created_at = parse_datetime(created_at)
+        if created_at is None:
+            raise ValueError
+        return created_at, int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def getBroadcastHistory(request, device_id):
+    """
+    Broadcast history, newest first, with keyset pagination on (created_at, id).
+    Pass the returned `next_cursor` as `cursor` to get the following page.
+    The message body is not loaded; use the detail endpoint for it.
+    """
+    params = request.query_params
+    try:
+        limit = min(max(int(params.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return Response({'error': 'limit must be an integer'}, status=400)
+
+    broadcasts = (BroadcastLog.objects.only(*BROADCAST_LIST_FIELDS, *BROADCAST_TIMING_FIELDS).select_related('timing')
+                  .order_by('-created_at', '-id'))
+    if device_id:
+        broadcasts = broadcasts.filter(device_id=device_id)
+    if params.get('status'):
+        broadcasts = broadcasts.filter(status=params['status'])
+    if params.get('cursor'):
+        try:
+            created_at, pk = _decode_cursor(params['cursor'])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        broadcasts = broadcasts.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    # One extra row tells whether there is a next page without a COUNT
+    page = list(broadcasts[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    return Response({
+        'results': BroadcastLogListSerializer(page, many=True).data,
+        'next_cursor': _encode_cursor(page[-1]) if has_more else None,
+        'has_more': has_more,
+    })
+
+
+def getBroadcastDetail(request, broadcast_id, device_id):
+    """A single broadcast including its message body"""
+    broadcasts = BroadcastLog.objects.defer('payload', 'timing__request_state').select_related('timing')
+    if device_id:
+        broadcasts = broadcasts.filter(device_id=device_id)
+    broadcast_log = broadcasts.filter(broadcast_id=broadcast_id).first()
+    if broadcast_log is None:
+        return Response({'error': 'Broadcast not found'}, status=404)
+    return Response(BroadcastLogSerializer(broadcast_log).data)
+
+
+# Broadcast progress functions
+def _broadcast_progress(broadcast_id):
+    """Latest progress snapshot: from the cache, or once from the database."""
+    snapshot = get_progress(broadcast_id)
+    if snapshot is not None:
+        return snapshot
+    broadcast_log = BroadcastLog.objects.filter(broadcast_id=broadcast_id).first()
+    if broadcast_log is None:
+        return None
+    return snapshot_from_log(broadcast_log)
+
+
+def getProviderStats(request):
+    """Keep-alive connection pool statistics and transport circuit breakers
+    of this worker process"""
+    return Response(dict(pool_stats(), breakers=breaker_states()))
+
+
+def _seconds_since(moment, now):
+    return round((now - moment).total_seconds(), 1) if moment else 0
+
+
+def getLaneStats(request):
+    """
+    Depth and wait times of the transactional and bulk send lanes of this
+    worker process, and the bulk work queued in the database (due scheduled
+    broadcasts, unfinished partitions of sharded ones)
+    """
+    now = timezone.now()
+    due = BroadcastLog.objects.filter(status='scheduled', send_at__lte=now).aggregate(
+        broadcasts=Count('id'), recipients=Sum('recipients_count'), oldest=Min('send_at'))
+    partitions = BroadcastPartition.objects.exclude(status__in=PARTITION_FINISHED).aggregate(
+        partitions=Count('id'),
+        unclaimed=Count('id', filter=Q(status='pending')),
+        recipients=Sum(F('recipients_count') - F('cursor')),
+        oldest=Min('broadcast__created_at', filter=Q(status='pending')),
+    )
+    return Response(dict(lanes.lane_stats(), backlog={
+        'scheduled': {
+            'broadcasts': due['broadcasts'],
+            'recipients': due['recipients'] or 0,
+            'oldest_wait_seconds': _seconds_since(due['oldest'], now),
+        },
+        'partitions': {
+            'open': partitions['partitions'],
+            'unclaimed': partitions['unclaimed'],
+            'recipients': partitions['recipients'] or 0,
+            'oldest_wait_seconds': _seconds_since(partitions['oldest'], now),
+        },
+    }))
+
+
+def ingestProviderEvents(request):
+    """
+    SendGrid event webhook: validate the batch, buffer its events and answer
+    right away; they are written in bulk by core.webhooks
+    """
+    options = webhooks.webhook_settings()
+    # Before request.data: signatures cover the raw body
+    error = webhooks.authenticate(request, options)
+    if error:
+        return Response({'error': error}, status=403)
+
+    payload = request.data
+    if isinstance(payload, list) and len(payload) > options['max_batch']:
+        return Response({'error': f"At most {options['max_batch']} events per request"}, status=413)
+    try:
+        events, rejected = webhooks.parse_events(payload)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+
+    if options['record_dir']:
+        webhooks.record_payload(payload, options['record_dir'])
+    pending = webhooks.get_buffer().add(events)
+    return Response({'accepted': len(events), 'rejected': rejected, 'pending': pending})
+
+
+def getBroadcastProgress(request, broadcast_id):
+    """Sent, failed and remaining counts with the current rate and ETA"""
+    snapshot = _broadcast_progress(broadcast_id)
+    if snapshot is None:
+        return Response({'error': 'Broadcast not found'}, status=404)
+    return Response(snapshot)
+
+
+def _progress_event_id(snapshot):
+    return f"{snapshot['version']}:{snapshot['timestamp']}"
+
+
+def _progress_events(broadcast_id, last_event_id=None):
+    interval = getattr(settings, 'BROADCAST_PROGRESS_STREAM_INTERVAL', 1.0)
+    timeout = getattr(settings, 'BROADCAST_PROGRESS_STREAM_TIMEOUT', 30)
+    keepalive = 15
+    deadline = time.monotonic() + timeout
+    last_write = time.monotonic()
+
+    yield 'retry: 2000\n\n'
+    while time.monotonic() < deadline:
+        snapshot = get_progress(broadcast_id)
+        if snapshot is not None:
+            event_id = _progress_event_id(snapshot)
+            if event_id != last_event_id:
+                last_event_id = event_id
+                last_write = time.monotonic()
+                yield f"id: {event_id}\nevent: progress\ndata: {json.dumps(snapshot)}\n\n"
+            if snapshot['status'] in FINAL_STATUSES:
+                yield 'event: done\ndata: {}\n\n'
+                return
+        if time.monotonic() - last_write >= keepalive:
+            last_write = time.monotonic()
+            yield ': keepalive\n\n'
+        time.sleep(interval)
+    # Clients reconnect automatically (EventSource) with Last-Event-ID and resume from the cache
+    yield 'event: timeout\ndata: {}\n\n'
+
+
+def streamBroadcastProgress(request, broadcast_id):
+    """Server-Sent Events stream of progress snapshots until the broadcast finishes
+    (or BROADCAST_PROGRESS_STREAM_TIMEOUT; clients reconnect). Watchers poll the
+    cache only, never the database. Each stream holds a worker thread, so there
+    are at most BROADCAST_PROGRESS_STREAM_MAX per process.
+    """
+    if _broadcast_progress(broadcast_id) is None:
+        return JsonResponse({'error': 'Broadcast not found'}, status=404)
+    if not open_stream():
+        response = JsonResponse({'error': 'Too many progress streams, poll the progress endpoint instead'}, status=503)
+        response['Retry-After'] = '5'
+        return response
+    events = _progress_events(broadcast_id, request.headers.get('Last-Event-ID'))
+    response = StreamingHttpResponse(StreamSlot(events), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Analytics functions
+def _analytics_range(request):
+    """(start, end) from the `days` query parameter (1-366, default 30)"""
+    try:
+        days = int(request.query_params.get('days', 30))
+    except (TypeError, ValueError):
+        raise ValueError('days must be an integer')
+    if not 1 <= days <= 366:
+        raise ValueError('days must be between 1 and 366')
+    return date_range(days)
+
+
+def getAnalytics(request, device_id):
+    """Daily sends, failure rate and subscriber growth, read from the rollups"""
+    try:
+        start, end = _analytics_range(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+
+    broadcasts = broadcast_series(start, end, device_id)
+    subscribers = subscriber_series(start, end, device_id)
+    sent = sum(day['sent'] for day in broadcasts)
+    failed = sum(day['failed'] for day in broadcasts)
+    return Response({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'totals': {
+            'broadcasts': sum(day['broadcasts'] for day in broadcasts),
+            'recipients': sum(day['recipients'] for day in broadcasts),
+            'sent': sent,
+            'failed': failed,
+            'failure_rate': round(failed / (sent + failed), 4) if sent + failed else 0.0,
+            'subscribers_net': sum(day['net'] for day in subscribers),
+            'subscribers_active': subscribers[-1]['active'],
+        },
+        'broadcasts': broadcasts,
+        'subscribers': subscribers,
+    })
+
+
+def getDeviceAnalytics(request):
+    """Failure rate per device_id, read from the rollups"""
+    try:
+        start, end = _analytics_range(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+    return Response({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'devices': device_failure_rates(start, end),
+    })
 
 
 # Subscriber functions
@@ -453,6 +1014,21 @@ def getSubscriberList(request, device_id):
     return Response(serializer.data)
 
 
+def _subscriber_fields(data, current=None):
+    """Merge fields of a subscriber after a request that may carry `fields`
+    and/or `name` (which also sets first_name). Raises ValueError."""
+    fields = dict(current or {})
+    given = personalize.clean_fields(data['fields']) if data.get('fields') is not None else {}
+    name = data.get('name')
+    if name:
+        if not isinstance(name, str) or len(name) > personalize.MAX_FIELD_LENGTH:
+            raise ValueError('name must be a string')
+        fields['name'] = name.strip()
+        fields['first_name'] = name.split()[0] if name.split() else ''
+    fields.update(given)
+    return fields
+
+
 def createSubscriber(request, device_id):
     """Create a new subscriber or reactivate existing one"""
     data = request.data
@@ -461,6 +1037,10 @@ def createSubscriber(request, device_id):
     if 'email' not in data:
         logger.error("Subscriber creation failed: Email field missing")
         return Response({'error': 'Email field is required'}, status=400)
+    try:
+        fields = _subscriber_fields(data)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
 
     # Use get_or_create to ensure only one record per email
     try:
@@ -468,12 +1048,16 @@ def createSubscriber(request, device_id):
             email=data['email'],
             defaults={
                 'device_id': device_id,
-                'is_active': True
+                'is_active': True,
+                'fields': fields,
             }
         )
+        if not created and fields:
+            subscriber.fields = dict(subscriber.fields, **fields)
         
         if created:
             logger.info(f"New subscriber created: {data['email']} (ID: {subscriber.id})")
+            record_subscribers(device_id, added=1)
             serializer = SubscriberSerializer(subscriber)
             return Response(serializer.data, status=201)
         else:
@@ -484,12 +1068,15 @@ def createSubscriber(request, device_id):
                 subscriber.is_active = True
                 subscriber.device_id = device_id
                 subscriber.save()
+                record_subscribers(device_id, reactivated=1)
                 serializer = SubscriberSerializer(subscriber)
                 logger.info(f"Subscriber reactivated successfully: {data['email']}")
                 return Response(serializer.data, status=200)
             else:
                 # Already active
                 logger.warning(f"Subscriber already exists and is active: {data['email']}")
+                if fields:
+                    subscriber.save(update_fields=['fields', 'updated_at'])
                 serializer = SubscriberSerializer(subscriber)
                 return Response(serializer.data, status=200)  # Return existing subscriber
                 
@@ -498,6 +1085,88 @@ def createSubscriber(request, device_id):
         return Response({'error': 'Failed to process subscriber'}, status=500)
 
 
+SUBSCRIBER_SEARCH_PAGE_SIZE = 50
+SUBSCRIBER_SEARCH_MAX_PAGE_SIZE = 500
+
+
+def _subscriber_search(query, after=None):
+    """Ordered index range for a search query:
+    '@example.com' -> everyone at example.com or one of its subdomains,
+    anything else -> emails starting with the query (case-insensitive).
+    `after` is the last email of the previous page.
+    """
+    query = normalize_email(query)
+    after = normalize_email(after) if after else None
+    if query.startswith('@'):
+        subscribers = Subscriber.objects.filter(domain_q(query))
+        if after:
+            after_domain = reversed_domain(after)
+            subscribers = subscribers.filter(
+                Q(domain_reversed__gt=after_domain) | Q(domain_reversed=after_domain, email_normalized__gt=after))
+        # Index order of core_sub_domain, so no sort is needed
+        return subscribers.order_by('domain_reversed', 'email_normalized')
+
+    # Range instead of LIKE so SQLite can use the index
+    subscribers = Subscriber.objects.filter(email_normalized__gte=query, email_normalized__lt=query + '\U0010ffff')
+    if after:
+        subscribers = subscribers.filter(email_normalized__gt=after)
+    return subscribers.order_by('email_normalized')
+
+
+def searchSubscribers(request, device_id):
+    """
+    Prefix ('ann', 'ann@ex') and domain ('@example.com') search over subscribers.
+    Query params: q (required), active (true/false), limit, after (next_after of the previous page)
+    """
+    params = request.query_params
+    query = params.get('q', '').strip()
+    if not query or query == '@':
+        return Response({'error': 'Query parameter q is required'}, status=400)
+    try:
+        limit = min(max(int(params.get('limit', SUBSCRIBER_SEARCH_PAGE_SIZE)), 1), SUBSCRIBER_SEARCH_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return Response({'error': 'limit must be an integer'}, status=400)
+
+    subscribers = _subscriber_search(query, params.get('after'))
+    if device_id:
+        subscribers = subscribers.filter(device_id=device_id)
+    if params.get('active') in ('true', 'false'):
+        subscribers = subscribers.filter(is_active=params['active'] == 'true')
+
+    page = list(subscribers[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    return Response({
+        'query': query,
+        'results': SubscriberSerializer(page, many=True).data,
+        'next_after': page[-1].email_normalized if has_more else None,
+        'has_more': has_more,
+    })
+
+
+def bulkUpdateSubscribers(request, device_id, data):
+    """Activate, deactivate or delete many subscribers at once (scoped to the
+    X-Device-ID when given). `data` is validated by SubscriberBulkSerializer."""
+    base = Subscriber.objects.all()
+    if device_id:
+        base = base.filter(device_id=device_id)
+
+    filters = after = None
+    if 'filter' in data:
+        filters = dict(data['filter'])
+        after = filters.pop('after', None)
+        if filters.get('device_id'):
+            filters['device_id'] = lookup_device(filters['device_id'])
+            if filters['device_id'] is None:
+                base = base.none()
+
+    result = bulk.apply(data['action'], base, ids=data.get('ids'), emails=data.get('emails'),
+                        filters=filters, after=after, dry_run=data['dry_run'])
+    logger.info(f"Bulk {data['action']} of subscribers: {result['changed']} changed, {result['matched']} matched"
+                f"{' (dry run)' if data['dry_run'] else ''}")
+    return Response(result)
+
+
 def getSubscriberDetail(request, pk, device_id):
     """Get a specific subscriber"""
     try:
@@ -523,9 +1192,16 @@ def updateSubscriber(request, pk, device_id):
         return Response({'error': 'Subscriber not found'}, status=404)
 
     data = request.data
+    try:
+        subscriber.fields = _subscriber_fields(data, subscriber.fields)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+    was_active = subscriber.is_active
     subscriber.email = data.get('email', subscriber.email)
     subscriber.is_active = data.get('is_active', subscriber.is_active)
     subscriber.save()
+    if bool(subscriber.is_active) != was_active:
+        record_subscribers(subscriber.device_id, reactivated=int(bool(subscriber.is_active)), deactivated=int(was_active))
 
     serializer = SubscriberSerializer(subscriber)
     return Response(serializer.data)
@@ -541,7 +1217,10 @@ def deleteSubscriber(request, pk, device_id):
         if '@' in str(pk):
             logger.info(f"Searching for subscriber by email: {pk}")
             # Don't filter by device_id for deletion - allow deleting any subscriber with matching email
-            subscriber = Subscriber.objects.get(email=pk)
+            # Case-insensitive match on the indexed normalised column
+            subscriber = Subscriber.objects.filter(email_normalized=normalize_email(pk)).order_by('id').first()
+            if subscriber is None:
+                raise Subscriber.DoesNotExist
             logger.info(f"Found subscriber: {subscriber.email} (ID: {subscriber.id}, Device: {subscriber.device_id})")
         else:
             # Otherwise, treat as ID
@@ -552,16 +1231,20 @@ def deleteSubscriber(request, pk, device_id):
                 subscriber = Subscriber.objects.get(id=pk)
     except Subscriber.DoesNotExist:
         logger.error(f"Subscriber not found: {pk}")
-        # Log all subscribers for debugging
-        all_subscribers = Subscriber.objects.all()
-        logger.debug(f"Total subscribers in database: {all_subscribers.count()}")
-        for sub in all_subscribers[:5]:  # Show first 5
-            logger.debug(f"  - {sub.email} (ID: {sub.id}, Active: {sub.is_active}, Device: {sub.device_id})")
+        # Log some subscribers for debugging (skipped unless DEBUG logging: COUNT(*) is a full scan)
+        if logger.isEnabledFor(logging.DEBUG):
+            all_subscribers = Subscriber.objects.all()
+            logger.debug(f"Total subscribers in database: {all_subscribers.count()}")
+            for sub in all_subscribers[:5]:  # Show first 5
+                logger.debug(f"  - {sub.email} (ID: {sub.id}, Active: {sub.is_active}, Device: {sub.device_id})")
         return Response({'error': 'Subscriber not found'}, status=404)
     
     # Soft delete by setting is_active to False
+    was_active = subscriber.is_active
     subscriber.is_active = False
     subscriber.save()
+    if was_active:
+        record_subscribers(subscriber.device_id, deactivated=1)
     logger.info(f"Subscriber deactivated successfully: {subscriber.email} (ID: {subscriber.id})")
     
     return Response({'message': 'Subscriber deactivated successfully'})
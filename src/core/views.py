@@ -1,11 +1,14 @@
 from django.shortcuts import render
-from .serializers import EmailSerializer, BroadcastSerializer
+from .serializers import EmailSerializer, BroadcastSerializer, SubscriberBulkSerializer
 from .models import Emails
 from django.core.mail import send_mail, EmailMultiAlternatives
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from .utils import *
+from .devices import resolve_device, scope_device
+from . import bulk
 import logging
 
 # Create your views here.
@@ -53,8 +56,80 @@ def getRoutes(request):
         {
             'Endpoint': '/broadcast/send',
             'method': 'POST',
-            'body': {'subject': "", 'message': "", 'recipients': [], 'senderEmail': "", 'senderName': "", 'broadcastId': ""},
-            'description': 'Sends broadcast emails to multiple recipients and auto-saves them as subscribers'
+            'body': {'subject': "", 'message': "", 'recipients': [], 'senderEmail': "", 'senderName': "", 'broadcastId': "", 'sendAt': "", 'spreadSeconds': 0, 'sendRate': None, 'shardSize': None, 'transport': "sendgrid"},
+            'description': 'Sends broadcast emails to multiple recipients and auto-saves them as subscribers. With a future sendAt (or spreadSeconds/sendRate pacing) the broadcast is scheduled for the dispatcher instead. With shardSize it is split into partitions sent by run_broadcast_worker processes. transport "smtp" sends over a pool of persistent SMTP connections. Subject and message may contain merge tags such as {{first_name|default:"there"}}, filled from each subscriber\'s fields. The response includes the time spent in each phase (timing)'
+        },
+        {
+            'Endpoint': '/broadcast/preview/?html=&email=',
+            'method': 'POST',
+            'body': {'subject': "", 'message': ""},
+            'description': 'Renders a broadcast without sending it (html=1 returns the page itself), personalised for email. The render is cached by content, so the broadcast that follows reuses it'
+        },
+        {
+            'Endpoint': '/broadcast/preview/render_key/?html=',
+            'method': 'GET',
+            'body': None,
+            'description': 'Returns a previous preview by its render_key while it is still cached'
+        },
+        {
+            'Endpoint': '/search/?q=&type=&page=1&page_size=20',
+            'method': 'GET',
+            'body': None,
+            'description': 'Ranked full-text search of sent emails and broadcasts by subject, newsletter title and content (scoped to X-Device-ID when given)'
+        },
+        {
+            'Endpoint': '/broadcasts/?limit=50&cursor=&status=',
+            'method': 'GET',
+            'body': None,
+            'description': 'Returns broadcast history newest first, without message bodies, with the phase timings of each broadcast. Pass next_cursor as cursor for the next page'
+        },
+        {
+            'Endpoint': '/broadcasts/id/',
+            'method': 'GET',
+            'body': None,
+            'description': 'Returns a single broadcast, including its message'
+        },
+        {
+            'Endpoint': '/broadcast/id/progress/',
+            'method': 'GET',
+            'body': None,
+            'description': 'Returns sent, failed and remaining counts, current rate and ETA of a broadcast'
+        },
+        {
+            'Endpoint': '/broadcast/id/progress/stream/',
+            'method': 'GET',
+            'body': None,
+            'description': 'Server-Sent Events stream of "progress" events until the broadcast finishes ("done" event). Streams end after BROADCAST_PROGRESS_STREAM_TIMEOUT ("timeout" event) and resume from Last-Event-ID; beyond BROADCAST_PROGRESS_STREAM_MAX open streams per process the answer is 503, poll the progress endpoint instead'
+        },
+        {
+            'Endpoint': '/analytics/?days=30',
+            'method': 'GET',
+            'body': None,
+            'description': 'Sends per day, failure rate and subscriber growth from the daily rollups (scoped to X-Device-ID when given)'
+        },
+        {
+            'Endpoint': '/analytics/devices/?days=30',
+            'method': 'GET',
+            'body': None,
+            'description': 'Broadcast failure rate per device_id from the daily rollups'
+        },
+        {
+            'Endpoint': '/providers/stats/',
+            'method': 'GET',
+            'body': None,
+            'description': 'Keep-alive connection pool statistics of the provider clients and transport circuit breaker states in the answering worker process'
+        },
+        {
+            'Endpoint': '/lanes/',
+            'method': 'GET',
+            'body': None,
+            'description': 'Depth and wait times of the transactional and bulk send lanes in the answering worker process, and the queued bulk backlog'
+        },
+        {
+            'Endpoint': '/webhooks/sendgrid/',
+            'method': 'POST',
+            'body': [{'event': "delivered", 'email': "", 'timestamp': 0, 'sg_event_id': "", 'sg_message_id': "", 'broadcast_id': ""}],
+            'description': 'SendGrid event webhook. Events are buffered and written in bulk; delivered/bounce/spamreport update the broadcast counts, hard bounces, spam reports and unsubscribes suppress the address and deactivate the subscriber'
         },
         {
             'Endpoint': '/subscribers/',
@@ -65,8 +140,20 @@ def getRoutes(request):
         {
             'Endpoint': '/subscribers/',
             'method': 'POST',
-            'body': {'email': "", 'name': ""},
-            'description': 'Creates a new subscriber or reactivates an existing one'
+            'body': {'email': "", 'name': "", 'fields': {'first_name': ""}},
+            'description': 'Creates a new subscriber or reactivates an existing one. fields are merge fields for {{first_name}}-style tags in broadcasts (name also sets first_name)'
+        },
+        {
+            'Endpoint': '/subscribers/search/?q=&active=&limit=50&after=',
+            'method': 'GET',
+            'body': None,
+            'description': 'Case-insensitive email prefix search (q=ann) or domain search (q=@example.com, includes subdomains). Pass next_after as after for the next page'
+        },
+        {
+            'Endpoint': '/subscribers/bulk/',
+            'method': 'POST',
+            'body': {'action': "deactivate", 'ids': [], 'emails': [], 'filter': {'device_id': "", 'domain': "", 'is_active': None, 'created_before': "", 'after': None}, 'dry_run': False},
+            'description': 'Activates, deactivates or deletes subscribers given by exactly one of ids, emails or filter, in chunked set-based queries. Returns matched/changed/unchanged/not_found counts. A filter handles at most SUBSCRIBER_BULK_MAX_ITEMS subscribers per request: when has_more, repeat it with after=next_after'
         },
         {
             'Endpoint': '/subscribers/id/',
@@ -77,8 +164,8 @@ def getRoutes(request):
         {
             'Endpoint': '/subscribers/id/',
             'method': 'PUT',
-            'body': {'email': "", 'name': "", 'is_active': True},
-            'description': 'Updates an existing subscriber'
+            'body': {'email': "", 'name': "", 'fields': {}, 'is_active': True},
+            'description': 'Updates an existing subscriber (given fields are merged into its merge fields)'
         },
         {
             'Endpoint': '/subscribers/id/',
@@ -91,7 +178,7 @@ def getRoutes(request):
 
 @api_view(['GET', 'POST'])
 def getEmails(request):
-    device_id = request.headers.get('X-Device-ID')
+    device_id = (resolve_device if request.method == 'POST' else scope_device)(request.headers.get('X-Device-ID'))
     logger.info(f"getEmails called - Method: {request.method}, Device ID: {device_id}")
     
     if request.method == 'GET':
@@ -103,7 +190,7 @@ def getEmails(request):
 
 @api_view(['GET', 'PUT', 'DELETE'])
 def getEmail(request, pk):
-    device_id = request.headers.get('X-Device-ID')
+    device_id = scope_device(request.headers.get('X-Device-ID'))
     if request.method == 'GET':
         return getEmailDetail(request, pk, device_id)
 
@@ -121,7 +208,7 @@ def broadcastEmail(request):
     Broadcast endpoint matching Angular's data structure.
     Expects: { subject, message, recipients, senderEmail, senderName, broadcastId }
     """
-    device_id = request.headers.get('X-Device-ID')
+    device_id = resolve_device(request.headers.get('X-Device-ID'))
     
     # Print recipients array
     recipients = request.data.get('recipients', [])
@@ -139,12 +226,113 @@ def broadcastEmail(request):
     return sendBroadcastEmail(request, device_id)
 
 
+@api_view(['GET'])
+def searchEmails(request):
+    """
+    Full-text search over sent emails and broadcasts
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    return searchNewsletters(request, device_id)
+
+
+@api_view(['GET'])
+def broadcasts(request):
+    """
+    Broadcast history (newest first, cursor paginated, without message bodies)
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    return getBroadcastHistory(request, device_id)
+
+
+@api_view(['GET'])
+def broadcastDetail(request, broadcast_id):
+    """
+    A single broadcast including its message
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    return getBroadcastDetail(request, broadcast_id, device_id)
+
+
+@api_view(['POST'])
+def broadcastPreview(request):
+    """
+    Render a broadcast without sending it
+    """
+    return previewBroadcast(request)
+
+
+@api_view(['GET'])
+def broadcastPreviewDetail(request, render_key):
+    """
+    A cached preview by its render key
+    """
+    return getBroadcastPreview(request, render_key)
+
+
+@api_view(['GET'])
+def broadcastProgress(request, broadcast_id):
+    """
+    Polling endpoint for the progress of a running broadcast
+    """
+    return getBroadcastProgress(request, broadcast_id)
+
+
+@api_view(['GET'])
+def analytics(request):
+    """
+    Daily broadcast and subscriber analytics (scoped to X-Device-ID when given)
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    return getAnalytics(request, device_id)
+
+
+@api_view(['GET'])
+def analyticsDevices(request):
+    """
+    Broadcast failure rate per device
+    """
+    return getDeviceAnalytics(request)
+
+
+@api_view(['GET'])
+def providerStats(request):
+    """
+    Provider connection pool statistics (per worker process)
+    """
+    return getProviderStats(request)
+
+
+@api_view(['GET'])
+def laneStats(request):
+    """
+    Send lane depth and wait times (per worker process) and bulk backlog
+    """
+    return getLaneStats(request)
+
+
+@api_view(['POST'])
+def sendgridWebhook(request):
+    """
+    SendGrid event webhook (batches of delivery, bounce, open, ... events)
+    """
+    return ingestProviderEvents(request)
+
+
+# Plain Django view: DRF content negotiation would reject text/event-stream
+@require_GET
+def broadcastProgressStream(request, broadcast_id):
+    """
+    Server-Sent Events stream of broadcast progress
+    """
+    return streamBroadcastProgress(request, broadcast_id)
+
+
 @api_view(['GET', 'POST'])
 def subscribers(request):
     """
     Handle subscriber list retrieval and creation
     """
-    device_id = request.headers.get('X-Device-ID')
+    device_id = (resolve_device if request.method == 'POST' else scope_device)(request.headers.get('X-Device-ID'))
     logger.info(f"Subscribers endpoint - Method: {request.method}, Device ID: {device_id}")
     
     if request.method == 'GET':
@@ -155,12 +343,33 @@ def subscribers(request):
         return createSubscriber(request, device_id)
 
 
+@api_view(['GET'])
+def subscriberSearch(request):
+    """
+    Prefix and domain search over subscribers
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    return searchSubscribers(request, device_id)
+
+
+@api_view(['POST'])
+def subscriberBulk(request):
+    """
+    Activate, deactivate or delete subscribers by ids, emails or filter
+    """
+    device_id = scope_device(request.headers.get('X-Device-ID'))
+    serializer = SubscriberBulkSerializer(data=request.data, context={'max_items': bulk.max_items()})
+    if not serializer.is_valid():
+        return Response({'error': serializer.errors}, status=400)
+    return bulkUpdateSubscribers(request, device_id, serializer.validated_data)
+
+
 @api_view(['GET', 'PUT', 'DELETE'])
 def subscriberDetail(request, pk):
     """
     Handle individual subscriber operations
     """
-    device_id = request.headers.get('X-Device-ID')
+    device_id = scope_device(request.headers.get('X-Device-ID'))
     logger.info(f"Subscriber detail - Method: {request.method}, ID: {pk}, Device ID: {device_id}")
     
     if request.method == 'GET':
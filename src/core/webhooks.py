@@ -0,0 +1,426 @@
+"""
+Ingestion of provider event webhooks (POST /webhooks/sendgrid/).
+
+SendGrid posts events in batches (a JSON array of up to a few thousand
+events) and retries for a day on anything but a 2xx, at rates well above our
+own send rate. The endpoint therefore only validates a batch and appends its
+events to a per-process buffer. A background thread flushes the buffer every
+`flush_interval` seconds, or as soon as it holds `flush_size` events, and
+every flush is one transaction of set-based statements:
+
+1. new events are bulk-inserted into DeliveryEvent; events already stored
+   (same sg_event_id) are skipped, so replaying a payload is harmless;
+2. the delivered / bounced / complaint counts of the broadcasts the events
+   belong to (custom arg broadcast_id) are incremented, one UPDATE each;
+3. hard bounces, spam reports and unsubscribes are upserted into
+   Suppression and the subscribers deactivated (core.bulk).
+
+Requests are authenticated with SendGrid's signed event webhook: an ECDSA
+(P-256, SHA-256) signature over the timestamp header and the raw body,
+checked against the account's verification key (`public_key`), with
+timestamps older than `max_age` seconds refused. A shared `token` in the
+query string is accepted as a fallback, but it ends up in access logs. With
+neither configured the endpoint refuses every request, since anyone could
+otherwise suppress addresses by posting bounces.
+
+A buffer that grows past `max_buffered` is flushed by the request itself, so
+a stalled flusher slows the provider down instead of exhausting memory.
+Events still buffered when a process is killed are lost; with `record_dir`
+set, accepted payloads are also appended to daily JSON lines files, which
+`manage.py replay_webhook_events` replays.
+"""
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from functools import lru_cache
+from .models import BroadcastLog, DeliveryEvent, Subscriber, Suppression, normalize_email
+from . import bulk
+from pathlib import Path
+import atexit
+import base64
+import binascii
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import load_der_public_key
+except ImportError:
+    ec = None
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('processed', 'deferred', 'delivered', 'dropped', 'bounce', 'open', 'click',
+          'spamreport', 'unsubscribe', 'group_unsubscribe', 'group_resubscribe')
+
+# Event -> BroadcastLog counter
+BROADCAST_COUNTERS = {'delivered': 'delivered_count', 'bounce': 'bounced_count', 'spamreport': 'complaint_count'}
+
+# Event -> Suppression reason ('blocked' bounces are temporary and not suppressed)
+SUPPRESSING_EVENTS = {'bounce': 'bounce', 'spamreport': 'spamreport',
+                      'unsubscribe': 'unsubscribe', 'group_unsubscribe': 'unsubscribe'}
+
+# Rows per IN (...) lookup and per INSERT
+CHUNK_SIZE = 500
+
+DEFAULT_OPTIONS = {
+    'public_key': '',
+    'max_age': 300,
+    'token': '',
+    'flush_size': 1000,
+    'flush_interval': 1.0,  # 0 writes every batch before answering
+    'max_buffered': 20000,
+    'max_batch': 10000,
+    'record_dir': '',
+}
+
+
+def webhook_settings():
+    options = dict(DEFAULT_OPTIONS)
+    options.update(getattr(settings, 'WEBHOOK_EVENTS', {}) or {})
+    return options
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Authentication ------------------------------------------------------------
+
+SIGNATURE_HEADER = 'HTTP_X_TWILIO_EMAIL_EVENT_WEBHOOK_SIGNATURE'
+TIMESTAMP_HEADER = 'HTTP_X_TWILIO_EMAIL_EVENT_WEBHOOK_TIMESTAMP'
+
+
+@lru_cache(maxsize=4)
+def _public_key(value):
+    # The verification key is shown by SendGrid as base64 DER, without PEM armour
+    return load_der_public_key(base64.b64decode(value))
+
+
+def verify_signature(body, signature, timestamp, public_key, max_age=300, now=None):
+    """Whether `signature` (base64 ECDSA over `timestamp` + the raw `body`
+    bytes) is valid for `public_key` and `timestamp` is at most `max_age`
+    seconds away from now."""
+    if ec is None:
+        raise RuntimeError('The cryptography package is required to verify signed webhooks')
+    try:
+        if abs((now or time.time()) - int(timestamp)) > max_age:
+            return False
+        _public_key(public_key).verify(base64.b64decode(signature), timestamp.encode('ascii') + body,
+                                       ec.ECDSA(hashes.SHA256()))
+    except (InvalidSignature, ValueError, TypeError, binascii.Error, UnicodeEncodeError):
+        return False
+    return True
+
+
+def authenticate(request, options):
+    """None when `request` is an authentic provider webhook, otherwise the
+    reason it is refused."""
+    if options['public_key']:
+        signature = request.META.get(SIGNATURE_HEADER, '')
+        timestamp = request.META.get(TIMESTAMP_HEADER, '')
+        if not signature or not timestamp:
+            return 'Missing webhook signature'
+        if not verify_signature(request.body, signature, timestamp, options['public_key'], options['max_age']):
+            return 'Invalid webhook signature'
+        return None
+    if options['token']:
+        if not hmac.compare_digest(request.GET.get('token', ''), options['token']):
+            return 'Invalid webhook token'
+        return None
+    logger.error('Provider webhook refused: set WEBHOOK_EVENTS public_key (or token) to accept events')
+    return 'Webhook authentication is not configured'
+
+
+# Validation ----------------------------------------------------------------
+
+def _event_id(item):
+    if item.get('sg_event_id'):
+        return str(item['sg_event_id'])[:100]
+    digest = hashlib.sha1(json.dumps(item, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'sha1:{digest}'
+
+
+def parse_event(item):
+    """The stored form of one webhook event, or None when it is malformed."""
+    if not isinstance(item, dict):
+        return None
+    event, email, timestamp = item.get('event'), item.get('email'), item.get('timestamp')
+    if event not in EVENTS or not isinstance(email, str) or '@' not in email:
+        return None
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        return None
+    try:
+        occurred_at = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        return None
+    return {
+        'event_id': _event_id(item),
+        'event': event,
+        'email': normalize_email(email)[:254],
+        'broadcast_id': str(item.get('broadcast_id') or '')[:255],
+        'message_id': str(item.get('sg_message_id') or '')[:255],
+        'reason': str(item.get('reason') or item.get('response') or '')[:500],
+        'bounce_type': item.get('type', ''),
+        'occurred_at': occurred_at,
+    }
+
+
+def parse_events(payload):
+    """Split a webhook payload into (events, number of malformed events).
+    Raises ValueError when the payload is not a JSON array."""
+    if not isinstance(payload, list):
+        raise ValueError('Expected a JSON array of events')
+    events = []
+    for item in payload:
+        event = parse_event(item)
+        if event is not None:
+            events.append(event)
+    return events, len(payload) - len(events)
+
+
+# Writing -------------------------------------------------------------------
+
+def _suppression_reason(event):
+    if event['event'] == 'bounce' and event['bounce_type'] == 'blocked':
+        return None
+    return SUPPRESSING_EVENTS.get(event['event'])
+
+
+def _update_broadcasts(events):
+    counts = Counter((event['broadcast_id'], BROADCAST_COUNTERS[event['event']])
+                     for event in events if event['broadcast_id'] and event['event'] in BROADCAST_COUNTERS)
+    by_broadcast = {}
+    for (broadcast_id, counter), total in counts.items():
+        by_broadcast.setdefault(broadcast_id, {})[counter] = F(counter) + total
+    for broadcast_id, increments in by_broadcast.items():
+        BroadcastLog.objects.filter(broadcast_id=broadcast_id).update(**increments)
+    return len(by_broadcast)
+
+
+def _suppress(events):
+    """Upsert the suppressions of `events`; returns the suppressed emails."""
+    latest = {}
+    for event in events:
+        reason = _suppression_reason(event)
+        if reason and (event['email'] not in latest or latest[event['email']][1] <= event['occurred_at']):
+            latest[event['email']] = (reason, event['occurred_at'])
+    if not latest:
+        return []
+    Suppression.objects.bulk_create(
+        [Suppression(email=email, reason=reason, event_at=event_at) for email, (reason, event_at) in latest.items()],
+        batch_size=CHUNK_SIZE,
+        update_conflicts=True, unique_fields=['email'], update_fields=['reason', 'event_at', 'updated_at'],
+    )
+    return list(latest)
+
+
+def write_events(events):
+    """Store parsed events and apply their effects in one transaction.
+
+    Returns counts: events, stored, duplicates, broadcasts (updated),
+    suppressed and deactivated (subscribers).
+    """
+    unique = {}
+    for event in events:
+        unique.setdefault(event['event_id'], event)
+    with transaction.atomic():
+        existing = set()
+        for chunk in _chunks(list(unique)):
+            existing.update(DeliveryEvent.objects.filter(event_id__in=chunk).values_list('event_id', flat=True))
+        new = [event for event_id, event in unique.items() if event_id not in existing]
+        DeliveryEvent.objects.bulk_create(
+            [DeliveryEvent(**{key: value for key, value in event.items() if key != 'bounce_type'}) for event in new],
+            batch_size=CHUNK_SIZE, ignore_conflicts=True,
+        )
+        broadcasts = _update_broadcasts(new)
+        suppressed = _suppress(new)
+        deactivated = 0
+        if suppressed:
+            deactivated = bulk.apply('deactivate', Subscriber.objects.all(), emails=suppressed)['changed']
+    return {'events': len(events), 'stored': len(new), 'duplicates': len(events) - len(new),
+            'broadcasts': broadcasts, 'suppressed': len(suppressed), 'deactivated': deactivated}
+
+
+def suppressed_emails(emails):
+    """The normalised addresses among `emails` that are suppressed."""
+    values = list({normalize_email(email) for email in emails})
+    found = set()
+    for chunk in _chunks(values):
+        found.update(Suppression.objects.filter(email__in=chunk).values_list('email', flat=True))
+    return found
+
+
+def exclude_suppressed(recipients):
+    """Split `recipients` into (deliverable, suppressed), keeping their order."""
+    blocked = suppressed_emails(recipients)
+    if not blocked:
+        return list(recipients), []
+    kept, dropped = [], []
+    for email in recipients:
+        (dropped if normalize_email(email) in blocked else kept).append(email)
+    return kept, dropped
+
+
+# Buffer --------------------------------------------------------------------
+
+class EventBuffer:
+    """Parsed events waiting to be written, shared by the request threads of
+    one process and flushed by a background thread."""
+
+    def __init__(self, flush_size=1000, flush_interval=1.0, max_buffered=20000):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._events = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self.stats = {'received': 0, 'flushes': 0, 'stored': 0, 'duplicates': 0, 'errors': 0}
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._events)
+
+    def add(self, events):
+        """Buffer `events`; returns the number of events now pending."""
+        with self._lock:
+            self._events.extend(events)
+            self.stats['received'] += len(events)
+            pending = len(self._events)
+        if not self.flush_interval or pending >= self.max_buffered:
+            # Synchronous mode, or the flusher is falling behind
+            self.flush(raise_errors=True)
+            return self.pending
+        self._ensure_thread()
+        if pending >= self.flush_size:
+            self._wakeup.set()
+        return pending
+
+    def flush(self, raise_errors=False):
+        """Write everything buffered so far; returns write_events() counts."""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if not events:
+                return None
+            try:
+                result = write_events(events)
+            except Exception:
+                # Keep the events for the next flush (duplicates are skipped)
+                with self._lock:
+                    self._events[:0] = events
+                    self.stats['errors'] += 1
+                if raise_errors:
+                    raise
+                logger.exception(f'Writing {len(events)} webhook events failed; retrying on the next flush')
+                return None
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['stored'] += result['stored']
+                self.stats['duplicates'] += result['duplicates']
+            return result
+
+    def _ensure_thread(self):
+        if self._thread is not None or self._stopped:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='webhook-event-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def close(self):
+        """Stop the flusher and write what is left."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(self.flush_interval, 1) * 5)
+        self.flush()
+
+
+_buffer = None
+_buffer_pid = os.getpid()
+_buffer_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The parent's flusher thread does not exist in the child
+    global _buffer, _buffer_pid, _buffer_lock
+    _buffer = None
+    _buffer_pid = os.getpid()
+    _buffer_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_buffer():
+    global _buffer
+    if _buffer_pid != os.getpid():
+        _reset_after_fork()
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                options = webhook_settings()
+                _buffer = EventBuffer(options['flush_size'], options['flush_interval'], options['max_buffered'])
+                atexit.register(_buffer.close)
+    return _buffer
+
+
+# Recording -----------------------------------------------------------------
+
+_record_lock = threading.Lock()
+
+
+def record_payload(payload, record_dir):
+    """Append a raw payload to <record_dir>/events-<date>.jsonl."""
+    path = Path(record_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    line = json.dumps(payload, separators=(',', ':')) + '\n'
+    with _record_lock:
+        with open(path / f'events-{timezone.now():%Y%m%d}.jsonl', 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def read_payloads(path):
+    """Yield the payloads recorded in `path`: a JSON array (one payload), or
+    JSON lines of arrays (record_dir files), optionally gzipped."""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        text = f.read()
+    if not text.strip():
+        return
+    try:
+        yield json.loads(text)
+        return
+    except ValueError:
+        pass
+    for number, line in enumerate(text.splitlines(), 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(f'{path}:{number}: {e}')
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -51,6 +52,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
+    'core.middleware.ResponseCompressionMiddleware',
+    'core.middleware.RequestDecompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -60,13 +63,41 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# gzip / brotli responses for large API bodies (core.middleware)
+RESPONSE_COMPRESSION = {
+    'path_prefixes': ['/api/'],
+    'min_bytes': 1024,
+    'gzip_level': 6,
+    'brotli_quality': 4,
+    'content_types': ['application/json', 'text/html', 'text/plain'],
+}
+
+# Endpoints accepting gzip / deflate request bodies (Content-Encoding), and
+# the largest body they may inflate to
+REQUEST_DECOMPRESSION = {
+    'paths': ['/api/broadcast/send/', '/api/subscribers/bulk/', '/api/webhooks/sendgrid/'],
+    'max_bytes': 64 * 1024 * 1024,
+}
+
+# orjson-backed JSON parsing and rendering when orjson is installed (core.fastjson)
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.fastjson.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.fastjson.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
 ROOT_URLCONF = 'newsletterservice.urls'
 
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'newsletterservice' / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -74,6 +105,14 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Newsletter templates get their CSS inlined and are minified once
+            # per process when first loaded (see core/template_compiler.py)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'core.template_compiler.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
@@ -91,6 +130,23 @@ DATABASES = {
     }
 }
 
+# Cache shared by the web, dispatcher and worker processes (broadcast progress).
+# Use Redis when REDIS_URL is set, otherwise a file cache on this host.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(tempfile.gettempdir(), 'newsletterservice-cache'),
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -132,6 +188,49 @@ EMAIL_HOST_PASSWORD = os.getenv('SENDGRID_API_KEY', '')  # Store your API key in
 DEFAULT_FROM_EMAIL = '234kosi@restlesssociety.xyz'
 # Make the SendGrid API key available in settings (used by SendGrid client)
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY', '')
+# The SendGrid client is imported on the first send; set this for long-lived
+# workers (e.g. run_broadcast_worker) to import it at boot instead
+PRELOAD_PROVIDER_CLIENTS = os.getenv('PRELOAD_PROVIDER_CLIENTS', '') == '1'
+# SendGrid API origin (override to point at a mock provider) and the per-process
+# pool of keep-alive connections to it (core.providers)
+SENDGRID_API_HOST = os.getenv('SENDGRID_API_HOST', 'https://api.sendgrid.com')
+PROVIDER_HTTP_POOL = {
+    'size': int(os.getenv('PROVIDER_HTTP_POOL_SIZE', '10')),
+    'timeout': 30,        # seconds per request
+    'idle_timeout': 60,   # idle connections older than this are not reused
+}
+
+# Transports (SendGrid API keys / accounts and SMTP relays) that the 'balanced'
+# broadcast transport spreads sends over by weight, with a circuit breaker per
+# entry and failover between them (core.transports.BalancedTransport). Entries:
+# {'name': ..., 'type': 'sendgrid' | 'smtp', 'weight': 1, 'api_key': ..., 'host': ...};
+# SENDGRID_API_KEYS="key,key:weight,..." fills it with one SendGrid entry per key
+BROADCAST_TRANSPORTS = [
+    {'name': f'sendgrid-{index}', 'type': 'sendgrid', 'api_key': key.partition(':')[0],
+     'weight': float(key.partition(':')[2] or 1)}
+    for index, key in enumerate(filter(None, os.getenv('SENDGRID_API_KEYS', '').split(',')), 1)
+]
+# Per-transport circuit breaker: it opens when, over the last `window` sends (at
+# least `min_requests`), the error or the 429 rate reaches its threshold, and lets a
+# trial send through after `cooldown` seconds (doubling up to `max_cooldown` while it
+# keeps failing). A send waits at most `max_wait` seconds when every transport is open.
+TRANSPORT_CIRCUIT_BREAKER = {
+    'window': 50,
+    'min_requests': 10,
+    'error_threshold': 0.5,
+    'throttle_threshold': 0.2,
+    'cooldown': 30,
+    'max_cooldown': 300,
+    'max_wait': 10,
+}
+
+# Broadcast transport: 'sendgrid' (HTTP API), 'smtp' (pooled persistent connections
+# to EMAIL_HOST; override host/port/credentials in BROADCAST_SMTP, e.g. for a local debug server)
+# or 'balanced' (BROADCAST_TRANSPORTS, the default when any are configured)
+BROADCAST_TRANSPORT = os.getenv('BROADCAST_TRANSPORT', 'balanced' if BROADCAST_TRANSPORTS else 'sendgrid')
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '4'))
+SMTP_POOL_MAX_MESSAGES = int(os.getenv('SMTP_POOL_MAX_MESSAGES', '100'))
+BROADCAST_SMTP = {}
 
 
 # Static files (CSS, JavaScript, Images)
@@ -248,4 +347,102 @@ NEWSLETTER_IMAGES = {
     'whatsapp': WHATSAPP_ICON_URL,
     'header_bg': HEADER_BG_URL,
     'footer_bg': FOOTER_BG_URL,
-}
\ No newline at end of file
+}
+
+# Public origin serving STATIC_URL (e.g. https://newsletterservice.pythonanywhere.com).
+# When set, images optimised by `manage.py optimize_images` are linked by their
+# content-hashed file names instead of the URLs above.
+NEWSLETTER_ASSET_BASE_URL = os.getenv('NEWSLETTER_ASSET_BASE_URL', '')
+
+# Templates compiled (CSS inlined + minified) by core.template_compiler.Loader
+NEWSLETTER_COMPILE_TEMPLATES = True
+NEWSLETTER_COMPILED_TEMPLATES = ['newsletter-announcement.html', 'newsletter-event.html']
+
+# Rendered newsletters kept per process, keyed by template version and content
+# (core.render_cache); least recently used renders are evicted first
+NEWSLETTER_RENDER_CACHE = {
+    'max_entries': 256,
+    'max_bytes': 32 * 1024 * 1024,
+}
+
+# Fallbacks for merge tags ({{first_name}}) a recipient has no value for and
+# that give no default of their own (core.personalize)
+MERGE_TAG_DEFAULTS = {
+    'first_name': 'there',
+}
+
+# Scheduled broadcast dispatcher (python manage.py dispatch_broadcasts)
+BROADCAST_DISPATCHER_WORKERS = int(os.getenv('BROADCAST_DISPATCHER_WORKERS', '2'))
+BROADCAST_DISPATCHER_RESYNC_SECONDS = int(os.getenv('BROADCAST_DISPATCHER_RESYNC_SECONDS', '300'))
+BROADCAST_DISPATCHER_WAKEUP_ADDRESS = ('127.0.0.1', int(os.getenv('BROADCAST_DISPATCHER_WAKEUP_PORT', '8765')))
+
+# Sharded broadcasts (python manage.py run_broadcast_worker)
+BROADCAST_SHARD_LEASE_SECONDS = int(os.getenv('BROADCAST_SHARD_LEASE_SECONDS', '60'))
+BROADCAST_SHARD_BATCH_SIZE = int(os.getenv('BROADCAST_SHARD_BATCH_SIZE', '25'))
+BROADCAST_SHARD_IDLE_SECONDS = int(os.getenv('BROADCAST_SHARD_IDLE_SECONDS', '5'))
+# Claims of one partition before it is marked failed
+BROADCAST_SHARD_MAX_ATTEMPTS = int(os.getenv('BROADCAST_SHARD_MAX_ATTEMPTS', '5'))
+
+# Shared token bucket for outbound SendGrid calls (all processes on this host).
+# Bulk (broadcast) sends leave `reserve` of the burst for transactional single sends.
+PROVIDER_RATE_LIMIT = {
+    'rate': float(os.getenv('PROVIDER_RATE_LIMIT_PER_SECOND', '0')),  # 0 disables limiting
+    'burst': float(os.getenv('PROVIDER_RATE_LIMIT_BURST', '0')) or None,
+    'reserve': {'transactional': 0.0, 'bulk': 0.2},
+    'timeout': {'transactional': 10, 'bulk': 300},
+}
+
+# Priority lanes for provider calls within a process (core.lanes): at most `capacity`
+# calls in flight (default PROVIDER_HTTP_POOL size), of which `reserved` are kept for
+# transactional single sends so they never queue behind a broadcast
+SEND_LANES = {
+    'capacity': int(os.getenv('SEND_LANES_CAPACITY', '0')) or None,
+    'reserved': {'transactional': int(os.getenv('SEND_LANES_TRANSACTIONAL_RESERVED', '2'))},
+}
+
+# Live broadcast progress (cache snapshots polled by /broadcast/<id>/progress/ and its SSE stream)
+BROADCAST_PROGRESS_EVERY = int(os.getenv('BROADCAST_PROGRESS_EVERY', '25'))  # publish every N recipients
+BROADCAST_PROGRESS_TTL = 3600
+BROADCAST_PROGRESS_STREAM_INTERVAL = 1.0
+# SSE streams hold a worker thread while open: serve them from threaded or async
+# workers (gunicorn --threads / gevent, ASGI). Streams end after TIMEOUT seconds
+# (clients reconnect with Last-Event-ID); beyond MAX open streams per process
+# watchers get a 503 and poll instead.
+BROADCAST_PROGRESS_STREAM_TIMEOUT = int(os.getenv('BROADCAST_PROGRESS_STREAM_TIMEOUT', '30'))
+BROADCAST_PROGRESS_STREAM_MAX = int(os.getenv('BROADCAST_PROGRESS_STREAM_MAX', '4'))
+
+# POST /subscribers/bulk/: rows per SELECT + UPDATE round, and ids/emails (or
+# subscribers matched by a filter) per request
+SUBSCRIBER_BULK_CHUNK_SIZE = 500
+SUBSCRIBER_BULK_MAX_ITEMS = 100000
+
+# Provider event webhooks (POST /api/webhooks/sendgrid/). Requests must carry
+# SendGrid's signature, checked with the Signed Event Webhook verification key
+# (public_key) and refused when older than max_age seconds; without a key, a
+# ?token=... shared secret is accepted instead (it ends up in access logs). With
+# neither set every request is refused. Events are buffered per process and
+# written in bulk every flush_interval seconds or flush_size events (0 writes each
+# batch before answering). With record_dir set, raw payloads are kept for
+# `manage.py replay_webhook_events`.
+WEBHOOK_EVENTS = {
+    'public_key': os.getenv('SENDGRID_WEBHOOK_PUBLIC_KEY', ''),
+    'max_age': 300,
+    'token': os.getenv('SENDGRID_WEBHOOK_TOKEN', ''),
+    'flush_size': 1000,
+    'flush_interval': float(os.getenv('WEBHOOK_FLUSH_INTERVAL', '1.0')),
+    'max_buffered': 20000,
+    'max_batch': 10000,
+    'record_dir': os.getenv('WEBHOOK_RECORD_DIR', ''),
+}
+
+# X-Device-ID -> Device id mappings kept in each process (core.devices)
+DEVICE_CACHE_SIZE = 10000
+
+# Retention of old broadcast data (python manage.py apply_retention)
+RETENTION = {
+    'compress_after_days': int(os.getenv('RETENTION_COMPRESS_AFTER_DAYS', '30')),
+    # Rows older than this are archived and deleted; unset keeps them forever
+    'prune_after_days': int(os.getenv('RETENTION_PRUNE_AFTER_DAYS', '0')) or None,
+    'archive_dir': os.getenv('RETENTION_ARCHIVE_DIR', str(BASE_DIR / 'archive')),
+    'batch_size': 500,
+}